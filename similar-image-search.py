@@ -56,111 +56,857 @@
 # python similar-image-search.py "C:\AI\CHATGPT-3.5-visually-similar-image-search\input.png" "D:\AI_outputs_etc" --threshold 0.005
 # finds at least 0.5% similar images
 
-import cv2
+# Build a histogram index once, then search against it; only new or modified files are decoded again:
+# python similar-image-search.py index build "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx"
+# python similar-image-search.py index update --index "D:\AI_outputs_etc.idx"
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx"
+
+# Check how much smaller histograms change the rankings, then store them as uint8 (a quarter of the size)
+# and serve them memory-mapped:
+# python similar-image-search.py index eval --index "D:\AI_outputs_etc.idx" --queries 200
+# python similar-image-search.py index update --index "D:\AI_outputs_etc.idx" --precision uint8
+# python similar-image-search.py serve --index "D:\AI_outputs_etc.idx" --mmap
+
+# Decode images on several cores (0 uses all of them):
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --workers 0
+
+# On a network share, read files on 8 threads ahead of the decoders, and on later updates don't list folders
+# whose modification time did not change (images overwritten in place are then only seen without the option);
+# the time spent on I/O and on CPU is printed after the update:
+# python similar-image-search.py index update --index "D:\AI_outputs_etc.idx" --workers 0 --readahead 8 --skip-unchanged-dirs
+
+# Decode images at reduced resolution, after checking how much that changes the histograms:
+# python similar-image-search.py drift "D:\AI_outputs_etc" --sample 200
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --decode-scale 1/4
+
+# Match every image of a folder (or of a text file with one path per line) against the search folder in one pass:
+# python similar-image-search.py batch "C:\AI\inputs" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --output "C:\AI\matches"
+
+# Train an approximate nearest-neighbour index on top of a histogram index, check its recall
+# against exact search, then only search the closest inverted lists:
+# python similar-image-search.py ann build --index "D:\AI_outputs_etc.idx"
+# python similar-image-search.py ann eval --index "D:\AI_outputs_etc.idx" --probes 1 4 16
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --probes 8
+
+# Look for near-duplicates of an image by first matching perceptual hashes, then ranking only those by histogram:
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --hash-radius 10
+
+# Rank the whole folder by color histogram, then re-rank the best 300 with 2x2 grid histograms and the best 50 of
+# those with ORB keypoints; the time every stage took is printed with the results:
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --candidates 300 --rerank hsv@2x2 orb=50
+
+# Group the near-duplicate images of a whole folder and pick the largest file of every group:
+# python similar-image-search.py dedupe "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --threshold 0.9 --output duplicates.csv
+
+# Split an archive spread over several volumes into shards (one per volume, here each split in two more by path hash),
+# keep every shard up to date on its own, and search all of them in parallel:
+# python similar-image-search.py shard build "D:\AI_outputs_etc" "E:\archive" --index "D:\archive.shards" --shards 2
+# python similar-image-search.py shard update --index "D:\archive.shards" --only shard-002
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\archive.shards"
+# Every shard is an ordinary index, so each one can also be served on its own and searched through all services:
+# python similar-image-search.py serve --index "D:\archive.shards\shard-000" --port 8765
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --server http://127.0.0.1:8765,http://127.0.0.1:8766
+
+# Keep an index in memory in a local search service, then search through it without reloading anything:
+# python similar-image-search.py serve --index "D:\AI_outputs_etc.idx"
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --server
+
+# Keep an index live while new images keep arriving, on its own or inside the search service:
+# python similar-image-search.py watch "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx"
+# python similar-image-search.py serve --index "D:\AI_outputs_etc.idx" --watch
+
+# Measure every search stage on a synthetic corpus, save the report as a baseline, and check later changes against it:
+# python similar-image-search.py bench run --images 2000 --formats jpg=0.7,png=0.3 --resolutions 1920x1080 --output baseline.json
+# python similar-image-search.py bench run --images 2000 --formats jpg=0.7,png=0.3 --resolutions 1920x1080 --baseline baseline.json
+
+# Check that the command line still starts fast enough to be called from scripts (exits with 1 above the target):
+# python similar-image-search.py bench startup --runs 20
+
+# Search from Python with the same engine the command line and the GUIs use:
+# from similar_image_search import engine
+# similar_images = engine.query(r"C:\AI\input.png", index_path=r"D:\AI_outputs_etc.idx", num_similar=10)
+
+# Images are checked against a pixel limit and a memory budget before they are decoded; JPEG files over the budget
+# are decoded at a smaller scale, anything else is skipped only when over a budget given with --memory-budget (an index
+# retries skipped images once the limits change). The full image is still decoded; only the HSV histogram runs in strips:
+# python similar-image-search.py index update "D:\scans" --index "D:\scans.idx" --max-pixels 400000000 --memory-budget 256M
+
+# Search the images inside zip and tar archives as well, without extracting them; they are reported and indexed
+# under paths like "D:\AI_outputs_etc\batch-01.zip!/day1/0001.png":
+# python similar-image-search.py index build "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --archives
+
+# Store a 4x4 grid of coarse histograms per image, then look for images whose top right quarter looks like the whole
+# input image (regions are LEFT,TOP,RIGHT,BOTTOM in grid cells), or like its own top right quarter:
+# python similar-image-search.py index update --index "D:\AI_outputs_etc.idx" --regions
+# python similar-image-search.py "C:\AI\logo.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --region 2,0,4,2
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --index "D:\AI_outputs_etc.idx" --region 2,0,4,2 --input-region 2,0,4,2
+
+# Show the best matches while the folder is still being scanned:
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --stream
+
+# Write the time spent in every stage and the number of failed images by category (a .prom file is written in the
+# Prometheus text format), and profile the run with cProfile; both options work with every command:
+# python similar-image-search.py "C:\AI\input.png" "D:\AI_outputs_etc" --metrics metrics.json --profile search.prof
+# A running search service reports the same metrics on http://127.0.0.1:8765/metrics
+
 import os
-import numpy as np
 import argparse
+import csv
+import json
 import logging
 import sys
 from datetime import datetime
 
-# Function to compute the color histogram of an image
-def compute_histogram(image_path):
-    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
-
-    if image is None:
-        logging.warning(f"Unable to read image '{image_path}'")
-        return None
-
-    # Check if the image is grayscale, and convert it to color if necessary
-    if len(image.shape) == 2:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-    # Convert the image to the HSV color space
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+# Only the light modules are imported here, so --help and the subcommands that don't decode images start fast;
+# every command imports the modules it needs when it runs
+from similar_image_search import engine
+from similar_image_search.metrics import instrumented
+from similar_image_search.options import (DEFAULT_CANDIDATES, DEFAULT_HOST, DEFAULT_PORT, DEFAULT_SCAN_THREADS,
+                                          DEFAULT_URL, GRID_SIZE, PRECISION_NAMES, parse_byte_size,
+                                          parse_decode_scale, parse_region)
 
-    # Calculate the histogram
-    hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-
-    # Normalize the histogram
-    hist = cv2.normalize(hist, hist).flatten()
+# Function to print the similar images and log them to a timestamped output file
+def report_similar_images(input_image_path, threshold, num_similar, similar_images):
+    if similar_images:
+        print(f"Similar images to '{input_image_path}' (with similarity threshold {threshold * 100}% or higher):")
+        for i, (image_path, score) in enumerate(similar_images):
+            print(f"{i + 1}. {image_path} (similarity {score:.4f})")
 
-    return hist
+        output_file = engine.save_results(input_image_path, threshold, num_similar, similar_images)
 
-# Function to calculate the similarity score between two histograms
-def calculate_similarity_score(hist1, hist2):
-    # Use the chi-squared distance as the similarity score
-    score = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
-    return 1.0 / (1.0 + score)  # Convert distance to similarity
+        print(f"Similar images logged to '{output_file}'")
 
-# Function to find visually similar images
-def find_similar_images(input_image_path, search_folder, threshold=0.005, num_similar=5):
-    input_hist = compute_histogram(input_image_path)
-    if input_hist is None:
+# Function to show the best matches found so far while a streaming search is running
+def print_snapshot(snapshot, total=None):
+    if snapshot.done:
         return
 
-    image_paths = []
-    image_histograms = []
-
-    # Iterate through the subfolders and find image histograms
-    for root, dirs, files in os.walk(search_folder):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp')):
-                image_path = os.path.join(root, file)
-                image_hist = compute_histogram(image_path)
+    print(f"Scanned {snapshot.scanned} images in {snapshot.elapsed:.1f}s, best matches so far:")
+    for i, (image_path, score) in enumerate(snapshot.results):
+        print(f"  {i + 1}. {image_path} (similarity {score:.4f})")
+
+# Function to print the cost of every stage of a re-ranking cascade
+def print_cascade_costs(costs):
+    from similar_image_search import format_cascade_costs
+
+    print(f"Cascade stages:\n{format_cascade_costs(costs)}")
+
+# Function to refresh an index, or every shard of a sharded index, and get all the images it holds as
+# (paths, histograms, file sizes, decode scale, the index or None for a sharded index)
+def refresh_indexed_images(search_folder, index_path, workers=1, decode_scale=None, limits=None):
+    from similar_image_search import ShardedIndex, is_sharded_index
+
+    if not is_sharded_index(index_path):
+        index, stats = engine.index(search_folder, index_path, workers, decode_scale, limits=limits)
+        logging.info(f"Index '{index_path}' refreshed: {stats}")
+        return index.paths, index.histograms, index.sizes, index.decode_scale, index
+
+    import numpy as np
+
+    from similar_image_search import HISTOGRAM_SIZE
+    from similar_image_search.store import stored_histograms
+
+    sharded = ShardedIndex.load(index_path)
+    stats = sharded.update(workers=workers, decode_scale=decode_scale, limits=limits)
+    logging.info(f"Shards of '{index_path}' refreshed: {stats}")
+
+    # The shards are searched as one index, so images are also matched across shards
+    indexes = sharded.load_shards()
+    if not indexes:
+        return [], np.empty((0, HISTOGRAM_SIZE), dtype=np.float32), np.empty(0, dtype=np.int64), decode_scale or 1, None
+    return ([image_path for index in indexes for image_path in index.paths],
+            np.vstack([stored_histograms(index.histograms, 'float32') for index in indexes]),
+            np.concatenate([index.sizes for index in indexes]), indexes[0].decode_scale, None)
+
+# Function to match many input images against one folder, scanning the folder only once.
+# Writes one results file per input image plus a results.json covering all of them.
+def find_similar_images_batch(input_image_paths, search_folder, threshold=0.005, num_similar=5, index_path=None,
+                              workers=1, decode_scale=None, output_folder=None, limits=None):
+    from similar_image_search import batch_similar_images, iter_image_paths
+
+    if index_path:
+        image_paths, image_histograms, sizes, decode_scale, index = refresh_indexed_images(search_folder, index_path,
+                                                                                          workers, decode_scale, limits)
+    else:
+        decode_scale = decode_scale or 1
+        image_paths = list(iter_image_paths(search_folder))
+        histograms, hashes, ok = engine.extract(image_paths, workers, decode_scale, limits=limits)
+        image_paths = [image_path for image_path, decoded in zip(image_paths, ok) if decoded]
+        image_histograms = histograms[ok]
+
+    # Decode all input images the same way as the folder images
+    query_histograms, query_hashes, query_ok = engine.extract(input_image_paths, workers, decode_scale, limits=limits)
+    input_image_paths = [image_path for image_path, decoded in zip(input_image_paths, query_ok) if decoded]
+
+    matches = batch_similar_images(query_histograms[query_ok], image_histograms, threshold, num_similar)
+    results = {input_image_path: [(image_paths[i], score) for i, score in similar]
+               for input_image_path, similar in zip(input_image_paths, matches)}
+
+    if output_folder is None:
+        output_folder = f"similar-images-batch-{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}"
+    os.makedirs(output_folder, exist_ok=True)
+
+    for n, (input_image_path, similar_images) in enumerate(results.items()):
+        name = os.path.splitext(os.path.basename(input_image_path))[0]
+        output_file = os.path.join(output_folder, f"{n + 1:05d}-{name}.txt")
+        engine.write_results(output_file, input_image_path, threshold, num_similar, similar_images)
+
+    with open(os.path.join(output_folder, 'results.json'), 'w', encoding='utf-8') as json_file:
+        json.dump({input_image_path: [{'path': image_path, 'score': score} for image_path, score in similar_images]
+                   for input_image_path, similar_images in results.items()}, json_file, indent=2)
+
+    print(f"Matched {len(results)} input images against {len(image_paths)} images, "
+          f"results written to '{output_folder}'")
+
+    return results
+
+# Function to find every group of near-duplicate images in a folder and write the groups to
+# a JSON or CSV file, depending on the extension of output_file
+def find_duplicate_images(search_folder, threshold=0.9, index_path=None, workers=1, decode_scale=None, probes=None,
+                          output_file=None, limits=None):
+    from similar_image_search import (cluster_duplicates, find_duplicate_pairs, find_duplicate_pairs_ivf,
+                                      iter_image_paths, load_ivf, representative_scores)
+
+    if index_path:
+        image_paths, image_histograms, sizes, decode_scale, index = refresh_indexed_images(search_folder, index_path,
+                                                                                          workers, decode_scale, limits)
+    else:
+        image_paths = list(iter_image_paths(search_folder))
+        histograms, hashes, ok = engine.extract(image_paths, workers, decode_scale or 1, limits=limits)
+        image_paths = [image_path for image_path, decoded in zip(image_paths, ok) if decoded]
+        image_histograms = histograms[ok]
+        sizes = [os.path.getsize(image_path) for image_path in image_paths]
+
+    if probes:
+        # Only compare every image with the images in its closest inverted lists
+        pairs = find_duplicate_pairs_ivf(image_histograms, load_ivf(index, index_path), threshold, probes)
+    else:
+        pairs = find_duplicate_pairs(image_histograms, threshold)
+
+    clusters = []
+    for representative, members in cluster_duplicates(len(image_paths), pairs[0], pairs[1], sizes):
+        scores = representative_scores(image_histograms, representative, members)
+        clusters.append({
+            'representative': image_paths[representative],
+            'images': [{'path': image_paths[i], 'similarity': float(score)} for i, score in zip(members, scores)],
+        })
+
+    if output_file is None:
+        output_file = f"duplicate-images-{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.json"
+
+    if output_file.lower().endswith('.csv'):
+        with open(output_file, 'w', encoding='utf-8', newline='') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['cluster', 'path', 'representative', 'similarity'])
+            for n, cluster in enumerate(clusters):
+                for image in cluster['images']:
+                    writer.writerow([n + 1, image['path'], int(image['path'] == cluster['representative']),
+                                     f"{image['similarity']:.4f}"])
+    else:
+        with open(output_file, 'w', encoding='utf-8') as out_file:
+            json.dump({'threshold': threshold, 'images': len(image_paths), 'clusters': clusters}, out_file, indent=2)
+
+    duplicates = sum(len(cluster['images']) - 1 for cluster in clusters)
+    print(f"Found {len(clusters)} groups of near-duplicate images ({duplicates} duplicates) "
+          f"among {len(image_paths)} images, written to '{output_file}'")
+
+    return clusters
+
+# Function to send warnings to the errors log once the arguments have been parsed. Standard error
+# is left alone, so crashes still show on the console; failure counts are in the metrics.
+def configure_logging():
+    # Configure logging to save errors to a file
+    logging.basicConfig(filename='errors_log.txt', level=logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
 
-                if image_hist is not None:
-                    image_paths.append(image_path)
-                    image_histograms.append(image_hist)
+# Function to take the --metrics and --profile options, which every command accepts, out of the arguments
+def parse_instrumentation_arguments(argv):
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--metrics")
+    parser.add_argument("--profile")
+    return parser.parse_known_args(argv)
+
+# Function to parse a --decode-scale value for argparse
+def decode_scale_type(value):
+    try:
+        return parse_decode_scale(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+# Function to parse a --memory-budget value such as 512M for argparse
+def byte_size_type(value):
+    try:
+        return parse_byte_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+# Function to parse a --region value such as 0,0,2,2 for argparse
+def region_type(value):
+    try:
+        return parse_region(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+# Function to add the options limiting the size of the images decoded to a command
+def add_limit_arguments(parser):
+    parser.add_argument("--max-pixels", type=int,
+                        help="Skip images with more pixels than this without decoding them (default: 2^30, or the limit of the index)")
+    parser.add_argument("--memory-budget", type=byte_size_type,
+                        help="Memory one image may take while decoded, e.g. 256M; larger JPEG files are decoded at a smaller scale, "
+                             "other formats skipped only when this is given (default: 512M for JPEG files only, or the budget of the index)")
+
+# Function to get the image limits given on the command line, or None to keep the defaults (or those of the index)
+def image_limits(args):
+    if args.max_pixels is None and args.memory_budget is None:
+        return None
 
-    if not image_paths:
+    from similar_image_search.limits import DEFAULT_LIMITS, ImageLimits
+
+    return ImageLimits(args.max_pixels or DEFAULT_LIMITS.max_pixels, args.memory_budget)
+
+# Function to add the options of the folder scan and the file readahead to a command
+def add_scan_arguments(parser):
+    parser.add_argument("--scan-threads", type=int, default=DEFAULT_SCAN_THREADS,
+                        help="Number of threads listing folders and reading file sizes and dates")
+    parser.add_argument("--readahead", type=int, default=0,
+                        help="Number of threads reading image files ahead of the decoders, so reading overlaps with "
+                             "decoding, e.g. on network shares (default: 0, the decoders read the files)")
+    parser.add_argument("--skip-unchanged-dirs", action="store_true",
+                        help="Don't list folders whose modification time is unchanged since the index was last refreshed; "
+                             "faster, but misses images overwritten in place")
+    parser.add_argument("--archives", action="store_true",
+                        help="Also search the images inside zip and tar archives without extracting them "
+                             "(an index keeps this setting once built with it)")
+
+# Function to handle the "index build" and "index update" commands
+def run_index_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py index",
+                                     description="Build, refresh or evaluate a persistent histogram index.")
+    parser.add_argument("action", choices=["build", "update", "eval"],
+                        help="Build a new index, update an existing one, or report how much storing its histograms "
+                             "at lower precision changes the rankings")
+    parser.add_argument("search_folder", nargs="?", help="Folder to index (defaults to the folder stored in the index on update)")
+    parser.add_argument("--index", required=True, help="Path of the index directory")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of an existing index)")
+    parser.add_argument("--precision", choices=PRECISION_NAMES,
+                        help="Store histograms as float32, float16 (half the size) or uint8 (a quarter) "
+                             "(default: float32, or the precision of an existing index)")
+    parser.add_argument("--queries", type=int, default=100, help="Number of indexed images used as queries by eval")
+    parser.add_argument("--num_similar", type=int, default=10, help="Number of best matches compared by eval")
+    parser.add_argument("--regions", action="store_true",
+                        help=f"Also store a {GRID_SIZE}x{GRID_SIZE} grid of histograms per image for --region queries "
+                             f"(4 kB per image; turning it on decodes every image again)")
+    add_scan_arguments(parser)
+    add_limit_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.search_folder is None:
+        if args.action == "build":
+            parser.error("a search folder is required to build an index")
+        if not os.path.isdir(args.index):
+            parser.error(f"index '{args.index}' does not exist, give a search folder to create it")
+
+    configure_logging()
+
+    from similar_image_search import FeatureIndex, evaluate_precisions, format_time_breakdown
+
+    if args.action == "eval":
+        index = FeatureIndex.load(args.index)
+        if index.precision != "float32":
+            parser.error(f"index '{args.index}' is stored as {index.precision}, evaluate a float32 index instead")
+        print(f"Ranking changes over {min(args.queries, len(index))} queries against {len(index)} images:")
+        for report in evaluate_precisions(index.histograms, num_queries=args.queries, num_similar=args.num_similar):
+            print(", ".join(f"{key}={value}" for key, value in report.items()))
         return
 
-    # Calculate the similarity scores
-    similarity_scores = [calculate_similarity_score(input_hist, hist) for hist in image_histograms]
-
-    # Find images that meet the similarity threshold
-    similar_indices = [i for i, score in enumerate(similarity_scores) if score >= threshold]
-
-    # Sort the images by similarity
-    similar_images = [image_paths[i] for i in similar_indices]
-
-    if similar_images:
-        print(f"Similar images to '{input_image_path}' (with similarity threshold {threshold * 100}% or higher):")
-        for i, image_path in enumerate(similar_images[:num_similar]):
-            print(f"{i + 1}. {image_path}")
-
-        # Generate a file name based on the current date and time
-        now = datetime.now()
-        timestamp = now.strftime("%d-%m-%Y_%H-%M-%S")
-        output_file = f"similar-images-{timestamp}.txt"
-
-        # Log command-line options and similar images to the output file
-        with open(output_file, 'w') as out_file:
-            out_file.write(f"Input image: {input_image_path}\n")
-            out_file.write(f"Threshold: {threshold}\n")
-            out_file.write(f"Number of similar images: {num_similar}\n\n")
-            out_file.write("Similar images:\n")
-
-            for i, image_path in enumerate(similar_images[:num_similar]):
-                out_file.write(f"{i + 1}. {image_path}\n")
-
-        print(f"Similar images logged to '{output_file}'")
-
-if __name__ == "__main__":
+    try:
+        index, stats = engine.index(args.search_folder, args.index, args.workers, args.decode_scale, args.precision,
+                                    args.scan_threads, args.readahead, args.skip_unchanged_dirs,
+                                    rebuild=args.action == "build", limits=image_limits(args),
+                                    archives=args.archives or None, regions=args.regions or None)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print(f"Index '{args.index}' now holds {len(index)} images "
+          f"({stats['added']} added, {stats['updated']} updated, {stats['removed']} removed, "
+          f"{stats['unchanged']} unchanged, {stats['failed']} unreadable)")
+    print(f"Scanned {stats['folders_listed']} folders, skipped {stats['folders_skipped']} unchanged ones; "
+          f"{format_time_breakdown()}")
+
+# Function to handle the "batch" command
+def run_batch_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py batch",
+                                     description="Find visually similar images for many input images in one pass.")
+    parser.add_argument("queries", help="Folder of input images, or a text file with one input image path per line")
+    parser.add_argument("search_folder", help="Folder to search for similar images")
+    parser.add_argument("--threshold", type=float, default=0.005, help="Similarity score threshold (from 0 to 1)")
+    parser.add_argument("--num_similar", type=int, default=5, help="Number of similar images to find per input image")
+    parser.add_argument("--index",
+                        help="Histogram index directory, or sharded index directory (all shards are searched), to reuse "
+                             "and refresh instead of rescanning every image")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of the index)")
+    parser.add_argument("--output", help="Folder for the per-image results (default: a timestamped folder)")
+    add_limit_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    configure_logging()
+
+    from similar_image_search import load_query_paths
+
+    find_similar_images_batch(load_query_paths(args.queries), args.search_folder, args.threshold, args.num_similar,
+                              args.index, args.workers, args.decode_scale, args.output, image_limits(args))
+
+# Function to handle the "dedupe" command
+def run_dedupe_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py dedupe",
+                                     description="Find groups of near-duplicate images in a folder.")
+    parser.add_argument("search_folder", help="Folder to search for near-duplicate images")
+    parser.add_argument("--threshold", type=float, default=0.9,
+                        help="Similarity score (above 0, at most 1) two images need in both directions to count as duplicates")
+    parser.add_argument("--index",
+                        help="Histogram index directory, or sharded index directory, to reuse and refresh instead of "
+                             "rescanning every image; duplicates are also found across shards")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of the index)")
+    parser.add_argument("--probes", type=int,
+                        help="Only compare images within this many inverted lists of the index's approximate nearest-neighbour index")
+    parser.add_argument("--output", help="JSON or CSV file for the duplicate groups (default: a timestamped JSON file)")
+    add_limit_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if not 0 < args.threshold <= 1:
+        parser.error("--threshold must be above 0 and at most 1")
+    if args.probes and not args.index:
+        parser.error("--probes needs an --index")
+
+    from similar_image_search import is_sharded_index
+
+    if args.probes and is_sharded_index(args.index):
+        parser.error("--probes needs an index that is not sharded, the inverted lists belong to one index")
+
+    configure_logging()
+
+    find_duplicate_images(args.search_folder, args.threshold, args.index, args.workers, args.decode_scale, args.probes,
+                          args.output, image_limits(args))
+
+# Function to handle the "ann build", "ann query" and "ann eval" commands
+def run_ann_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py ann",
+                                     description="Build, query or evaluate the approximate nearest-neighbour index of a histogram index.")
+    parser.add_argument("action", choices=["build", "query", "eval"],
+                        help="Train the index, search it with an input image, or report its recall against exact search")
+    parser.add_argument("input_image_path", nargs="?", help="Path to the input image (query only)")
+    parser.add_argument("--index", required=True, help="Path of the histogram index directory")
+    parser.add_argument("--lists", type=int, help="Number of inverted lists to train (default: 4 * sqrt(number of images))")
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32],
+                        help="Number of lists searched per query; query uses the first value, eval reports every value")
+    parser.add_argument("--threshold", type=float, default=0.005, help="Similarity score threshold (from 0 to 1)")
+    parser.add_argument("--num_similar", type=int, default=10, help="Number of similar images to find")
+    parser.add_argument("--queries", type=int, default=100, help="Number of indexed images used as queries by eval")
+
+    args = parser.parse_args(argv)
+
+    if args.action == "query" and args.input_image_path is None:
+        parser.error("an input image is required to query the index")
+
+    configure_logging()
+
+    from similar_image_search import FeatureIndex, compute_histogram, evaluate_recall, load_ivf
+
+    index = FeatureIndex.load(args.index)
+    if not len(index):
+        parser.error(f"index '{args.index}' holds no images, update it with the index command first")
+
+    if args.action == "build":
+        ivf = load_ivf(index, args.index, args.lists, rebuild=True)
+        print(f"Trained {ivf.n_lists} inverted lists over {len(index)} images in '{args.index}'")
+    elif args.action == "query":
+        input_hist = compute_histogram(args.input_image_path, index.decode_scale)
+        if input_hist is None:
+            return
+        ivf = load_ivf(index, args.index, args.lists)
+        similar_images = [(index.paths[i], score) for i, score in
+                          ivf.search(input_hist, index.histograms, args.threshold, args.num_similar, args.probes[0])]
+        report_similar_images(args.input_image_path, args.threshold, args.num_similar, similar_images)
+    else:
+        ivf = load_ivf(index, args.index, args.lists)
+        for report in evaluate_recall(ivf, index.histograms, args.probes, args.queries, args.num_similar):
+            print(", ".join(f"{key}={value}" for key, value in report.items()))
+
+# Function to handle the "shard build" and "shard update" commands
+def run_shard_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py shard",
+                                     description="Build or refresh a sharded histogram index, one index per shard.")
+    parser.add_argument("action", choices=["build", "update"], help="Build a new sharded index or update its shards")
+    parser.add_argument("roots", nargs="*", help="Folders to index, one or more shards each (build only)")
+    parser.add_argument("--index", required=True, help="Path of the sharded index directory")
+    parser.add_argument("--shards", type=int, default=1, help="Number of shards every folder is split into by path hash")
+    parser.add_argument("--only", nargs="+", metavar="SHARD", help="Only update these shards, e.g. shard-002")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of the shards)")
+    parser.add_argument("--precision", choices=PRECISION_NAMES,
+                        help="Store histograms as float32, float16 or uint8 (default: float32, or the precision of the shards)")
+
+    args = parser.parse_args(argv)
+
+    if args.action == "build" and not args.roots:
+        parser.error("give the folders to index")
+    if args.action == "update" and args.roots:
+        parser.error("the folders of a sharded index are set when it is built")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+
+    configure_logging()
+
+    from similar_image_search import ShardedIndex
+
+    if args.action == "build":
+        sharded = ShardedIndex.create(args.index, [os.path.abspath(root) for root in args.roots], args.shards)
+    else:
+        sharded = ShardedIndex.load(args.index)
+
+    for name, stats in sharded.update(args.only, args.workers, args.decode_scale, args.precision).items():
+        print(f"{name}: {stats['added']} added, {stats['updated']} updated, {stats['removed']} removed, "
+              f"{stats['unchanged']} unchanged, {stats['failed']} unreadable")
+
+# Function to handle the "drift" command, measuring how reduced decoding changes the histograms
+def run_drift_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py drift",
+                                     description="Compare histograms from reduced-resolution decoding with full-resolution ones.")
+    parser.add_argument("search_folder", help="Folder with sample images")
+    parser.add_argument("--sample", type=int, default=200, help="Number of images to sample from the folder (0 uses all)")
+    parser.add_argument("--scales", type=decode_scale_type, nargs="+", default=[2, 4, 8], help="Decode scales to measure")
+    parser.add_argument("--num_similar", type=int, default=10, help="Number of top matches compared per query")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--json", help="Also write the report to this JSON file")
+
+    args = parser.parse_args(argv)
+
+    configure_logging()
+
+    from similar_image_search import measure_decode_drift, sample_image_paths
+
+    image_paths = sample_image_paths(args.search_folder, args.sample)
+    reports = measure_decode_drift(image_paths, [scale for scale in args.scales if scale != 1], args.workers, args.num_similar)
+
+    for report in reports:
+        print(", ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}" for key, value in report.items()))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(reports, json_file, indent=2)
+        print(f"Drift report written to '{args.json}'")
+
+# Function to handle the "serve" command, keeping an index in memory for fast repeated searches
+def run_serve_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py serve",
+                                     description="Serve similarity searches over a histogram index from a local HTTP service.")
+    parser.add_argument("--index", required=True, help="Path of the histogram index directory")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    parser.add_argument("--threads", type=int, default=4, help="Number of requests handled at the same time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes decoding images when a reload rescans the folder (0 uses every core)")
+    parser.add_argument("--reload-interval", type=float, default=5.0,
+                        help="Seconds between checks for a newer version of the index on disk (0 disables them)")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep the index up to date by watching its folder for new, modified and deleted images")
+    add_watch_arguments(parser)
+    parser.add_argument("--mmap", action="store_true",
+                        help="Memory-map the index instead of reading it, so large indexes start at once and stay in the page cache")
+
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.index):
+        parser.error(f"index '{args.index}' does not exist, build it with the index command first")
+
+    configure_logging()
+
+    from similar_image_search import serve
+
+    serve(args.index, args.host, args.port, args.threads, args.workers, args.reload_interval, args.watch,
+          args.debounce, args.save_interval, args.poll, args.mmap)
+
+# Function to add the options shared by the "watch" and "serve --watch" commands
+def add_watch_arguments(parser):
+    parser.add_argument("--debounce", type=float, default=1.0,
+                        help="Seconds without new file system events before a burst of changes is applied")
+    parser.add_argument("--save-interval", type=float, default=10.0,
+                        help="Minimum number of seconds between two saves of the index to disk")
+    parser.add_argument("--poll", action="store_true",
+                        help="Poll folder modification times instead of using inotify")
+
+# Function to handle the "watch" command, keeping an index on disk up to date as its folder changes
+def run_watch_command(argv):
+    parser = argparse.ArgumentParser(prog="similar-image-search.py watch",
+                                     description="Keep a histogram index up to date while images are added, changed or deleted.")
+    parser.add_argument("search_folder", nargs="?", help="Folder to watch (defaults to the folder stored in the index)")
+    parser.add_argument("--index", required=True, help="Path of the index directory, created if it does not exist")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of an existing index)")
+    add_watch_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.search_folder is None and not os.path.isdir(args.index):
+        parser.error(f"index '{args.index}' does not exist, give a search folder to create it")
+
+    configure_logging()
+
+    from similar_image_search import watch_folder
+
+    # Catch up with what changed while nothing was watching, then only follow the events
+    index, stats = engine.index(args.search_folder, args.index, args.workers, args.decode_scale)
+    print(f"Watching '{index.root}' for index '{args.index}' with {len(index)} images")
+
+    last_save = datetime.now()
+    unsaved = False
+
+    def on_update(index, stats):
+        nonlocal last_save, unsaved
+        print(f"{datetime.now():%H:%M:%S} {stats['added']} added, {stats['updated']} updated, "
+              f"{stats['removed']} removed, {stats['failed']} unreadable, {len(index)} images")
+
+        unsaved = True
+        if (datetime.now() - last_save).total_seconds() >= args.save_interval:
+            index.save(args.index)
+            last_save = datetime.now()
+            unsaved = False
+
+    try:
+        watch_folder(index, args.workers, args.debounce, on_update=on_update, polling=args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if unsaved:
+            index.save(args.index)
+
+# Function to print the comparisons of a benchmark report with its baseline. Returns True if nothing regressed.
+def print_comparisons(comparisons, tolerance):
+    for comparison in comparisons:
+        flag = "REGRESSION" if comparison['regression'] else "ok"
+        print(f"{comparison['stage']:>10} {comparison['metric']:<15} {comparison['baseline']:>12} -> "
+              f"{comparison['value']:<12} ({comparison['change'] * 100:+.1f}%) {flag}")
+
+    regressions = sum(comparison['regression'] for comparison in comparisons)
+    print(f"{regressions} of {len(comparisons)} metrics regressed by more than {tolerance * 100:.0f}%")
+    return regressions == 0
+
+# Function to time fresh runs of the commands that start without decoding images, against the cold start target.
+# Returns True if every command started within the target.
+def print_cold_start(runs):
+    from similar_image_search.benchmark import COLD_START_TARGET_MS, measure_cold_start
+
+    script = os.path.abspath(__file__)
+    interpreter = measure_cold_start([[sys.executable, "-c", "pass"]], runs)[0]
+    print(f"{'python -c pass':<40} p50 {interpreter['p50_ms']:>8.1f} ms  p99 {interpreter['p99_ms']:>8.1f} ms")
+
+    commands = [[sys.executable, script, "--help"], [sys.executable, script, "index", "--help"],
+                [sys.executable, "-c", "from similar_image_search import engine"]]
+    reports = measure_cold_start(commands, runs, COLD_START_TARGET_MS, cwd=os.path.dirname(script))
+    for report in reports:
+        flag = "ok" if report['within_target'] else "OVER TARGET"
+        print(f"{report['command']:<40} p50 {report['p50_ms']:>8.1f} ms  p99 {report['p99_ms']:>8.1f} ms  {flag}")
+
+    slow = sum(not report['within_target'] for report in reports)
+    print(f"{slow} of {len(reports)} commands took longer than the {COLD_START_TARGET_MS} ms target (median of {runs} runs)")
+    return slow == 0
+
+# Function to handle the "bench run", "bench compare" and "bench startup" commands
+def run_bench_command(argv):
+    from similar_image_search import compare_reports, parse_format_mix, parse_resolutions, run_benchmark
+
+    parser = argparse.ArgumentParser(prog="similar-image-search.py bench",
+                                     description="Benchmark every search stage on a synthetic image corpus.")
+    parser.add_argument("action", choices=["run", "compare", "startup"],
+                        help="Run the benchmark, compare a saved report with a baseline report, or time how long "
+                             "the command line takes to start")
+    parser.add_argument("reports", nargs="*", help="compare: the report and the baseline report (JSON)")
+    parser.add_argument("--images", type=int, default=1000, help="Number of images in the synthetic corpus")
+    parser.add_argument("--formats", type=parse_format_mix, default="jpg=0.7,png=0.3",
+                        help="Image format mix, e.g. jpg=0.7,png=0.2,webp=0.1")
+    parser.add_argument("--resolutions", type=parse_resolutions, default="1024x768",
+                        help="Comma separated image resolutions picked at random, e.g. 1920x1080,512x512")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated corpus and queries")
+    parser.add_argument("--corpus", help="Folder to keep the generated corpus in and reuse (default: a temporary folder)")
+    parser.add_argument("--decode-scale", type=decode_scale_type, default=1, help="Decode images at 1/2, 1/4 or 1/8 resolution")
+    parser.add_argument("--queries", type=int, default=50, help="Number of queries timed by the scoring and ranking stages")
+    parser.add_argument("--score-rows", type=int,
+                        help="Score the queries against this many histograms, repeating the corpus (default: one per image)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes of the extraction stage (0 uses every core)")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    parser.add_argument("--baseline", help="Compare the report with this baseline report (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative change of a metric that counts as a regression (0.1 is 10%%)")
+    parser.add_argument("--runs", type=int, default=20, help="startup: number of fresh runs timed per command")
+
+    args = parser.parse_args(argv)
+
+    if args.action == "compare" and len(args.reports) != 2:
+        parser.error("compare needs a report and a baseline report")
+
+    configure_logging()
+
+    if args.action == "startup":
+        sys.exit(0 if print_cold_start(args.runs) else 1)
+
+    if args.action == "compare":
+        with open(args.reports[0], 'r', encoding='utf-8') as report_file:
+            report = json.load(report_file)
+        with open(args.reports[1], 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        sys.exit(0 if print_comparisons(compare_reports(report, baseline, args.tolerance), args.tolerance) else 1)
+
+    report = run_benchmark(args.images, args.formats, args.resolutions, args.seed, args.corpus, args.decode_scale,
+                           args.queries, args.score_rows, workers=args.workers)
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Benchmark report written to '{args.output}'")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if not print_comparisons(compare_reports(report, baseline, args.tolerance), args.tolerance):
+            sys.exit(1)
+
+# Function to handle a search for the images most similar to one image
+def run_search_command(argv):
     parser = argparse.ArgumentParser(description="Find visually similar images.")
     parser.add_argument("input_image_path", help="Path to the input image")
     parser.add_argument("search_folder", help="Folder to search for similar images")
     parser.add_argument("--threshold", type=float, default=0.005, help="Similarity score threshold (from 0 to 1)")
     parser.add_argument("--num_similar", type=int, default=5, help="Number of similar images to find")
+    parser.add_argument("--index", help="Histogram index directory to reuse and refresh instead of rescanning every image")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--decode-scale", type=decode_scale_type,
+                        help="Decode images at 1/2, 1/4 or 1/8 resolution (default: full resolution, or the scale of the index)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Print the best matches found so far while the folder is being scanned")
+    parser.add_argument("--probes", type=int,
+                        help="Only search this many inverted lists of the index's approximate nearest-neighbour index")
+    parser.add_argument("--hash-radius", type=int,
+                        help="Only rank indexed images whose 64-bit perceptual hash is within this Hamming distance (e.g. 10 for near-duplicates)")
+    parser.add_argument("--rerank", nargs="+", metavar="DESCRIPTOR[=N]",
+                        help="Re-rank the best histogram matches with these descriptors in turn, each on the best N "
+                             "candidates of the one before, e.g. hsv:8x8x8@2x2 edges:16@2x2=100 orb:500=30 "
+                             "(descriptors: hsv, edges, orb)")
+    parser.add_argument("--candidates", type=int, default=DEFAULT_CANDIDATES,
+                        help="Number of histogram matches handed to the re-ranking stages")
+    parser.add_argument("--region", type=region_type,
+                        help=f"Only compare this region of the indexed images, LEFT,TOP,RIGHT,BOTTOM in cells of a "
+                             f"{GRID_SIZE}x{GRID_SIZE} grid, e.g. 2,0,4,2 for the top right quarter (needs an index built with --regions)")
+    parser.add_argument("--input-region", type=region_type,
+                        help="Region of the input image to compare with --region (default: the whole input image)")
+    add_scan_arguments(parser)
+    add_limit_arguments(parser)
+
+    parser.add_argument("--server", nargs="?", const=DEFAULT_URL,
+                        help=f"Search with a running search service (default {DEFAULT_URL}) instead of reading the folder or index; "
+                             f"the results of several comma-separated services, e.g. one per shard, are merged")
+
+    # Taken out of the arguments before they get here, listed for --help
+    parser.add_argument("--metrics",
+                        help="Write the stage timings and failure counts to this file, JSON or Prometheus text for a .prom file (any command)")
+    parser.add_argument("--profile", help="Profile the run with cProfile and write the stats to this file (any command)")
+
+    args = parser.parse_args(argv)
+
+    if args.server and (args.index or args.stream):
+        parser.error("--server searches the index of the service and can't be combined with --index or --stream")
+    if args.stream and args.index:
+        parser.error("--stream scans the folder itself and can't be combined with --index")
+    if args.probes and not (args.index or args.server):
+        parser.error("--probes needs an --index")
+    if args.hash_radius is not None and not (args.index or args.server):
+        parser.error("--hash-radius needs an --index")
+    if args.rerank and args.server:
+        parser.error("--rerank decodes the candidates here and can't be combined with --server")
+    if args.skip_unchanged_dirs and not args.index:
+        parser.error("--skip-unchanged-dirs needs an --index")
+    if args.region and not args.index:
+        parser.error("--region needs an --index built with --regions")
+    if args.region and (args.server or args.stream or args.probes or args.hash_radius is not None or args.rerank):
+        parser.error("--region searches the region grids of the index and can't be combined with --server, --stream, "
+                     "--probes, --hash-radius or --rerank")
+    if args.input_region and not args.region:
+        parser.error("--input-region needs a --region")
+
+    rerank = None
+    if args.rerank:
+        from similar_image_search import parse_cascade
+
+        try:
+            rerank = parse_cascade(args.rerank)
+        except ValueError as e:
+            parser.error(str(e))
+
+    configure_logging()
+
+    if args.server:
+        from similar_image_search.client import SearchServiceError
+
+        try:
+            similar_images = engine.query(args.input_image_path, server_url=args.server, threshold=args.threshold,
+                                          num_similar=args.num_similar, probes=args.probes, hash_radius=args.hash_radius)
+        except SearchServiceError as e:
+            logging.warning(str(e))
+            print(e)
+            return
+    elif args.region:
+        try:
+            similar_images = engine.query(args.input_image_path, args.search_folder, args.index,
+                                          threshold=args.threshold, num_similar=args.num_similar,
+                                          workers=args.workers, decode_scale=args.decode_scale,
+                                          scan_threads=args.scan_threads, readahead=args.readahead,
+                                          skip_unchanged_dirs=args.skip_unchanged_dirs, limits=image_limits(args),
+                                          archives=args.archives or None, region=args.region,
+                                          input_region=args.input_region)
+        except ValueError as e:
+            logging.warning(str(e))
+            print(e)
+            return
+    else:
+        similar_images = engine.query(args.input_image_path, args.search_folder, args.index, threshold=args.threshold,
+                                      num_similar=args.num_similar, workers=args.workers, decode_scale=args.decode_scale,
+                                      probes=args.probes, hash_radius=args.hash_radius, rerank=rerank,
+                                      candidates=args.candidates, scan_threads=args.scan_threads,
+                                      readahead=args.readahead, skip_unchanged_dirs=args.skip_unchanged_dirs,
+                                      on_progress=print_snapshot if args.stream else None,
+                                      on_costs=print_cascade_costs, limits=image_limits(args),
+                                      archives=args.archives or None)
+
+    report_similar_images(args.input_image_path, args.threshold, args.num_similar, similar_images)
+
+COMMANDS = {
+    "index": run_index_command,
+    "batch": run_batch_command,
+    "bench": run_bench_command,
+    "ann": run_ann_command,
+    "dedupe": run_dedupe_command,
+    "drift": run_drift_command,
+    "serve": run_serve_command,
+    "shard": run_shard_command,
+    "watch": run_watch_command,
+}
 
-    args = parser.parse_args()
-
-    # Configure logging to save errors to a file
-    logging.basicConfig(filename='errors_log.txt', level=logging.WARNING,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
-
-    # Redirect standard error to the errors log file
-    sys.stderr = open('errors_log.txt', 'a')
+if __name__ == "__main__":
+    instrumentation, argv = parse_instrumentation_arguments(sys.argv[1:])
 
-    find_similar_images(args.input_image_path, args.search_folder, args.threshold, args.num_similar)
+    with instrumented(instrumentation.metrics, instrumentation.profile):
+        if argv and argv[0] in COMMANDS:
+            COMMANDS[argv[0]](argv[1:])
+        else:
+            run_search_command(argv)
@@ -0,0 +1,76 @@
+# Histogram based visually similar image search
+#
+# The package is imported lazily: importing it, or a light module such as
+# options, client or metrics, does not load OpenCV or NumPy. Every name below
+# is only imported from its module the first time it is used, so a front-end
+# answering --help or talking to a search service starts in a few tens of
+# milliseconds. The stable programmatic API is the engine module:
+#
+#   from similar_image_search import engine
+#   engine.index(folder, index_path)
+#   engine.query(image_path, index_path=index_path)
+
+import importlib
+
+# Public names of the package, by the module that defines them
+_EXPORTS = {
+    'ann': ('IVFIndex', 'evaluate_recall', 'hellinger_embedding', 'load_ivf'),
+    'archives': ('ARCHIVE_EXTENSIONS', 'ARCHIVE_SEPARATOR', 'ArchiveReader', 'is_archive', 'list_archive', 'member_path',
+                 'read_archive_member', 'read_archive_members', 'split_archive_path'),
+    'batch': ('batch_similar_images', 'load_query_paths'),
+    'benchmark': ('COLD_START_TARGET_MS', 'compare_reports', 'generate_corpus', 'measure_cold_start',
+                  'parse_format_mix', 'parse_resolutions', 'run_benchmark', 'synthetic_image'),
+    'cascade': ('CascadeStage', 'format_cascade_costs', 'parse_cascade', 'rerank_candidates'),
+    'client': ('SearchClient', 'SearchServiceError', 'merge_shard_results'),
+    'dedupe': ('cluster_duplicates', 'find_duplicate_pairs', 'find_duplicate_pairs_ivf', 'representative_scores'),
+    'descriptors': ('DESCRIPTORS', 'Descriptor', 'EdgeOrientationHistogram', 'HSVHistogram', 'HistogramDescriptor',
+                    'ORBDescriptor', 'fit_image', 'get_descriptor', 'register_descriptor'),
+    'drift': ('measure_decode_drift', 'sample_image_paths'),
+    'engine': ('format_progress',),
+    'extract': ('ChunkFeatures', 'extract_features', 'extract_histograms', 'iter_feature_chunks',
+                'resolve_workers'),
+    'features': ('HISTOGRAM_SIZE', 'classify_failure', 'compute_buffer_features', 'compute_features',
+                 'compute_histogram', 'compute_region_features_or_error', 'compute_region_grid', 'decode_image',
+                 'decode_image_buffer', 'image_dhash', 'image_histogram', 'image_region_grid', 'iter_image_paths',
+                 'limited_decode_scale'),
+    'index': ('FeatureIndex', 'build_index', 'index_generation', 'path_shard', 'update_index'),
+    'limits': ('DEFAULT_LIMITS', 'ImageLimits', 'ImageTooLarge', 'STRIP_PIXELS', 'budget_bytes', 'decode_bytes',
+               'fit_decode_scale', 'probe_image_size'),
+    'metrics': ('FAILURE_DECODE_ERROR', 'FAILURE_TOO_LARGE', 'FAILURE_UNREADABLE', 'FAILURE_UNSUPPORTED_FORMAT',
+                'METRICS', 'Metrics', 'failure_summary', 'format_time_breakdown', 'instrumented', 'profiled'),
+    'options': ('DECODE_SCALES', 'DEFAULT_CANDIDATES', 'DEFAULT_HOST', 'DEFAULT_MAX_PIXELS', 'DEFAULT_MEMORY_BUDGET',
+                'DEFAULT_PORT', 'DEFAULT_SCAN_THREADS', 'DEFAULT_URL', 'GRID_SIZE', 'PRECISION_NAMES', 'parse_byte_size',
+                'parse_decode_scale', 'parse_region'),
+    'phash': ('HashIndex', 'hamming_distances'),
+    'query': ('search_index',),
+    'regions': ('FULL_REGION', 'GRID_CELLS', 'REGION_BINS', 'REGION_HISTOGRAM_SIZE', 'cell_edges', 'region_histograms',
+                'search_regions'),
+    'scanner': ('DirectoryScanner', 'IMAGE_EXTENSIONS', 'ScanEntry', 'group_by_archive', 'group_by_directory',
+                'iter_file_buffers'),
+    'scoring': ('calculate_similarity_score', 'chi_squared_distance_matrix', 'chi_squared_distances',
+                'paired_chi_squared_distances', 'similarity_scores', 'top_k'),
+    'service': ('IndexSnapshot', 'PooledHTTPServer', 'SearchService', 'serve'),
+    'shards': ('ShardedIndex', 'is_sharded_index', 'search_shards'),
+    'store': ('PRECISIONS', 'PathTable', 'QuantizedHistograms', 'encode_histograms', 'evaluate_precisions',
+              'load_path_table', 'parse_precision', 'save_path_table'),
+    'stream': ('SearchSnapshot', 'TopK', 'iter_similar_images', 'stream_similar_images'),
+    'thumbnails': ('DEFAULT_THUMBNAIL_SIZE', 'LRUCache', 'ThumbnailStore', 'default_thumbnail_folder'),
+    'watch': ('InotifyWatcher', 'PollingWatcher', 'open_watcher', 'watch_folder'),
+}
+
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = sorted(_MODULES)
+
+# Function to import a public name from its module on first use (PEP 562)
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_MODULES))
@@ -0,0 +1,174 @@
+# Approximate nearest-neighbour search over the histogram index
+#
+# Histograms are mapped to a Hellinger embedding, sqrt(h / sum(h)), in which
+# the Euclidean distance tracks the chi-squared distance closely. A k-means
+# coarse quantizer splits the embeddings into inverted lists (IVF). A query
+# only looks at the n_probe lists whose centroids are closest to it, and the
+# candidates found there are ranked with the exact chi-squared score, so the
+# scores are the same as a brute-force search and only recall is traded for
+# speed.
+#
+# The IVF is stored as ivf.npz inside the index directory, together with the
+# index generation it was built for. After the index changed, the rows are
+# re-assigned to the existing centroids instead of running k-means again.
+
+import logging
+import os
+import time
+
+import numpy as np
+
+from .scoring import similarity_scores, top_k
+
+IVF_FILE = 'ivf.npz'
+
+# Rows assigned to centroids at once, bounds the (rows, lists) distance block
+ASSIGN_BLOCK_ROWS = 16384
+
+# Function to map histograms to the Hellinger embedding used by the coarse quantizer
+def hellinger_embedding(histograms):
+    histograms = np.maximum(np.asarray(histograms, dtype=np.float32), 0.0)
+    if histograms.ndim == 1:
+        histograms = histograms[None, :]
+
+    totals = histograms.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.0
+    return np.sqrt(histograms / totals)
+
+# Function to compute the squared Euclidean distances between embeddings and centroids
+def _squared_distances(embeddings, centroids):
+    distances = (embeddings * embeddings).sum(axis=1)[:, None]
+    distances = distances - 2.0 * (embeddings @ centroids.T)
+    distances += (centroids * centroids).sum(axis=1)[None, :]
+    return distances
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, list_rows, generation=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.generation = generation
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    # Function to train the coarse quantizer on a sample of the histograms and fill the lists.
+    # Plain Lloyd k-means is used as mini-batch k-means tends to leave a few huge lists.
+    # Raises ValueError if there are no histograms to train on.
+    @classmethod
+    def build(cls, histograms, n_lists=None, points_per_list=40, seed=0, generation=None):
+        from sklearn.cluster import KMeans
+
+        if not len(histograms):
+            raise ValueError("No histograms to train the inverted lists on")
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(histograms)))
+        n_lists = max(1, min(n_lists, len(histograms)))
+
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(histograms), points_per_list * n_lists)
+        sample = np.sort(rng.choice(len(histograms), sample_size, replace=False))
+
+        kmeans = KMeans(n_clusters=n_lists, n_init=1, max_iter=20, random_state=seed)
+        kmeans.fit(hellinger_embedding(histograms[sample]))
+
+        index = cls(kmeans.cluster_centers_.astype(np.float32), None, None, generation)
+        index.assign(histograms, generation)
+        return index
+
+    # Function to (re)fill the inverted lists from the histograms, keeping the centroids
+    def assign(self, histograms, generation=None):
+        assignments = np.empty(len(histograms), dtype=np.int64)
+        for start in range(0, len(histograms), ASSIGN_BLOCK_ROWS):
+            embeddings = hellinger_embedding(histograms[start:start + ASSIGN_BLOCK_ROWS])
+            assignments[start:start + len(embeddings)] = _squared_distances(embeddings, self.centroids).argmin(axis=1)
+
+        # Rows sorted by list, keeping the index order inside every list
+        self.list_rows = np.argsort(assignments, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+        self.generation = generation
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            generation = int(data['generation']) if data['generation'] >= 0 else None
+            return cls(data['centroids'], data['list_offsets'], data['list_rows'], generation)
+
+    def save(self, path):
+        generation = -1 if self.generation is None else self.generation
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_rows=self.list_rows, generation=np.int64(generation))
+        os.replace(tmp_path, path)
+
+    # Function to find the index rows stored in the n_probe lists closest to the query
+    def candidates(self, query_hist, n_probe=8):
+        distances = _squared_distances(hellinger_embedding(query_hist), self.centroids)[0]
+
+        # Empty lists (e.g. duplicate centroids when there are few distinct images) don't use up a probe
+        distances[self.list_offsets[1:] == self.list_offsets[:-1]] = np.inf
+        n_probe = max(1, min(n_probe, self.n_lists))
+        probed = np.argpartition(distances, n_probe - 1)[:n_probe]
+
+        rows = [self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed]
+        return np.sort(np.concatenate(rows))
+
+    # Function to find the best matches of a query among the probed candidates.
+    # Returns (row, score) pairs, best first, with exact chi-squared based scores.
+    def search(self, query_hist, histograms, threshold=0.005, num_similar=5, n_probe=8):
+        rows = self.candidates(query_hist, n_probe)
+        scores = similarity_scores(query_hist, histograms[rows])
+        return [(int(rows[i]), float(scores[i])) for i in top_k(scores, num_similar, threshold)]
+
+# Function to load the IVF of a feature index, building it if it is missing and re-assigning
+# its lists if the index changed since it was saved
+def load_ivf(index, index_path, n_lists=None, rebuild=False):
+    ivf_path = os.path.join(index_path, IVF_FILE)
+
+    if rebuild or not os.path.exists(ivf_path):
+        ivf = IVFIndex.build(index.histograms, n_lists, generation=index.generation)
+        ivf.save(ivf_path)
+        return ivf
+
+    ivf = IVFIndex.load(ivf_path)
+    if ivf.generation != index.generation:
+        logging.info(f"Index '{index_path}' changed since its IVF was built, re-assigning the lists")
+        ivf.assign(index.histograms, index.generation)
+        ivf.save(ivf_path)
+
+    return ivf
+
+# Function to measure how many of the exact top matches the IVF finds for every n_probe value,
+# using a sample of the indexed images as queries. Every query is left out of its own matches,
+# which the IVF always finds in its own list.
+def evaluate_recall(ivf, histograms, probes=(1, 2, 4, 8, 16, 32), num_queries=100, num_similar=10, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(histograms), min(num_queries, len(histograms)), replace=False)
+
+    def best_others(rows, q):
+        return set([row for row in rows if row != q][:num_similar])
+
+    start = time.perf_counter()
+    expected = [best_others(top_k(similarity_scores(histograms[q], histograms), num_similar + 1).tolist(), q)
+                for q in queries]
+    exact_seconds = (time.perf_counter() - start) / max(1, len(queries))
+
+    reports = []
+    for n_probe in probes:
+        start = time.perf_counter()
+        found = [best_others([row for row, score in ivf.search(histograms[q], histograms, None, num_similar + 1,
+                                                                n_probe)], q)
+                 for q in queries]
+        seconds = (time.perf_counter() - start) / max(1, len(queries))
+
+        recall = np.mean([len(e & f) / max(1, len(e)) for e, f in zip(expected, found)])
+        reports.append({
+            'n_probe': n_probe,
+            f'recall@{num_similar}': float(recall),
+            'ms_per_query': round(seconds * 1000, 3),
+            'exact_ms_per_query': round(exact_seconds * 1000, 3),
+            'speedup': round(exact_seconds / seconds, 2) if seconds > 0 else None,
+        })
+
+    return reports
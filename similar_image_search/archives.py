@@ -0,0 +1,169 @@
+# Images inside zip and tar archives
+#
+# With archives enabled, the scanner lists the members of every zip or tar
+# archive it finds next to the image files of a folder, under a virtual path
+# made of the archive path, '!/' and the member name:
+#
+#   D:\renders\batch-01.zip!/day1/0001.png
+#
+# Nothing is extracted to disk. The size and modification time of a member
+# come from the zip directory or the tar header, so an index only decodes the
+# members that are new or changed, and an archive whose own size and mtime did
+# not change is not even listed again. The decoders get the bytes of members
+# from read_archive_members, which keeps one archive open at a time and reads
+# its members in the order they are asked for, so a compressed tar is
+# decompressed in one sequential pass instead of once per member. Listing a
+# compressed tar still takes a full pass, a zip is listed from its directory.
+#
+# A few kB of zip can expand to gigabytes, so the uncompressed size of a
+# member is checked against the memory budget of the decode limits (512 MB
+# unless one was given, see limits.py) before anything is read, and larger
+# members are never read.
+
+import calendar
+import logging
+import tarfile
+import time
+import zipfile
+import zlib
+
+from .limits import ImageTooLarge
+from .metrics import METRICS
+
+# File extensions of the archives searched for images
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# Separates the archive path from the member name in the virtual path of a member
+ARCHIVE_SEPARATOR = '!/'
+
+# Errors raised by broken or truncated archives
+ARCHIVE_ERRORS = (OSError, EOFError, zlib.error, zipfile.BadZipFile, tarfile.TarError)
+
+# Function to tell whether a file is an archive, by its extension
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+# Function to build the virtual path of an archive member
+def member_path(archive_path, name):
+    return f"{archive_path}{ARCHIVE_SEPARATOR}{name}"
+
+# Function to split a virtual path into the archive path and the member name.
+# Returns (path, None) for paths that are not inside an archive.
+def split_archive_path(path):
+    archive_path, separator, name = path.partition(ARCHIVE_SEPARATOR)
+    if not separator or not is_archive(archive_path):
+        return path, None
+    return archive_path, name
+
+# Function to list the regular files in an archive as (name, size, mtime_ns), in the order they are
+# stored. Raises one of ARCHIVE_ERRORS if the archive can't be read.
+def list_archive(archive_path):
+    if archive_path.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+            # Zip dates have no time zone, they are taken as UTC so the same archive always gives the same mtimes
+            return [(info.filename, info.file_size, calendar.timegm(info.date_time + (0, 0, 0)) * 1_000_000_000)
+                    for info in infos if not info.is_dir()]
+
+    with tarfile.open(archive_path) as archive:
+        return [(info.name, info.size, int(info.mtime) * 1_000_000_000) for info in archive if info.isfile()]
+
+class ArchiveReader:
+    # Reads members of one archive. Zip members are read straight from their offset, tar members
+    # from a stream that only goes forward, so they should be asked for in the order they are stored.
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.zip = None
+        self.tar = None
+        if archive_path.lower().endswith('.zip'):
+            self.zip = zipfile.ZipFile(archive_path)
+        else:
+            self.tar = tarfile.open(archive_path, 'r|*')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        if self.tar is not None:
+            self.tar.close()
+
+    # Function to read the bytes of a member. Returns None if there is no such file in the archive,
+    # and raises ImageTooLarge if it would take more than max_size bytes once read.
+    def read(self, name, max_size=None):
+        if self.zip is not None:
+            try:
+                info = self.zip.getinfo(name)
+            except KeyError:
+                return None
+            _check_member_size(info.file_size, max_size)
+            return self.zip.read(info)
+
+        # Skip forward to the member, and start over once if it was stored before the current one
+        for restarted in (False, True):
+            while True:
+                info = self.tar.next()
+                if info is None:
+                    break
+                if info.name == name and info.isfile():
+                    _check_member_size(info.size, max_size)
+                    return self.tar.extractfile(info).read()
+            if restarted:
+                return None
+            self.tar.close()
+            self.tar = tarfile.open(self.archive_path, 'r|*')
+
+# Function to raise ImageTooLarge for a member of the given uncompressed size over max_size (None for no limit)
+def _check_member_size(size, max_size):
+    if max_size is not None and size > max_size:
+        raise ImageTooLarge(f"{size >> 20} MB uncompressed, more than the memory budget of {max_size >> 20} MB")
+
+# Function to read one archive member by its virtual path. Returns None if it can't be read, and
+# raises ImageTooLarge if it is larger than max_size bytes.
+def read_archive_member(path, max_size=None):
+    archive_path, name = split_archive_path(path)
+    try:
+        with ArchiveReader(archive_path) as reader:
+            return reader.read(name, max_size)
+    except ARCHIVE_ERRORS as e:
+        logging.warning(f"Unable to read '{name}' from archive '{archive_path}': {e}")
+        return None
+
+# Function to fill in the bytes of the archive members in a stream of (path, bytes or None) pairs,
+# keeping one archive open until the stream moves on to the next one. Other pairs are passed
+# through as they are; the bytes are None for members that can't be read or are larger than
+# max_size bytes, which the decoders then report.
+def read_archive_members(items, metrics=METRICS, max_size=None):
+    reader = None
+    try:
+        for path, data in items:
+            archive_path, name = split_archive_path(path)
+            if name is None:
+                yield path, data
+                continue
+
+            start = time.perf_counter()
+            try:
+                if reader is None or reader.archive_path != archive_path:
+                    if reader is not None:
+                        reader.close()
+                    reader = None
+                    reader = ArchiveReader(archive_path)
+                data = reader.read(name, max_size)
+            except ARCHIVE_ERRORS as e:
+                logging.warning(f"Unable to read '{name}' from archive '{archive_path}': {e}")
+                data = None
+            except ImageTooLarge:
+                data = None
+            metrics.add_time('read', time.perf_counter() - start)
+            if data is not None:
+                metrics.count('bytes_read', len(data))
+
+            yield path, data
+    finally:
+        if reader is not None:
+            reader.close()
@@ -0,0 +1,47 @@
+# Batch queries: many reference images against one corpus in a single pass
+#
+# The corpus histograms are extracted (or loaded from an index) once, and all
+# queries are scored against them as (query block x corpus block) chi-squared
+# matrices. Each query keeps its own bounded top-k heap, so memory depends on
+# the block sizes and num_similar rather than on Q x N.
+
+import os
+
+import numpy as np
+
+from .features import iter_image_paths
+from .scoring import chi_squared_distance_matrix
+from .stream import TopK
+
+# Queries and corpus rows scored together; a block of scores is QUERY_BLOCK x CORPUS_BLOCK float64
+QUERY_BLOCK = 256
+CORPUS_BLOCK = 4096
+
+# Function to read the query images from a folder, or from a text file with one path per line
+def load_query_paths(queries):
+    if os.path.isdir(queries):
+        return list(iter_image_paths(queries))
+
+    with open(queries, 'r', encoding='utf-8') as query_file:
+        return [line.strip() for line in query_file if line.strip() and not line.startswith('#')]
+
+# Function to find the best matches of every query histogram among the rows of a histogram matrix.
+# Returns one list of (row index, score) pairs per query, best first.
+def batch_similar_images(query_histograms, histograms, threshold=0.005, num_similar=5,
+                         query_block=QUERY_BLOCK, corpus_block=CORPUS_BLOCK):
+    query_histograms = np.asarray(query_histograms, dtype=np.float32)
+    tops = [TopK(num_similar, threshold) for _ in range(len(query_histograms))]
+
+    for corpus_start in range(0, len(histograms), corpus_block):
+        block = np.asarray(histograms[corpus_start:corpus_start + corpus_block], dtype=np.float32)
+        rows = np.arange(corpus_start, corpus_start + len(block))
+
+        for query_start in range(0, len(query_histograms), query_block):
+            queries = query_histograms[query_start:query_start + query_block]
+            scores = 1.0 / (1.0 + chi_squared_distance_matrix(queries, block))
+
+            # Only hand the rows that can change a result to the per-query heaps
+            for q in np.flatnonzero(scores.max(axis=1) >= threshold):
+                tops[query_start + q].push_batch(rows, scores[q])
+
+    return [top.results() for top in tops]
@@ -0,0 +1,279 @@
+# Reproducible performance benchmark on synthetic image corpora
+#
+# A corpus of random gradients and rectangles is generated from a seed with a
+# configurable number of images, format mix and resolutions, so two runs on
+# the same machine measure the same work. Every stage of a search is timed on
+# its own: walking the folder, decoding, the strip-wise HSV histogram and the
+# region grid the index computes, scoring a query against all histograms and
+# ranking the scores. Per-image (or
+# per-query) latencies give p50/p99 values next to the throughput, and the
+# report is plain JSON so it can be saved as a baseline and compared later.
+#
+# The command line is also run from scripts thousands of times a day, so its
+# cold start is measured too: fresh interpreters running the commands that
+# don't decode images, compared against COLD_START_TARGET_MS.
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from .extract import extract_features
+from .features import decode_image, image_histogram, image_region_grid, iter_image_paths
+from .scoring import similarity_scores, top_k
+
+CORPUS_MANIFEST = 'corpus.json'
+
+# Median wall-clock time a fresh run of "--help", "index --help" or an import of the engine may take,
+# interpreter startup included (about 20 ms of it)
+COLD_START_TARGET_MS = 120
+
+# Metrics compared against a baseline, and whether a larger value is better
+COMPARED_METRICS = {
+    'images_per_sec': True,
+    'queries_per_sec': True,
+    'p50_ms': False,
+    'p99_ms': False,
+}
+
+# Function to parse a format mix such as "jpg=0.7,png=0.3" into normalized weights
+def parse_format_mix(value):
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip().lower().lstrip('.')
+        if name not in ('jpg', 'jpeg', 'png', 'bmp', 'webp'):
+            raise ValueError(f"Unsupported image format '{name}'")
+        weights[name] = float(weight) if weight else 1.0
+
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError(f"Format mix '{value}' has no positive weight")
+    return {name: weight / total for name, weight in weights.items()}
+
+# Function to parse resolutions such as "1920x1080,512x512" into (width, height) pairs
+def parse_resolutions(value):
+    resolutions = []
+    for part in value.split(','):
+        width, _, height = part.lower().partition('x')
+        resolutions.append((int(width), int(height)))
+    return resolutions
+
+# Function to draw one synthetic image: a random color gradient with a few filled rectangles
+def synthetic_image(rng, width, height):
+    corners = rng.integers(0, 256, size=(2, 2, 3)).astype(np.float32)
+    gradient = cv2.resize(corners, (width, height), interpolation=cv2.INTER_LINEAR)
+    image = gradient.astype(np.uint8)
+
+    for _ in range(rng.integers(2, 8)):
+        x0, x1 = np.sort(rng.integers(0, width, 2))
+        y0, y1 = np.sort(rng.integers(0, height, 2))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(image, (int(x0), int(y0)), (int(x1), int(y1)), color, thickness=-1)
+
+    return image
+
+# Function to write a synthetic corpus into a folder, reusing it if it was generated with
+# the same settings before. Returns the paths of the images.
+def generate_corpus(folder, num_images=1000, formats=None, resolutions=((1024, 768),), seed=0, folder_size=500):
+    formats = formats or {'jpg': 1.0}
+    config = {'num_images': num_images, 'formats': formats, 'resolutions': [list(r) for r in resolutions],
+              'seed': seed, 'folder_size': folder_size}
+
+    manifest_path = os.path.join(folder, CORPUS_MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['config'] == config:
+            return manifest['paths']
+        shutil.rmtree(folder)
+    elif os.path.isdir(folder) and os.listdir(folder):
+        raise ValueError(f"'{folder}' is not empty and holds no generated corpus, use another folder")
+
+    rng = np.random.default_rng(seed)
+    names = list(formats)
+    choices = rng.choice(len(names), size=num_images, p=[formats[name] for name in names])
+
+    paths = []
+    for i in range(num_images):
+        # Spread the images over subfolders, as real output folders are
+        subfolder = os.path.join(folder, f"{i // folder_size:04d}")
+        os.makedirs(subfolder, exist_ok=True)
+
+        width, height = resolutions[rng.integers(len(resolutions))]
+        path = os.path.join(subfolder, f"{i:06d}.{names[choices[i]]}")
+        cv2.imwrite(path, synthetic_image(rng, width, height))
+        paths.append(path)
+
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump({'config': config, 'paths': paths}, manifest_file)
+
+    return paths
+
+# Function to summarize per-item latencies in seconds
+def latency_stats(seconds, unit='images'):
+    seconds = np.asarray(seconds, dtype=np.float64)
+    total = float(seconds.sum())
+    return {
+        'count': len(seconds),
+        'total_seconds': round(total, 4),
+        f'{unit}_per_sec': round(len(seconds) / total, 2) if total > 0 else None,
+        'p50_ms': round(float(np.percentile(seconds, 50)) * 1000, 4) if len(seconds) else None,
+        'p99_ms': round(float(np.percentile(seconds, 99)) * 1000, 4) if len(seconds) else None,
+    }
+
+# Function to time fresh runs of each command (a list of arguments), runs times each. Returns the latency
+# stats of every command, and whether its median is within target_ms if a target is given.
+def measure_cold_start(commands, runs=20, target_ms=None, cwd=None):
+    reports = []
+    for command in commands:
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=cwd, check=True)
+            seconds.append(time.perf_counter() - start)
+
+        report = {'command': ' '.join(os.path.basename(part) for part in command[1:]), **latency_stats(seconds, 'runs')}
+        if target_ms is not None:
+            report['within_target'] = report['p50_ms'] <= target_ms
+        reports.append(report)
+
+    return reports
+
+# Function to read the peak resident set size of this process in MB, if the platform reports it
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+# Function to time every stage of a search over the images of a folder
+def benchmark_stages(folder, decode_scale=1, num_queries=50, score_rows=None, num_similar=5, workers=1, seed=0):
+    stages = {}
+
+    start = time.perf_counter()
+    image_paths = list(iter_image_paths(folder))
+    walk_seconds = time.perf_counter() - start
+    stages['walk'] = {'count': len(image_paths), 'total_seconds': round(walk_seconds, 4),
+                      'images_per_sec': round(len(image_paths) / walk_seconds, 2) if walk_seconds > 0 else None}
+
+    decode_times, hist_times, grid_times = [], [], []
+    histograms = []
+    for image_path in image_paths:
+        start = time.perf_counter()
+        image = decode_image(image_path, decode_scale)
+        decoded = time.perf_counter()
+        if image is None:
+            continue
+
+        # The same helpers the index uses, HSV conversion and calcHist strip by strip
+        hist = image_histogram(image)
+        counted = time.perf_counter()
+
+        image_region_grid(image)
+        done = time.perf_counter()
+
+        decode_times.append(decoded - start)
+        hist_times.append(counted - decoded)
+        grid_times.append(done - counted)
+        histograms.append(hist)
+
+    stages['decode'] = latency_stats(decode_times)
+    stages['histogram'] = latency_stats(hist_times)
+    stages['region_grid'] = latency_stats(grid_times)
+
+    # The same extraction through the (parallel) pipeline the search uses
+    start = time.perf_counter()
+    extract_features(image_paths, workers, decode_scale=decode_scale)
+    extract_seconds = time.perf_counter() - start
+    stages['extract'] = {'count': len(image_paths), 'workers': workers, 'total_seconds': round(extract_seconds, 4),
+                         'images_per_sec': round(len(image_paths) / extract_seconds, 2) if extract_seconds > 0 else None}
+
+    if not histograms:
+        return stages
+
+    # Scoring works on more rows than there are images if asked to, by repeating them with a little noise
+    rng = np.random.default_rng(seed)
+    histograms = np.vstack(histograms).astype(np.float32)
+    if score_rows and score_rows > len(histograms):
+        repeats = np.resize(np.arange(len(histograms)), score_rows)
+        noise = rng.random((score_rows, histograms.shape[1]), dtype=np.float32) * 1e-3
+        histograms = histograms[repeats] + noise
+
+    queries = histograms[rng.choice(len(histograms), num_queries)]
+    score_times, rank_times = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = similarity_scores(query, histograms)
+        scored = time.perf_counter()
+        top_k(scores, num_similar)
+        ranked = time.perf_counter()
+
+        score_times.append(scored - start)
+        rank_times.append(ranked - scored)
+
+    stages['scoring'] = dict(latency_stats(score_times, 'queries'), rows=len(histograms))
+    stages['ranking'] = dict(latency_stats(rank_times, 'queries'), rows=len(histograms))
+
+    return stages
+
+# Function to generate a corpus (or reuse the one in corpus_folder) and benchmark it.
+# Returns the JSON-ready report.
+def run_benchmark(num_images=1000, formats=None, resolutions=((1024, 768),), seed=0, corpus_folder=None,
+                  decode_scale=1, num_queries=50, score_rows=None, num_similar=5, workers=1):
+    temporary = corpus_folder is None
+    if temporary:
+        corpus_folder = tempfile.mkdtemp(prefix='similar-image-search-bench-')
+
+    try:
+        start = time.perf_counter()
+        generate_corpus(corpus_folder, num_images, formats, resolutions, seed)
+        generate_seconds = time.perf_counter() - start
+
+        stages = benchmark_stages(corpus_folder, decode_scale, num_queries, score_rows, num_similar, workers, seed)
+    finally:
+        if temporary:
+            shutil.rmtree(corpus_folder, ignore_errors=True)
+
+    return {
+        'config': {'num_images': num_images, 'formats': formats or {'jpg': 1.0},
+                   'resolutions': [f"{width}x{height}" for width, height in resolutions], 'seed': seed,
+                   'decode_scale': decode_scale, 'num_queries': num_queries, 'score_rows': score_rows,
+                   'num_similar': num_similar, 'workers': workers},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'opencv': cv2.__version__},
+        'corpus_seconds': round(generate_seconds, 2),
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+# Function to compare a report with a baseline report. Returns one dict per compared metric,
+# flagged as a regression when it got worse by more than the tolerance (0.1 is 10%).
+def compare_reports(report, baseline, tolerance=0.1):
+    comparisons = []
+    for stage, metrics in report['stages'].items():
+        base_metrics = baseline.get('stages', {}).get(stage)
+        if base_metrics is None:
+            continue
+
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, base_value = metrics.get(metric), base_metrics.get(metric)
+            if not value or not base_value:
+                continue
+
+            change = value / base_value - 1.0
+            regression = change < -tolerance if higher_is_better else change > tolerance
+            comparisons.append({'stage': stage, 'metric': metric, 'baseline': base_value, 'value': value,
+                                'change': round(change, 4), 'regression': regression})
+
+    return comparisons
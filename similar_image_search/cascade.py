@@ -0,0 +1,108 @@
+# Cascade re-ranking with more expensive descriptors
+#
+# The [8, 8, 8] HSV histogram is cheap enough to score against every image of
+# a folder or index, but it only knows about colors. A cascade keeps it as the
+# first stage and hands its best few hundred candidates to one or more slower
+# descriptors (spatial-grid histograms, edge orientations, ORB keypoints), each
+# of which decodes and re-ranks only the top candidates of the stage before.
+# The final order is the one of the last stage. Every stage reports how many
+# candidates it handled and how long it took, so the cost of a descriptor can
+# be weighed against what it changes.
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .descriptors import fit_image, get_descriptor
+from .features import decode_image
+from .limits import DEFAULT_LIMITS, ImageTooLarge
+from .metrics import METRICS
+
+class CascadeStage:
+    # One re-ranking stage: the descriptor, and how many of the best candidates of the previous
+    # stage it re-ranks (None for all of them)
+    def __init__(self, descriptor, candidates=None):
+        self.descriptor = descriptor
+        self.candidates = candidates
+
+    def __repr__(self):
+        return f"{self.descriptor.name}={self.candidates}" if self.candidates else self.descriptor.name
+
+# Function to parse re-ranking stages such as ["hsv:8x8x8@2x2=200", "orb=50"] (descriptor spec,
+# then optionally "=" and the number of candidates it re-ranks)
+def parse_cascade(specs):
+    stages = []
+    for spec in specs:
+        spec, _, candidates = spec.partition('=')
+        stages.append(CascadeStage(get_descriptor(spec), int(candidates) if candidates else None))
+    return stages
+
+# Function to decode an image and compute the features of every given descriptor on it, each on
+# the image shrunk to the descriptor's size. Returns None if the image can't be decoded within the limits.
+def _image_features(image_path, descriptors, decode_scale, metrics, limits=DEFAULT_LIMITS):
+    with metrics.timer('rerank_decode'):
+        try:
+            image = decode_image(image_path, decode_scale, limits)
+        except ImageTooLarge:
+            return None
+    if image is None:
+        return None
+    return [descriptor.compute(fit_image(image, descriptor.image_size)) for descriptor in descriptors]
+
+# Function to re-rank (path, score) candidates, best first, through the stages of a cascade.
+# Candidates are decoded again by each stage, in threads (OpenCV releases the GIL while
+# decoding), at the decode scale of the first stage and within its limits. Returns the best
+# num_similar (path, score) pairs of the last stage and the cost of every stage.
+def rerank_candidates(input_image_path, candidates, stages, num_similar=5, decode_scale=1, threads=4,
+                      metrics=METRICS, limits=DEFAULT_LIMITS):
+    query_features = _image_features(input_image_path, [stage.descriptor for stage in stages], decode_scale, metrics,
+                                     limits)
+    if query_features is None:
+        raise ValueError(f"Unable to read image '{input_image_path}'")
+
+    costs = []
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='rerank') as executor:
+        for stage, query in zip(stages, query_features):
+            # The last stage never needs fewer candidates than the results it has to return
+            count = stage.candidates or len(candidates)
+            candidates = candidates[:max(count, num_similar)]
+            descriptor = stage.descriptor
+
+            start = time.perf_counter()
+            features = list(executor.map(lambda path: _image_features(path, [descriptor], decode_scale, metrics,
+                                                                      limits),
+                                         [path for path, score in candidates]))
+
+            decoded = [(candidate, feature[0]) for candidate, feature in zip(candidates, features)
+                       if feature is not None]
+            for (path, score), feature in zip(candidates, features):
+                if feature is None:
+                    logging.warning(f"Unable to read image '{path}' for re-ranking, dropped")
+            computed = time.perf_counter()
+
+            scores = descriptor.similarities(query, [feature for candidate, feature in decoded])
+            # A stable sort keeps the previous order between equal scores
+            order = np.argsort(-scores, kind='stable')
+            candidates = [(decoded[i][0][0], float(scores[i])) for i in order]
+            done = time.perf_counter()
+
+            metrics.add_time(f"rerank_{descriptor.name}", done - start, len(features))
+            costs.append({'stage': descriptor.name, 'candidates': len(features),
+                          'failed': len(features) - len(decoded), 'seconds': round(done - start, 4),
+                          'features_seconds': round(computed - start, 4),
+                          'score_seconds': round(done - computed, 4),
+                          'ms_per_candidate': round((done - start) * 1000 / len(features), 3) if features else None})
+
+    return candidates[:num_similar], costs
+
+# Function to describe the cost of every stage of a cascade, one line per stage
+def format_cascade_costs(costs):
+    lines = []
+    for cost in costs:
+        per_candidate = f", {cost['ms_per_candidate']} ms per candidate" if cost.get('ms_per_candidate') else ""
+        failed = f", {cost['failed']} unreadable" if cost.get('failed') else ""
+        lines.append(f"  {cost['stage']}: {cost['candidates']} candidates in {cost['seconds']:.3f} s"
+                     f"{per_candidate}{failed}")
+    return '\n'.join(lines)
@@ -0,0 +1,72 @@
+# Thin client for the search service
+#
+# Only uses the standard library, so front-ends can talk to a running service
+# without loading the index themselves.
+
+import json
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from .options import DEFAULT_URL
+
+class SearchServiceError(Exception):
+    pass
+
+# Function to merge the best (path, score) matches of every shard or service into the global best
+# num_similar, best first. Ties keep the order of the shards.
+def merge_shard_results(results, num_similar=5):
+    matches = [match for shard_matches in results for match in shard_matches]
+    return sorted(matches, key=lambda match: -match[1])[:num_similar]
+
+class SearchClient:
+    def __init__(self, url=DEFAULT_URL, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, endpoint, data=None, content_type='application/json'):
+        request = Request(self.url + endpoint, data=data, method='GET' if data is None else 'POST')
+        if data is not None:
+            request.add_header('Content-Type', content_type)
+
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise SearchServiceError(f"Search service at {self.url} answered {e.code}: {message}")
+        except URLError as e:
+            raise SearchServiceError(f"Unable to reach the search service at {self.url}: {e.reason}")
+
+    def health(self):
+        return self._request('/health')
+
+    # Function to fetch the metrics summary of the service: stage timers, counters and failures
+    def metrics(self):
+        return self._request('/metrics?format=json')
+
+    # Function to ask the service to reload its index, rescanning the folder first if refresh is set
+    def reload(self, refresh=False):
+        return self._request('/reload', json.dumps({'refresh': refresh}).encode('utf-8'))
+
+    # Function to search by the path of an image the service can read, or by uploading the image
+    # bytes if upload is set. Returns (path, score) pairs, best first.
+    def search(self, image_path, threshold=0.005, num_similar=5, probes=None, hash_radius=None, upload=False):
+        options = {'threshold': threshold, 'num_similar': num_similar}
+        if probes:
+            options['probes'] = probes
+        if hash_radius is not None:
+            options['hash_radius'] = hash_radius
+
+        if upload:
+            with open(image_path, 'rb') as image_file:
+                data = image_file.read()
+            response = self._request('/search?' + urlencode(options), data, 'application/octet-stream')
+        else:
+            options['path'] = image_path
+            response = self._request('/search', json.dumps(options).encode('utf-8'))
+
+        return [(match['path'], match['score']) for match in response['results']]
@@ -0,0 +1,117 @@
+# Whole-library near-duplicate detection and clustering
+#
+# Every histogram is computed once. Pairs of images whose similarity is at or
+# above the threshold in both directions (chi-squared is not symmetric, so the
+# lower of the two scores counts) are found either by blocked, vectorized
+# all-pairs scoring or, for very large libraries, by only comparing every
+# image with the candidates from its closest IVF lists. Matching pairs are
+# grouped into connected components, and every cluster gets a representative.
+
+import numpy as np
+
+from .scoring import chi_squared_distance_matrix, paired_chi_squared_distances, similarity_scores
+
+# Images per block of the all-pairs scoring; every block pair needs a few
+# DEDUPE_BLOCK x DEDUPE_BLOCK float32 matrices
+DEDUPE_BLOCK = 2048
+
+# Relative slack of the float32 screening pass, candidates are then checked in float64
+SCREEN_TOLERANCE = 1e-3
+
+# Candidate pairs checked at a time; every pair gathers both of its histograms in float64
+VERIFY_BLOCK = 16384
+
+# Function to keep the candidate pairs whose exact symmetric similarity meets the threshold
+def _verify_pairs(histograms, first, second, threshold):
+    firsts, seconds, all_scores = [first[:0]], [second[:0]], [np.empty(0, dtype=np.float64)]
+    for start in range(0, len(first), VERIFY_BLOCK):
+        i, j = first[start:start + VERIFY_BLOCK], second[start:start + VERIFY_BLOCK]
+        distances = np.maximum(paired_chi_squared_distances(histograms[i], histograms[j]),
+                               paired_chi_squared_distances(histograms[j], histograms[i]))
+        scores = 1.0 / (1.0 + distances)
+        keep = scores >= threshold
+        firsts.append(i[keep])
+        seconds.append(j[keep])
+        all_scores.append(scores[keep])
+
+    return np.concatenate(firsts), np.concatenate(seconds), np.concatenate(all_scores)
+
+# Function to find all pairs (i, j), i < j, whose symmetric similarity is at or above the threshold.
+# Returns the arrays first, second and score.
+def find_duplicate_pairs(histograms, threshold=0.9, block=DEDUPE_BLOCK):
+    histograms = np.asarray(histograms, dtype=np.float32)
+
+    # Bins that are empty in every image (e.g. hues above 180) never contribute
+    histograms = histograms[:, histograms.any(axis=0)]
+    max_distance = (1.0 / threshold - 1.0) * (1.0 + SCREEN_TOLERANCE) + SCREEN_TOLERANCE
+
+    firsts, seconds = [], []
+    for i_start in range(0, len(histograms), block):
+        rows = histograms[i_start:i_start + block]
+
+        for j_start in range(i_start, len(histograms), block):
+            columns = histograms[j_start:j_start + block]
+
+            # Screen in float32 with both images as the query, keep the worse of the two distances
+            distances = np.maximum(chi_squared_distance_matrix(rows, columns, np.float32),
+                                   chi_squared_distance_matrix(columns, rows, np.float32).T)
+            if i_start == j_start:
+                distances[np.tril_indices(len(rows))] = np.inf
+
+            i, j = np.nonzero(distances <= max_distance)
+            firsts.append(i + i_start)
+            seconds.append(j + j_start)
+
+    first = np.concatenate(firsts) if firsts else np.empty(0, dtype=np.int64)
+    second = np.concatenate(seconds) if seconds else np.empty(0, dtype=np.int64)
+    return _verify_pairs(histograms, first, second, threshold)
+
+# Function to find the duplicate pairs among the candidates of an IVF index instead of all pairs.
+# The candidates of every block of images are verified before moving on, so only the matching pairs
+# are kept for the whole library.
+def find_duplicate_pairs_ivf(histograms, ivf, threshold=0.9, n_probe=2, block=DEDUPE_BLOCK):
+    histograms = np.asarray(histograms, dtype=np.float32)
+
+    matches = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))]
+    for start in range(0, len(histograms), block):
+        firsts, seconds = [], []
+        for i in range(start, min(start + block, len(histograms))):
+            candidates = ivf.candidates(histograms[i], n_probe)
+            candidates = candidates[candidates > i]
+            firsts.append(np.full(len(candidates), i, dtype=np.int64))
+            seconds.append(candidates.astype(np.int64))
+        matches.append(_verify_pairs(histograms, np.concatenate(firsts), np.concatenate(seconds), threshold))
+
+    first, second, scores = zip(*matches)
+    return np.concatenate(first), np.concatenate(second), np.concatenate(scores)
+
+# Function to group duplicate pairs into clusters of two or more images.
+# The representative of a cluster is its largest file (earliest on ties), or its first image
+# without file sizes. Returns a list of (representative, members) with members in index order.
+def cluster_duplicates(count, first, second, sizes=None):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = coo_matrix((np.ones(len(first), dtype=np.int8), (first, second)), shape=(count, count))
+    n_components, labels = connected_components(graph, directed=False)
+
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+
+    clusters = []
+    for members in np.split(order, bounds):
+        if len(members) < 2:
+            continue
+        if sizes is None:
+            representative = int(members[0])
+        else:
+            representative = int(members[np.argmax(np.asarray(sizes)[members])])
+        clusters.append((representative, members))
+
+    # Biggest clusters first
+    clusters.sort(key=lambda cluster: (-len(cluster[1]), cluster[0]))
+    return clusters
+
+# Function to score every member of a cluster against its representative
+def representative_scores(histograms, representative, members):
+    return similarity_scores(histograms[representative], histograms[members])
@@ -0,0 +1,199 @@
+# Registry of image descriptors
+#
+# A descriptor turns a decoded image into features and scores the features of
+# candidate images against those of a query, 1 meaning identical. Descriptors
+# are named by a spec string, a registered name with optional arguments:
+#
+#   hsv                 [8, 8, 8] HSV histogram, the one stored in the index
+#   hsv:16x4x4@2x2      16x4x4 bins, one histogram per cell of a 2x2 grid
+#   hsv@2x2             the default bins per cell of a 2x2 grid
+#   hsv:8x8x8/hellinger compared by Hellinger instead of chi-squared distance
+#   edges:16@3x3        histogram of 16 gradient orientations per cell of a 3x3 grid
+#   orb:500             up to 500 ORB keypoints, matched with a ratio test
+#
+# Histogram descriptors are cheap and scored in one vectorized pass; ORB needs
+# a brute-force match per candidate and is only worth it on a short list.
+# register_descriptor adds new kinds under their own name.
+
+import re
+
+import cv2
+import numpy as np
+
+from .ann import hellinger_embedding
+from .scoring import chi_squared_distances
+
+DESCRIPTORS = {}
+
+# Function to register a descriptor kind: factory(args) gets the text after "name:" (or None)
+# and returns the descriptor
+def register_descriptor(name, factory):
+    DESCRIPTORS[name] = factory
+
+# Function to create the descriptor of a spec such as "hsv:16x4x4@2x2" (or "hsv@2x2" with the default bins)
+def get_descriptor(spec):
+    name, args = re.match(r'(\w*):?(.*)$', spec).groups()
+    if name not in DESCRIPTORS:
+        raise ValueError(f"Unknown descriptor '{name}', use one of {', '.join(sorted(DESCRIPTORS))}")
+    return DESCRIPTORS[name](args or None)
+
+# Function to parse "AxB" (or "A") into a tuple of ints
+def _parse_sizes(text, count):
+    sizes = tuple(int(part) for part in text.lower().split('x'))
+    if len(sizes) == 1:
+        sizes *= count
+    if len(sizes) != count or min(sizes) < 1:
+        raise ValueError(f"Expected {count} positive sizes separated by 'x', got '{text}'")
+    return sizes
+
+# Function to split an image into the cells of a rows x columns grid
+def _grid_cells(image, grid):
+    height, width = image.shape[:2]
+    rows, columns = grid
+    for row in range(rows):
+        for column in range(columns):
+            yield image[row * height // rows:(row + 1) * height // rows,
+                        column * width // columns:(column + 1) * width // columns]
+
+# Function to shrink an image so its longest side is at most size pixels
+def fit_image(image, size):
+    height, width = image.shape[:2]
+    if size is None or max(height, width) <= size:
+        return image
+
+    scale = size / max(height, width)
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+class Descriptor:
+    # Base of all descriptors; image_size is the longest side images are shrunk to before
+    # computing, None to use the decoded image as is
+    name = None
+    image_size = None
+
+    def __repr__(self):
+        return self.name
+
+    # Function to compute the features of a decoded BGR image, or None if it has none
+    def compute(self, image):
+        raise NotImplementedError
+
+    # Function to score a list of candidate features against the query features
+    def similarities(self, query, features):
+        raise NotImplementedError
+
+class HistogramDescriptor(Descriptor):
+    # Normalized histograms of one or more grid cells, concatenated, compared bin by bin
+    def __init__(self, name, grid=(1, 1), metric='chisqr'):
+        if metric not in ('chisqr', 'hellinger'):
+            raise ValueError(f"Unsupported histogram metric '{metric}', use chisqr or hellinger")
+        self.name = name
+        self.grid = grid
+        self.metric = metric
+
+    def cell_histogram(self, cell):
+        raise NotImplementedError
+
+    def compute(self, image):
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return np.concatenate([self.cell_histogram(cell) for cell in _grid_cells(image, self.grid)])
+
+    def similarities(self, query, features):
+        if not len(features):
+            return np.empty(0)
+        features = np.vstack(features)
+        cells = self.grid[0] * self.grid[1]
+
+        if self.metric == 'hellinger':
+            # Per cell, 1 - Hellinger distance; averaged over the cells
+            bins = len(query) // cells
+            query_cells = hellinger_embedding(query.reshape(cells, bins))
+            feature_cells = hellinger_embedding(features.reshape(-1, bins)).reshape(len(features), cells, bins)
+            distances = np.sqrt(np.maximum(1.0 - (feature_cells * query_cells).sum(axis=2), 0.0))
+            return 1.0 - distances.mean(axis=1)
+
+        # The chi-squared distance over all cells, averaged per cell, gives the usual 1 / (1 + d) score
+        return 1.0 / (1.0 + chi_squared_distances(query, features) / cells)
+
+class HSVHistogram(HistogramDescriptor):
+    def __init__(self, bins=(8, 8, 8), grid=(1, 1), metric='chisqr'):
+        name = f"hsv:{'x'.join(map(str, bins))}@{grid[0]}x{grid[1]}"
+        super().__init__(name if metric == 'chisqr' else f"{name}/{metric}", grid, metric)
+        self.bins = list(bins)
+
+    def cell_histogram(self, cell):
+        hsv = cv2.cvtColor(cell, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1, 2], None, self.bins, [0, 256, 0, 256, 0, 256])
+        return cv2.normalize(hist, hist).flatten()
+
+class EdgeOrientationHistogram(HistogramDescriptor):
+    # Gradient orientations (0 to 180 degrees) weighted by gradient magnitude, per grid cell
+    image_size = 256
+
+    def __init__(self, bins=16, grid=(1, 1), metric='chisqr'):
+        name = f"edges:{bins}@{grid[0]}x{grid[1]}"
+        super().__init__(name if metric == 'chisqr' else f"{name}/{metric}", grid, metric)
+        self.bins = bins
+
+    def cell_histogram(self, cell):
+        gray = cv2.cvtColor(cell, cv2.COLOR_BGR2GRAY)
+        gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+        magnitude, angle = cv2.cartToPolar(gx, gy, angleInDegrees=True)
+
+        hist, _ = np.histogram(np.mod(angle, 180.0), bins=self.bins, range=(0.0, 180.0), weights=magnitude)
+        total = hist.sum()
+        return (hist / total if total > 0 else hist).astype(np.float32)
+
+class ORBDescriptor(Descriptor):
+    # ORB keypoint descriptors; the score is the share of keypoints with an unambiguous match
+    image_size = 640
+
+    def __init__(self, n_features=500, ratio=0.75):
+        self.name = f"orb:{n_features}"
+        self.n_features = n_features
+        self.ratio = ratio
+
+    def compute(self, image):
+        gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        orb = cv2.ORB_create(nfeatures=self.n_features)
+        keypoints, descriptors = orb.detectAndCompute(gray, None)
+        return descriptors
+
+    def similarities(self, query, features):
+        scores = np.zeros(len(features))
+        if query is None or len(query) < 2:
+            return scores
+
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        for i, candidate in enumerate(features):
+            if candidate is None or len(candidate) < 2:
+                continue
+            matches = matcher.knnMatch(query, candidate, k=2)
+            good = sum(1 for pair in matches if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance)
+            scores[i] = good / min(len(query), len(candidate))
+
+        return scores
+
+# Function to split "args/metric" and "bins@grid" of histogram specs
+def _histogram_args(args, default_bins, bin_count):
+    args, _, metric = (args or '').partition('/')
+    bins, _, grid = args.partition('@')
+    return (_parse_sizes(bins, bin_count) if bins else default_bins, _parse_sizes(grid, 2) if grid else (1, 1),
+            metric or 'chisqr')
+
+def _hsv_factory(args):
+    bins, grid, metric = _histogram_args(args, (8, 8, 8), 3)
+    return HSVHistogram(bins, grid, metric)
+
+def _edges_factory(args):
+    bins, grid, metric = _histogram_args(args, (16,), 1)
+    return EdgeOrientationHistogram(bins[0], grid, metric)
+
+def _orb_factory(args):
+    return ORBDescriptor(int(args) if args else 500)
+
+register_descriptor('hsv', _hsv_factory)
+register_descriptor('edges', _edges_factory)
+register_descriptor('orb', _orb_factory)
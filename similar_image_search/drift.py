@@ -0,0 +1,73 @@
+# Histogram drift of reduced-resolution decoding
+#
+# Decodes a sample of images at full resolution and at every reduced decode
+# scale, and reports how far the reduced histograms move away from the full
+# resolution ones: per image as a chi-squared distance and similarity score,
+# and per query as the overlap between the full-resolution top matches and the
+# top matches found with reduced decoding.
+
+import random
+import time
+
+import numpy as np
+
+from .extract import extract_histograms
+from .features import iter_image_paths
+from .options import DECODE_SCALES
+from .scoring import paired_chi_squared_distances, similarity_scores, top_k
+
+# Function to pick a reproducible random sample of the images below a folder
+def sample_image_paths(search_folder, sample_size, seed=0):
+    image_paths = list(iter_image_paths(search_folder))
+    if sample_size and len(image_paths) > sample_size:
+        image_paths = sorted(random.Random(seed).sample(image_paths, sample_size))
+    return image_paths
+
+# Function to compare reduced decoding against full-resolution decoding on the given images.
+# Returns one report per decode scale, the first one being the full-resolution baseline.
+def measure_decode_drift(image_paths, decode_scales=DECODE_SCALES[1:], workers=1, num_similar=10):
+    start = time.perf_counter()
+    full, full_ok = extract_histograms(image_paths, workers)
+    full_seconds = time.perf_counter() - start
+
+    reports = [{
+        'decode_scale': '1/1',
+        'images': int(full_ok.sum()),
+        'seconds': round(full_seconds, 3),
+        'speedup': 1.0,
+    }]
+
+    for decode_scale in decode_scales:
+        start = time.perf_counter()
+        reduced, reduced_ok = extract_histograms(image_paths, workers, decode_scale=decode_scale)
+        seconds = time.perf_counter() - start
+
+        both = full_ok & reduced_ok
+        exact = full[both]
+        approx = reduced[both]
+
+        # How far every reduced histogram is from its full-resolution version
+        distances = paired_chi_squared_distances(exact, approx)
+        similarities = 1.0 / (1.0 + distances)
+
+        # How many of the full-resolution top matches a reduced-resolution search still finds
+        k = min(num_similar, len(exact))
+        overlaps = []
+        for i in range(len(exact)):
+            expected = set(top_k(similarity_scores(exact[i], exact), k).tolist())
+            found = set(top_k(similarity_scores(approx[i], approx), k).tolist())
+            overlaps.append(len(expected & found) / k)
+
+        reports.append({
+            'decode_scale': f"1/{decode_scale}",
+            'images': int(both.sum()),
+            'seconds': round(seconds, 3),
+            'speedup': round(full_seconds / seconds, 2) if seconds > 0 else None,
+            'chi_squared_mean': float(np.mean(distances)) if len(distances) else None,
+            'chi_squared_p95': float(np.percentile(distances, 95)) if len(distances) else None,
+            'chi_squared_max': float(np.max(distances)) if len(distances) else None,
+            'similarity_min': float(np.min(similarities)) if len(similarities) else None,
+            f'top{num_similar}_overlap': float(np.mean(overlaps)) if overlaps else None,
+        })
+
+    return reports
@@ -0,0 +1,271 @@
+# Programmatic API of the similar image search
+#
+# The command line and both GUIs search through these functions, so a search
+# behaves the same whichever front-end started it:
+#
+#   extract   features of a list of images
+#   index     build or refresh the feature index of a folder
+#   query     the images most similar to one image, from a folder scan, an
+#             index, a sharded index or running search services, or the
+#             images most similar in one region of interest, from an index
+#
+# They take and return plain paths, (path, score) lists and NumPy arrays. The
+# modules doing the work are only imported inside each function, the first time
+# a code path needs them, so importing the engine costs next to nothing and a
+# front-end only loads OpenCV and NumPy once it actually searches.
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from .options import DEFAULT_CANDIDATES, DEFAULT_SCAN_THREADS
+
+# Function to compute the histograms and dHashes of a list of images. Returns an (N, 512) histogram
+# matrix and N hashes in input order, and a mask of the rows that could be decoded. Images over the
+# limits (an ImageLimits, the defaults if None) are not decoded.
+def extract(image_paths, workers=1, decode_scale=1, readahead=0, limits=None):
+    from .extract import extract_features
+    from .limits import DEFAULT_LIMITS
+
+    return extract_features(image_paths, workers, decode_scale=decode_scale, readahead=readahead,
+                            limits=limits or DEFAULT_LIMITS)
+
+# Function to build the index of a folder (rebuild=True, or if there is none yet) or refresh an
+# existing one, only decoding new or modified files. With archives, the images inside zip and tar
+# archives are indexed too, and with regions the grids region queries need are stored (None keeps the
+# settings of an existing index). Returns the index and what changed.
+def index(search_folder=None, index_path=None, workers=1, decode_scale=None, precision=None,
+          scan_threads=DEFAULT_SCAN_THREADS, readahead=0, skip_unchanged_dirs=False, rebuild=False, limits=None,
+          archives=None, regions=None):
+    from .index import build_index, update_index
+
+    if rebuild:
+        return build_index(search_folder, index_path, workers, decode_scale or 1, precision or 'float32',
+                           scan_threads, readahead, limits, bool(archives), bool(regions))
+    return update_index(index_path, search_folder, workers, decode_scale, precision, scan_threads, readahead,
+                        skip_unchanged_dirs, limits, archives, regions)
+
+# Function to find the images most similar to an input image, best first, as (path, score) pairs.
+#  - server_url: search running services (several comma-separated URLs are merged)
+#  - index_path: refresh and search a feature index or a sharded index, against the folder it was built for
+#  - otherwise scan search_folder, passing progress snapshots and the number of images (None unless
+#    list_first lists them before scanning) to on_progress, and stopping early once cancel is set
+# With re-ranking stages (CascadeStage objects or specs such as "orb=50"), the best candidates of the
+# histogram search are ranked again and the cost of every stage is passed to on_costs. Images over the
+# limits (an ImageLimits; the defaults, or those an index was built with, if None) are not decoded.
+# With archives, the images inside zip and tar archives are searched too (None keeps the setting of an index).
+# With a region (left, top, right, bottom) in grid cells, the images are compared in that region only, to
+# input_region of the input image (the whole image if None). Region queries need an index with region grids.
+def query(input_image_path, search_folder=None, index_path=None, server_url=None, threshold=0.005, num_similar=5,
+          workers=1, decode_scale=None, probes=None, hash_radius=None, rerank=None, candidates=DEFAULT_CANDIDATES,
+          scan_threads=DEFAULT_SCAN_THREADS, readahead=0, skip_unchanged_dirs=False, cancel=None, on_progress=None,
+          list_first=False, chunk_size=None, snapshot_interval=1.0, on_costs=None, limits=None, archives=None,
+          region=None, input_region=None):
+    if region is not None:
+        return _query_regions(input_image_path, search_folder, index_path, region, input_region, threshold,
+                              num_similar, workers, decode_scale, scan_threads, readahead, skip_unchanged_dirs,
+                              limits, archives)
+
+    if server_url:
+        return _query_servers(input_image_path, server_url, threshold, num_similar, probes, hash_radius)
+
+    num_found = max(candidates, num_similar) if rerank else num_similar
+    start = time.perf_counter()
+
+    if not index_path:
+        from .limits import DEFAULT_LIMITS
+
+        decode_scale, limits = decode_scale or 1, limits or DEFAULT_LIMITS
+        similar_images = _query_folder(input_image_path, search_folder, threshold, num_found, workers, decode_scale,
+                                       scan_threads, readahead, cancel, on_progress, list_first, chunk_size,
+                                       snapshot_interval, limits, bool(archives))
+    else:
+        from .shards import is_sharded_index
+
+        if is_sharded_index(index_path):
+            similar_images, decode_scale, limits = _query_shards(input_image_path, index_path, threshold, num_found,
+                                                                 workers, decode_scale, probes, hash_radius, limits,
+                                                                 archives)
+        else:
+            similar_images, decode_scale, limits = _query_index(input_image_path, search_folder, index_path,
+                                                                threshold, num_found, workers, decode_scale, probes,
+                                                                hash_radius, scan_threads, readahead,
+                                                                skip_unchanged_dirs, limits, archives)
+
+    if cancel is not None and cancel.is_set():
+        return []
+
+    if rerank and similar_images:
+        from .cascade import parse_cascade, rerank_candidates
+        from .extract import resolve_workers
+
+        stages = parse_cascade(rerank) if isinstance(rerank[0], str) else rerank
+        first_stage = {'stage': 'histogram', 'candidates': len(similar_images),
+                       'seconds': round(time.perf_counter() - start, 4)}
+        similar_images, costs = rerank_candidates(input_image_path, similar_images, stages, num_similar,
+                                                  decode_scale, resolve_workers(workers), limits=limits)
+        if on_costs is not None:
+            on_costs([first_stage] + costs)
+
+    return similar_images
+
+# Function to score the images of a folder while it is being walked, only keeping the best matches in memory
+def _query_folder(input_image_path, search_folder, threshold, num_similar, workers, decode_scale, scan_threads,
+                  readahead, cancel, on_progress, list_first, chunk_size, snapshot_interval, limits, archives):
+    from .extract import DEFAULT_CHUNK_SIZE
+    from .features import iter_image_paths
+    from .stream import iter_similar_images
+
+    image_paths = iter_image_paths(search_folder, threads=scan_threads, archives=archives)
+    total = None
+    if list_first:
+        # List the images first, so the progress can tell how many are left
+        listed = []
+        for image_path in image_paths:
+            if cancel is not None and cancel.is_set():
+                return []
+            listed.append(image_path)
+        image_paths, total = listed, len(listed)
+
+    snapshot = None
+    for snapshot in iter_similar_images(input_image_path, search_folder, threshold, num_similar, workers,
+                                        decode_scale, chunk_size or DEFAULT_CHUNK_SIZE, snapshot_interval, cancel,
+                                        image_paths, readahead, limits):
+        if on_progress is not None:
+            on_progress(snapshot, total)
+
+    return snapshot.results if snapshot is not None else []
+
+# Function to search a feature index, refreshed first so only new or modified files are decoded.
+# Returns the matches and the decode scale and limits of the index.
+def _query_index(input_image_path, search_folder, index_path, threshold, num_similar, workers, decode_scale,
+                 probes, hash_radius, scan_threads, readahead, skip_unchanged_dirs, limits, archives):
+    from .ann import load_ivf
+    from .features import compute_features
+    from .index import update_index
+    from .query import search_index
+
+    feature_index, stats = update_index(index_path, search_folder, workers, decode_scale, scan_threads=scan_threads,
+                                        readahead=readahead, skip_unchanged_dirs=skip_unchanged_dirs, limits=limits,
+                                        archives=archives, keep_root=True, mmap=True)
+    logging.info(f"Index '{index_path}' refreshed: {stats}")
+
+    # Decode the input image the same way as the indexed images
+    decode_scale, limits = feature_index.decode_scale, feature_index.limits
+    input_hist, input_hash = compute_features(input_image_path, decode_scale, limits)
+    if input_hist is None or not len(feature_index):
+        return [], decode_scale, limits
+
+    ivf = load_ivf(feature_index, index_path) if probes else None
+    return [(feature_index.paths[i], score) for i, score in
+            search_index(feature_index, input_hist, input_hash, threshold, num_similar, probes, hash_radius,
+                         ivf)], decode_scale, limits
+
+# Function to search a sharded index. Every shard is refreshed against its own folder, then all shards are
+# searched in parallel and their best matches merged. Returns the matches and the decode scale and limits of the
+# shards.
+def _query_shards(input_image_path, index_path, threshold, num_similar, workers, decode_scale, probes, hash_radius,
+                  limits, archives):
+    from .ann import load_ivf
+    from .features import compute_features
+    from .shards import ShardedIndex, search_shards
+
+    sharded = ShardedIndex.load(index_path)
+    stats = sharded.update(workers=workers, decode_scale=decode_scale, limits=limits, archives=archives)
+    logging.info(f"Shards of '{index_path}' refreshed: {stats}")
+
+    indexes = sharded.load_shards(mmap=True)
+    if not indexes:
+        from .limits import DEFAULT_LIMITS
+
+        return [], decode_scale or 1, limits or DEFAULT_LIMITS
+
+    decode_scale, limits = indexes[0].decode_scale, indexes[0].limits
+    input_hist, input_hash = compute_features(input_image_path, decode_scale, limits)
+    if input_hist is None:
+        return [], decode_scale, limits
+
+    ivfs = None
+    if probes:
+        ivfs = [load_ivf(shard_index, sharded.shard_path(shard['name']))
+                for shard_index, shard in zip(indexes, sharded.shards)]
+    return (search_shards(indexes, input_hist, input_hash, threshold, num_similar, probes, hash_radius, ivfs),
+            decode_scale, limits)
+
+# Function to search the images of an index in one region, scoring the sums of their precomputed cell
+# histograms in that region. Raises ValueError if the index is sharded or has no region grids.
+def _query_regions(input_image_path, search_folder, index_path, region, input_region, threshold, num_similar,
+                   workers, decode_scale, scan_threads, readahead, skip_unchanged_dirs, limits, archives):
+    from .features import compute_region_grid
+    from .index import update_index
+    from .regions import FULL_REGION, region_histograms, search_regions
+    from .shards import is_sharded_index
+
+    if not index_path or is_sharded_index(index_path):
+        raise ValueError("Region queries need a feature index that is not sharded")
+
+    feature_index, stats = update_index(index_path, search_folder, workers, decode_scale, scan_threads=scan_threads,
+                                        readahead=readahead, skip_unchanged_dirs=skip_unchanged_dirs, limits=limits,
+                                        archives=archives, keep_root=True, mmap=True)
+    logging.info(f"Index '{index_path}' refreshed: {stats}")
+    if feature_index.grids is None:
+        raise ValueError(f"Index '{index_path}' has no region grids, update it with --regions")
+
+    # Decode the input image the same way as the indexed images
+    input_grid = compute_region_grid(input_image_path, feature_index.decode_scale, feature_index.limits)
+    if input_grid is None or not len(feature_index):
+        return []
+
+    input_region_hist = region_histograms(input_grid[None], input_region or FULL_REGION)[0]
+    return [(feature_index.paths[i], score) for i, score in
+            search_regions(feature_index.grids, input_region_hist, region, threshold, num_similar)]
+
+# Function to search with running search services, which already hold the index in memory. Several
+# comma-separated URLs, e.g. one service per shard, are searched in parallel and their results merged.
+# Raises SearchServiceError if a service can't be reached or fails.
+def _query_servers(input_image_path, server_url, threshold, num_similar, probes, hash_radius):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .client import SearchClient, merge_shard_results
+
+    server_urls = [url for url in server_url.split(',') if url]
+
+    def search_server(url):
+        return SearchClient(url).search(os.path.abspath(input_image_path), threshold, num_similar, probes, hash_radius)
+
+    with ThreadPoolExecutor(max_workers=len(server_urls)) as executor:
+        results = list(executor.map(search_server, server_urls))
+
+    return merge_shard_results(results, num_similar)
+
+# Function to write the search options and the similar images to a results file
+def write_results(output_file, input_image_path, threshold, num_similar, similar_images):
+    with open(output_file, 'w', encoding='utf-8') as out_file:
+        out_file.write(f"Input image: {input_image_path}\n")
+        out_file.write(f"Threshold: {threshold}\n")
+        out_file.write(f"Number of similar images: {num_similar}\n\n")
+        out_file.write("Similar images:\n")
+
+        for i, (image_path, score) in enumerate(similar_images):
+            out_file.write(f"{i + 1}. {image_path} (similarity {score:.4f})\n")
+
+# Function to write the similar images to a results file named after the current date and time.
+# Returns the name of the file.
+def save_results(input_image_path, threshold, num_similar, similar_images):
+    output_file = f"similar-images-{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.txt"
+    write_results(output_file, input_image_path, threshold, num_similar, similar_images)
+    return output_file
+
+# Function to describe the progress of a search over a known number of images,
+# e.g. "Scanned 1200 of 5000 images, 350 files/s, ETA 0:00:11"
+def format_progress(snapshot, total):
+    processed = snapshot.scanned + snapshot.failed
+    text = f"Scanned {processed} of {total} images"
+
+    if snapshot.elapsed > 0 and processed:
+        rate = processed / snapshot.elapsed
+        eta = timedelta(seconds=int(max(0, total - processed) / rate))
+        text += f", {rate:.0f} files/s, ETA {eta}"
+
+    return text
@@ -0,0 +1,166 @@
+# Parallel feature extraction
+#
+# Image paths are fanned out to a process pool in chunks. Every chunk comes
+# back as one stacked histogram matrix, an array of dHashes computed from the
+# same decode, and a mask of the images that could be decoded, so results
+# cross the process boundary in bulk rather than as one pickle per image.
+# Chunks are consumed in submission order, which keeps the output in the same
+# order as the input paths. Stage timings and failure counts of a chunk come
+# back with it and are added to the metrics of the calling process.
+#
+# With readahead, threads of the calling process read the files ahead of the
+# decoders and the chunks carry their bytes, which are decoded from memory, so
+# reading the next files overlaps with decoding the current ones. Images inside
+# archives are always read by the calling process, one archive after the other,
+# and sent to the decoders as bytes.
+#
+# Every image is checked against the pixel and memory limits (see limits.py)
+# before it is decoded, so one huge file can't take a worker process down.
+
+import logging
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import cv2
+import numpy as np
+
+from .archives import read_archive_members
+from .features import HISTOGRAM_SIZE, compute_features_or_error, compute_region_features_or_error
+from .limits import DEFAULT_LIMITS, budget_bytes
+from .metrics import FAILURE_DECODE_ERROR, METRICS, Metrics
+from .regions import GRID_CELLS, REGION_HISTOGRAM_SIZE
+from .scanner import iter_file_buffers
+
+DEFAULT_CHUNK_SIZE = 64
+
+# Features of one chunk of paths; rows of images that could not be decoded are zero and not ok.
+# regions holds the (N, 16, 64) region grids if they were asked for.
+ChunkFeatures = namedtuple('ChunkFeatures', ['paths', 'histograms', 'hashes', 'ok', 'regions'], defaults=(None,))
+
+# Function to turn the --workers option into a process count (0 or None means all cores)
+def resolve_workers(workers):
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, workers)
+
+def _init_worker():
+    # Every process already works on its own image, so keep OpenCV single-threaded
+    cv2.setNumThreads(1)
+
+# Function run inside a worker process to compute the features of one chunk, from the bytes of
+# the files if they were read ahead (None for files that could not be read, or that the worker reads),
+# and with regions the region grids as well
+def _extract_chunk(image_paths, decode_scale=1, buffers=None, limits=DEFAULT_LIMITS, regions=False):
+    histograms = np.zeros((len(image_paths), HISTOGRAM_SIZE), dtype=np.float32)
+    hashes = np.zeros(len(image_paths), dtype=np.uint64)
+    grids = np.zeros((len(image_paths), GRID_CELLS, REGION_HISTOGRAM_SIZE), dtype=np.float32) if regions else None
+    ok = np.zeros(len(image_paths), dtype=bool)
+    errors = []
+    metrics = Metrics()
+
+    for i, image_path in enumerate(image_paths):
+        data = buffers[i] if buffers is not None else None
+        try:
+            if regions:
+                hist, dhash, grid, error = compute_region_features_or_error(image_path, decode_scale, metrics, data,
+                                                                            limits)
+            else:
+                hist, dhash, error = compute_features_or_error(image_path, decode_scale, metrics, data, limits)
+        except Exception as e:
+            metrics.failure(FAILURE_DECODE_ERROR)
+            hist, dhash, error = None, None, f"Error while processing '{image_path}': {e}"
+
+        if hist is None:
+            errors.append(error)
+        else:
+            histograms[i] = hist
+            hashes[i] = dhash
+            if regions:
+                grids[i] = grid
+            ok[i] = True
+
+    return histograms, hashes, ok, errors, metrics.snapshot(), grids
+
+# Function to split the paths into chunks of (paths, their bytes or None), reading the files on
+# readahead threads if asked to, and the archive members within the memory budget in any case
+def _chunks(image_paths, chunk_size, readahead=0, limits=DEFAULT_LIMITS):
+    if readahead:
+        items = iter_file_buffers(image_paths, readahead, depth=chunk_size * 2)
+    else:
+        items = ((path, None) for path in image_paths)
+    items = read_archive_members(items, max_size=budget_bytes(limits))
+
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            return
+        buffers = [data for path, data in chunk]
+        yield [path for path, data in chunk], buffers if any(data is not None for data in buffers) else None
+
+# Function to yield the ChunkFeatures of consecutive chunks of the input paths.
+# Only a bounded number of chunks is in flight at once, so the input may be a lazy iterator.
+# readahead is the number of threads reading files ahead of the decoders (0 lets them read).
+def iter_feature_chunks(image_paths, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, decode_scale=1, readahead=0,
+                        limits=DEFAULT_LIMITS, regions=False):
+    workers = resolve_workers(workers)
+
+    if workers == 1:
+        for chunk, buffers in _chunks(image_paths, chunk_size, readahead, limits):
+            histograms, hashes, ok, errors, snapshot, grids = _extract_chunk(chunk, decode_scale, buffers, limits,
+                                                                             regions)
+            METRICS.merge(snapshot)
+            for error in errors:
+                logging.warning(error)
+            yield ChunkFeatures(chunk, histograms, hashes, ok, grids)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        pending = deque()
+        chunks = _chunks(image_paths, chunk_size, readahead, limits)
+
+        for chunk, buffers in chunks:
+            pending.append((chunk, executor.submit(_extract_chunk, chunk, decode_scale, buffers, limits, regions)))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            chunk, future = pending.popleft()
+            histograms, hashes, ok, errors, snapshot, grids = future.result()
+            METRICS.merge(snapshot)
+
+            # Top up the pipeline before handing the results to the caller
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                next_paths, next_buffers = next_chunk
+                pending.append((next_paths, executor.submit(_extract_chunk, next_paths, decode_scale, next_buffers,
+                                                            limits, regions)))
+
+            for error in errors:
+                logging.warning(error)
+            yield ChunkFeatures(chunk, histograms, hashes, ok, grids)
+
+# Function to compute the histograms and dHashes of all given paths. Returns an (N, 512)
+# histogram matrix and N hashes in input order, and a mask of the rows that could be decoded,
+# followed with regions by the (N, 16, 64) region grids.
+def extract_features(image_paths, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, decode_scale=1, readahead=0,
+                     limits=DEFAULT_LIMITS, regions=False):
+    chunks = list(iter_feature_chunks(image_paths, workers, chunk_size, decode_scale, readahead, limits, regions))
+
+    if not chunks:
+        features = (np.empty((0, HISTOGRAM_SIZE), dtype=np.float32), np.empty(0, dtype=np.uint64),
+                    np.empty(0, dtype=bool))
+        grids = np.empty((0, GRID_CELLS, REGION_HISTOGRAM_SIZE), dtype=np.float32)
+    else:
+        features = (np.vstack([chunk.histograms for chunk in chunks]),
+                    np.concatenate([chunk.hashes for chunk in chunks]), np.concatenate([chunk.ok for chunk in chunks]))
+        grids = np.concatenate([chunk.regions for chunk in chunks]) if regions else None
+
+    return features + (grids,) if regions else features
+
+# Function to compute the histograms of all given paths.
+# Returns an (N, 512) matrix in input order and a mask of the rows that could be decoded.
+def extract_histograms(image_paths, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, decode_scale=1):
+    histograms, hashes, ok = extract_features(image_paths, workers, chunk_size, decode_scale)
+    return histograms, ok
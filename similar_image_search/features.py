@@ -0,0 +1,322 @@
+# Feature extraction shared by the command line and GUI front-ends
+
+import io
+import logging
+
+import cv2
+import numpy as np
+
+from .archives import read_archive_member, split_archive_path
+from .limits import DEFAULT_LIMITS, STRIP_PIXELS, ImageTooLarge, budget_bytes, fit_decode_scale, probe_image_size
+from .metrics import (FAILURE_DECODE_ERROR, FAILURE_MESSAGES, FAILURE_TOO_LARGE, FAILURE_UNREADABLE,
+                      FAILURE_UNSUPPORTED_FORMAT, METRICS)
+from .regions import GRID_CELLS, GRID_SIZE, REGION_BINS, cell_edges
+from .scanner import DEFAULT_SCAN_THREADS, DirectoryScanner
+
+# Number of values in a flattened [8, 8, 8] HSV histogram
+HISTOGRAM_SIZE = 8 * 8 * 8
+
+# JPEG files can be downscaled by libjpeg in the DCT domain while decoding
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Function to read the dimensions of an image from its header (from data, its bytes, if given) and pick
+# the scale to decode it at within the limits (None for no limits). Raises ImageTooLarge if it can't be
+# decoded within them; images whose header can't be read are left to the decoder.
+def limited_decode_scale(image_path, decode_scale=1, limits=DEFAULT_LIMITS, data=None, jpeg=None):
+    if limits is None:
+        return decode_scale
+
+    try:
+        if data is None:
+            with open(image_path, 'rb') as image_file:
+                size = probe_image_size(image_file)
+        else:
+            size = probe_image_size(io.BytesIO(data))
+    except OSError:
+        return decode_scale
+    if size is None:
+        return decode_scale
+
+    if jpeg is None:
+        jpeg = image_path.lower().endswith(JPEG_EXTENSIONS) if data is None else data[:3] == b'\xff\xd8\xff'
+    return fit_decode_scale(size[0], size[1], decode_scale, jpeg, limits)
+
+# Function to decode an image at 1/decode_scale of its resolution, or at a smaller scale if that's the
+# only way to stay within the limits. Raises ImageTooLarge for images over them. Images inside archives
+# are read into memory and decoded from there.
+def decode_image(image_path, decode_scale=1, limits=DEFAULT_LIMITS):
+    if split_archive_path(image_path)[1] is not None:
+        data = read_archive_member(image_path, budget_bytes(limits))
+        if data is None:
+            return None
+        return decode_image_buffer(data, decode_scale, image_path.lower().endswith(JPEG_EXTENSIONS), limits)
+
+    decode_scale = limited_decode_scale(image_path, decode_scale, limits)
+    if decode_scale == 1:
+        return cv2.imread(image_path, cv2.IMREAD_COLOR)
+
+    if image_path.lower().endswith(JPEG_EXTENSIONS):
+        return cv2.imread(image_path, REDUCED_COLOR_FLAGS[decode_scale])
+
+    # Other formats have to be decoded in full, but a nearest-neighbour resize is
+    # cheap and keeps the color conversion and histogram on fewer pixels
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, width // decode_scale), max(1, height // decode_scale)),
+                      interpolation=cv2.INTER_NEAREST)
+
+# Function to decode an image held in memory (e.g. uploaded bytes) at 1/decode_scale of its
+# resolution, the same way decode_image decodes the file. jpeg tells whether to decode it as
+# JPEG, which is recognized by its SOI marker if not given.
+def decode_image_buffer(data, decode_scale=1, jpeg=None, limits=DEFAULT_LIMITS):
+    if jpeg is None:
+        jpeg = data[:3] == b'\xff\xd8\xff'
+    decode_scale = limited_decode_scale(None, decode_scale, limits, data, jpeg)
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if decode_scale == 1:
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+    if jpeg:
+        return cv2.imdecode(buffer, REDUCED_COLOR_FLAGS[decode_scale])
+
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, width // decode_scale), max(1, height // decode_scale)),
+                      interpolation=cv2.INTER_NEAREST)
+
+# Function to compute the normalized color histogram of a decoded image and, with grid, the cell
+# histograms of its region grid (see regions.py) from the same pass. Large images are converted and
+# counted in strips of rows, so only one strip of HSV exists at a time; the counts add up to exactly
+# those of the whole image. With grid, every cell is counted on its own and the histogram is their
+# sum, so it costs no more than counting the image once. Returns (histogram, (16, 64) grid or None).
+def _hsv_histograms(image, grid=False):
+    height, width = image.shape[:2]
+    rows = max(1, STRIP_PIXELS // max(1, width))
+    counts = np.zeros((8, 8, 8), dtype=np.float64)
+    if grid:
+        cells = np.zeros((GRID_SIZE, GRID_SIZE, 8, 8, 8), dtype=np.float64)
+        row_edges, column_edges = cell_edges(height), cell_edges(width)
+
+    for top in range(0, height, rows):
+        strip = image[top:top + rows]
+
+        # Check if the image is grayscale, and convert it to color if necessary
+        if len(strip.shape) == 2:
+            strip = cv2.cvtColor(strip, cv2.COLOR_GRAY2BGR)
+
+        # Convert the strip to the HSV color space and count its colors
+        hsv = cv2.cvtColor(strip, cv2.COLOR_BGR2HSV)
+        if not grid:
+            counts += cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+            continue
+
+        # Count the part of every cell that lies in this strip
+        for row in range(GRID_SIZE):
+            first, last = max(row_edges[row], top), min(row_edges[row + 1], top + len(hsv))
+            if first >= last:
+                continue
+            for column in range(GRID_SIZE):
+                if column_edges[column] < column_edges[column + 1]:
+                    cell = hsv[first - top:last - top, column_edges[column]:column_edges[column + 1]]
+                    cells[row, column] += cv2.calcHist([cell], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+
+    if grid:
+        counts = cells.sum(axis=(0, 1))
+
+    # Normalize the histogram
+    hist = counts.astype(np.float32)
+    hist = cv2.normalize(hist, hist).flatten()
+    if not grid:
+        return hist, None
+
+    # Merge neighbouring bins down to the coarser bins of the cell histograms
+    fold = 8 // REGION_BINS[0]
+    cells = cells.reshape(GRID_CELLS, REGION_BINS[0], fold, REGION_BINS[1], fold, REGION_BINS[2], fold).sum(axis=(2, 4, 6))
+    return hist, (cells / max(1, height * width)).reshape(GRID_CELLS, -1).astype(np.float32)
+
+# Function to compute the normalized color histogram of a decoded image
+def image_histogram(image):
+    return _hsv_histograms(image)[0]
+
+# Function to compute the (16, 64) cell histograms of the region grid of a decoded image
+def image_region_grid(image):
+    return _hsv_histograms(image, True)[1]
+
+# Function to compute the 64-bit difference hash (dHash) of a decoded image: every bit tells
+# whether a pixel of the 9x8 grayscale thumbnail is brighter than its left neighbour
+def image_dhash(image):
+    # Shrinking first is cheaper than converting the full image, and the same up to rounding
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    if len(small.shape) == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+# Function to find out why an image that did not decode could not be used: the file can't be
+# read, OpenCV has no reader for its content, or the reader failed on it. data holds the bytes
+# the image was decoded from, if they were read ahead.
+def classify_failure(image_path, data=None):
+    if split_archive_path(image_path)[1] is not None:
+        # OpenCV can only look for a reader by file, so members that were read count as decode errors
+        return FAILURE_UNREADABLE if data is None else FAILURE_DECODE_ERROR
+
+    try:
+        with open(image_path, 'rb'):
+            pass
+    except OSError:
+        return FAILURE_UNREADABLE
+
+    if not cv2.haveImageReader(image_path):
+        return FAILURE_UNSUPPORTED_FORMAT
+    return FAILURE_DECODE_ERROR
+
+# Function to decode an image (from data, its bytes read ahead, if given) within the limits and compute
+# its features, timing every stage and tallying a failure by category. Images decoded at a smaller scale
+# to fit the memory budget are counted as 'downscaled'. Returns (histogram, dhash or None, region grid or None,
+# category or None).
+def _timed_features(image_path, decode_scale, with_hash, metrics, data=None, limits=DEFAULT_LIMITS, with_grid=False):
+    # Chosen by file name like decode_image, so both decode a file the same way
+    jpeg = image_path.lower().endswith(JPEG_EXTENSIONS)
+
+    # Archive members that were not read ahead are read here, once their size is checked against the limits
+    if data is None and split_archive_path(image_path)[1] is not None:
+        try:
+            with metrics.timer('read'):
+                data = read_archive_member(image_path, budget_bytes(limits))
+        except ImageTooLarge:
+            metrics.failure(FAILURE_TOO_LARGE)
+            return None, None, None, FAILURE_TOO_LARGE
+        if data is None:
+            metrics.failure(FAILURE_UNREADABLE)
+            return None, None, None, FAILURE_UNREADABLE
+
+    with metrics.timer('decode'):
+        try:
+            scale = limited_decode_scale(image_path, decode_scale, limits, data, jpeg)
+            if scale != decode_scale:
+                metrics.count('downscaled')
+
+            if data is None:
+                image = decode_image(image_path, scale, None)
+            else:
+                image = decode_image_buffer(data, scale, jpeg, None)
+        except ImageTooLarge:
+            metrics.failure(FAILURE_TOO_LARGE)
+            return None, None, None, FAILURE_TOO_LARGE
+        except cv2.error:
+            image = None
+
+    if image is None:
+        category = classify_failure(image_path, data)
+        metrics.failure(category)
+        return None, None, None, category
+
+    with metrics.timer('histogram'):
+        hist, grid = _hsv_histograms(image, with_grid)
+
+    dhash = None
+    if with_hash:
+        with metrics.timer('dhash'):
+            dhash = image_dhash(image)
+
+    return hist, dhash, grid, None
+
+# Function to compute the color histogram and dHash of an image from a single decode,
+# returning them together with an error message instead of logging, so worker processes
+# can report failures back. data holds the bytes of the file if they were already read.
+def compute_features_or_error(image_path, decode_scale=1, metrics=METRICS, data=None, limits=DEFAULT_LIMITS):
+    hist, dhash, grid, category = _timed_features(image_path, decode_scale, True, metrics, data, limits)
+
+    if category is not None:
+        return None, None, f"Unable to read image '{image_path}' ({FAILURE_MESSAGES[category]})"
+
+    return hist, dhash, None
+
+# Function to compute the color histogram, dHash and region grid of an image from a single decode,
+# like compute_features_or_error. Returns (histogram, dhash, grid, error message or None).
+def compute_region_features_or_error(image_path, decode_scale=1, metrics=METRICS, data=None, limits=DEFAULT_LIMITS):
+    hist, dhash, grid, category = _timed_features(image_path, decode_scale, True, metrics, data, limits, True)
+
+    if category is not None:
+        return None, None, None, f"Unable to read image '{image_path}' ({FAILURE_MESSAGES[category]})"
+
+    return hist, dhash, grid, None
+
+# Function to compute the color histogram of an image, returning it together with
+# an error message instead of logging
+def compute_histogram_or_error(image_path, decode_scale=1, metrics=METRICS, limits=DEFAULT_LIMITS):
+    hist, dhash, grid, category = _timed_features(image_path, decode_scale, False, metrics, limits=limits)
+
+    if category is not None:
+        return None, f"Unable to read image '{image_path}' ({FAILURE_MESSAGES[category]})"
+
+    return hist, None
+
+# Function to compute the color histogram of an image
+def compute_histogram(image_path, decode_scale=1, limits=DEFAULT_LIMITS):
+    hist, error = compute_histogram_or_error(image_path, decode_scale, limits=limits)
+
+    if error is not None:
+        logging.warning(error)
+
+    return hist
+
+# Function to compute the color histogram and dHash of an image
+def compute_features(image_path, decode_scale=1, limits=DEFAULT_LIMITS):
+    hist, dhash, error = compute_features_or_error(image_path, decode_scale, limits=limits)
+
+    if error is not None:
+        logging.warning(error)
+
+    return hist, dhash
+
+# Function to compute the region grid of an image, e.g. of the input image of a region query
+def compute_region_grid(image_path, decode_scale=1, limits=DEFAULT_LIMITS):
+    hist, dhash, grid, category = _timed_features(image_path, decode_scale, False, METRICS, limits=limits,
+                                                  with_grid=True)
+
+    if category is not None:
+        logging.warning(f"Unable to read image '{image_path}' ({FAILURE_MESSAGES[category]})")
+
+    return grid
+
+# Function to compute the color histogram and dHash of an image held in memory.
+# Returns (None, None) if the data can't be decoded or is over the limits.
+def compute_buffer_features(data, decode_scale=1, metrics=METRICS, limits=DEFAULT_LIMITS):
+    with metrics.timer('decode'):
+        try:
+            image = decode_image_buffer(data, decode_scale, limits=limits)
+        except ImageTooLarge:
+            metrics.failure(FAILURE_TOO_LARGE)
+            return None, None
+
+    if image is None:
+        metrics.failure(FAILURE_DECODE_ERROR)
+        return None, None
+
+    with metrics.timer('histogram'):
+        hist = image_histogram(image)
+    with metrics.timer('dhash'):
+        dhash = image_dhash(image)
+
+    return hist, dhash
+
+# Function to yield the image files below a folder, in os.walk order, listing the folders
+# on scan threads ahead of the caller. Only listing time counts as walk time. With archives,
+# the images inside zip and tar archives are yielded too, by their virtual path.
+def iter_image_paths(search_folder, metrics=METRICS, threads=DEFAULT_SCAN_THREADS, archives=False):
+    for entry in DirectoryScanner(threads, metrics=metrics, archives=archives).scan(search_folder):
+        yield entry.path
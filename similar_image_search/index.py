@@ -0,0 +1,576 @@
+# Persistent on-disk histogram index
+#
+# An index is a directory holding the HSV histograms of every image below a
+# search folder, keyed by path, file size and modification time:
+#
+#   meta.json         format version, indexed root folder, decode scale, histogram precision,
+#                     entry count, a generation number that goes up whenever the entries change,
+#                     the [max_pixels, memory_budget] limits images were decoded within, whether
+#                     images inside archives are indexed and region grids stored and, for one
+#                     shard of a sharded index, its [number, count]
+#   paths.bin         image paths in os.walk order, as one UTF-8 blob
+#   path_offsets.npy  where every path starts in paths.bin, plus its total length (int64)
+#   sizes.npy         file sizes in bytes (int64)
+#   mtimes.npy        modification times in nanoseconds (int64)
+#   histograms.npy    one normalized 512-bin histogram per path (float32, float16 or uint8 codes)
+#   hashes.npy        64-bit dHash per path, computed from the same decode (uint64)
+#   regions.npy       only with regions: the 4x4 grid of cell histograms of every path (see regions.py)
+#   failed.json       files that could not be decoded, with their size and mtime
+#   dirs.json         mtime and subfolder names of every folder at the last refresh
+#   archives.json     size and mtime of every archive at the last refresh
+#
+# Refreshing an index only decodes files that are new or whose size or mtime
+# changed, and drops entries whose files were deleted. With
+# skip_unchanged_dirs, folders whose mtime did not change are not even listed;
+# see scanner.py for the changes that misses. Other files in the
+# directory, such as an approximate nearest-neighbour index built on top of it,
+# are kept when the index is saved again. Files that were over the limits are
+# kept as failed, and tried again once the index is refreshed with other limits.
+# Images inside zip and tar archives are indexed by their virtual path (see
+# archives.py) and refreshed like files, and an unchanged archive is not listed.
+#
+# Loading with mmap maps the arrays and the path table instead of reading them,
+# so a query scores straight off the page cache. On Windows, an index that a
+# process has mapped can't be replaced by another process until it is closed.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from .archives import ARCHIVE_ERRORS, ARCHIVE_SEPARATOR, is_archive, list_archive, member_path
+from .extract import extract_features
+from .features import HISTOGRAM_SIZE
+from .limits import DEFAULT_LIMITS, ImageLimits
+from .regions import GRID_CELLS, REGION_HISTOGRAM_SIZE
+from .scanner import (DEFAULT_SCAN_THREADS, IMAGE_EXTENSIONS, DirectoryScanner, ScanEntry, group_by_archive,
+                      group_by_directory)
+from .store import (PATH_OFFSETS_FILE, PATHS_FILE, PRECISIONS, PathTable, encode_histograms, load_path_table,
+                    parse_precision, save_path_table, stored_histograms, wrap_histograms)
+
+INDEX_VERSION = 2
+
+# Files written by every version of the index; anything else in an index directory is kept on save
+INDEX_FILES = ('meta.json', 'paths.json', PATHS_FILE, PATH_OFFSETS_FILE, 'sizes.npy', 'mtimes.npy', 'histograms.npy',
+               'hashes.npy', 'regions.npy', 'failed.json', 'dirs.json', 'archives.json')
+
+# Function to find which of num_shards hash shards an image belongs to. The hash is taken over
+# the path relative to the root folder, so the assignment survives moving or remounting the folder.
+# A CRC would be cheaper, but it is linear and puts numbered file names into the same few shards.
+def path_shard(image_path, root, num_shards):
+    relative_path = os.path.relpath(image_path, root).replace(os.sep, '/')
+    digest = hashlib.blake2b(relative_path.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % num_shards
+
+class FeatureIndex:
+    def __init__(self, root=None, decode_scale=1, precision='float32', shard=None, limits=DEFAULT_LIMITS,
+                 archives=False, regions=False):
+        self.root = root
+        self.decode_scale = decode_scale
+        self.precision = parse_precision(precision)
+        self.limits = limits
+        self.archives = archives
+
+        # (number, count) if the index only holds the images of one hash shard of its root folder
+        self.shard = tuple(shard) if shard else None
+        self.generation = 0
+        self.paths = []
+        self.sizes = np.empty(0, dtype=np.int64)
+        self.mtimes = np.empty(0, dtype=np.int64)
+        self.histograms = wrap_histograms(np.empty((0, HISTOGRAM_SIZE), dtype=PRECISIONS[precision]), precision)
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+        # (N, 16, 64) region grids if the index stores them, None if it doesn't (or they are missing)
+        self.regions = regions
+        self.grids = np.empty((0, GRID_CELLS, REGION_HISTOGRAM_SIZE), dtype=np.float32) if regions else None
+
+        # Files that failed to decode, mapped to their (size, mtime) so they
+        # are only retried once they change
+        self.failed = {}
+
+        # [mtime_ns, subfolder names] of every folder and [size, mtime_ns] of every archive at the last refresh
+        self.directories = {}
+        self.archive_stats = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Function to tell whether an image below the root folder belongs in this index
+    def owns(self, image_path):
+        return self.shard is None or path_shard(image_path, self.root, self.shard[1]) == self.shard[0]
+
+    # Function to load an index, memory-mapping its arrays and path table if mmap is set
+    @classmethod
+    def load(cls, index_path, mmap=False):
+        with open(os.path.join(index_path, 'meta.json'), 'r', encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+
+        # Version 1 indexes store the paths as JSON and float32 histograms, and are written as version 2 on save
+        if meta.get('version') not in (1, INDEX_VERSION):
+            raise ValueError(f"Unsupported index version {meta.get('version')} in '{index_path}'")
+
+        index = cls(meta.get('root'), meta.get('decode_scale', 1), meta.get('precision', 'float32'), meta.get('shard'))
+        index.generation = meta.get('generation', 0)
+        if meta.get('limits'):
+            index.limits = ImageLimits(*meta['limits'])
+        index.archives = meta.get('archives', False)
+        index.regions = meta.get('regions', False)
+
+        if meta['version'] == 1:
+            with open(os.path.join(index_path, 'paths.json'), 'r', encoding='utf-8') as paths_file:
+                index.paths = json.load(paths_file)
+        else:
+            index.paths = load_path_table(index_path, mmap)
+        with open(os.path.join(index_path, 'failed.json'), 'r', encoding='utf-8') as failed_file:
+            index.failed = {path: tuple(stat) for path, stat in json.load(failed_file).items()}
+        directories_path = os.path.join(index_path, 'dirs.json')
+        if os.path.exists(directories_path):
+            with open(directories_path, 'r', encoding='utf-8') as directories_file:
+                index.directories = json.load(directories_file)
+        archives_path = os.path.join(index_path, 'archives.json')
+        if os.path.exists(archives_path):
+            with open(archives_path, 'r', encoding='utf-8') as archives_file:
+                index.archive_stats = json.load(archives_file)
+
+        mmap_mode = 'r' if mmap else None
+        index.sizes = np.load(os.path.join(index_path, 'sizes.npy'), mmap_mode=mmap_mode)
+        index.mtimes = np.load(os.path.join(index_path, 'mtimes.npy'), mmap_mode=mmap_mode)
+        histograms = np.load(os.path.join(index_path, 'histograms.npy'), mmap_mode=mmap_mode)
+        if histograms.dtype != PRECISIONS[index.precision]:
+            raise ValueError(f"Index '{index_path}' stores {histograms.dtype} histograms, not {index.precision}")
+        index.histograms = wrap_histograms(histograms, index.precision)
+
+        # Indexes written before hashes were stored get them on their next refresh
+        hashes_path = os.path.join(index_path, 'hashes.npy')
+        index.hashes = np.load(hashes_path, mmap_mode=mmap_mode) if os.path.exists(hashes_path) else None
+
+        # Missing region grids are computed on the next refresh
+        regions_path = os.path.join(index_path, 'regions.npy')
+        index.grids = None
+        if index.regions and os.path.exists(regions_path):
+            index.grids = np.load(regions_path, mmap_mode=mmap_mode)
+
+        if not (len(index.paths) == len(index.sizes) == len(index.mtimes) == len(index.histograms) == meta['count']):
+            raise ValueError(f"Index '{index_path}' is inconsistent, rebuild it")
+
+        return index
+
+    # Function to read the arrays and path table of an index loaded with mmap into memory, so that its files
+    # can be replaced
+    def read_into_memory(self):
+        if isinstance(self.paths, PathTable):
+            self.paths = PathTable(bytes(self.paths.blob), np.array(self.paths.offsets))
+        self.sizes, self.mtimes = np.array(self.sizes), np.array(self.mtimes)
+        self.histograms = wrap_histograms(np.array(stored_histograms(self.histograms, self.precision)), self.precision)
+        if self.hashes is not None:
+            self.hashes = np.array(self.hashes)
+        if self.grids is not None:
+            self.grids = np.array(self.grids)
+
+    # Function to write the index, replacing any previous version at the same path
+    def save(self, index_path):
+        index_path = os.path.normpath(index_path)
+        tmp_path = index_path + '.tmp'
+        old_path = index_path + '.old'
+
+        for stale_path in (tmp_path, old_path):
+            if os.path.exists(stale_path):
+                shutil.rmtree(stale_path)
+        os.makedirs(tmp_path)
+
+        meta = {'version': INDEX_VERSION, 'root': self.root, 'decode_scale': self.decode_scale,
+                'precision': self.precision, 'count': len(self.paths), 'generation': self.generation,
+                'limits': list(self.limits), 'archives': self.archives, 'regions': self.regions}
+        if self.shard is not None:
+            meta['shard'] = list(self.shard)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        save_path_table(self.paths, tmp_path)
+        with open(os.path.join(tmp_path, 'failed.json'), 'w', encoding='utf-8') as failed_file:
+            json.dump(self.failed, failed_file)
+        with open(os.path.join(tmp_path, 'dirs.json'), 'w', encoding='utf-8') as directories_file:
+            json.dump(self.directories, directories_file)
+        with open(os.path.join(tmp_path, 'archives.json'), 'w', encoding='utf-8') as archives_file:
+            json.dump(self.archive_stats, archives_file)
+
+        np.save(os.path.join(tmp_path, 'sizes.npy'), self.sizes)
+        np.save(os.path.join(tmp_path, 'mtimes.npy'), self.mtimes)
+        np.save(os.path.join(tmp_path, 'histograms.npy'), stored_histograms(self.histograms, self.precision))
+        if self.hashes is not None:
+            np.save(os.path.join(tmp_path, 'hashes.npy'), self.hashes)
+        if self.regions and self.grids is not None:
+            np.save(os.path.join(tmp_path, 'regions.npy'), self.grids)
+
+        # Swap the new index into place, keeping the old one until the rename succeeded
+        if os.path.exists(index_path):
+            for name in os.listdir(index_path):
+                if name not in INDEX_FILES and not os.path.exists(os.path.join(tmp_path, name)):
+                    os.replace(os.path.join(index_path, name), os.path.join(tmp_path, name))
+            os.replace(index_path, old_path)
+        os.replace(tmp_path, index_path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    # Function to store the histograms at another precision, without decoding the images again
+    def set_precision(self, precision):
+        precision = parse_precision(precision)
+        if precision == self.precision:
+            return
+        if np.dtype(PRECISIONS[precision]).itemsize > np.dtype(PRECISIONS[self.precision]).itemsize and len(self.paths):
+            logging.warning(f"Histograms stored as {self.precision} keep that accuracy when stored as {precision}, "
+                            f"rebuild the index to recompute them")
+
+        self.histograms = wrap_histograms(stored_histograms(self.histograms, precision), precision)
+        self.precision = precision
+
+    # Function to stack the histograms of index entries in the stored precision. An entry holds
+    # either the row of an unchanged image in the current histograms or a new float32 histogram.
+    def _stack_histograms(self, rows):
+        stacked = np.empty((len(rows), HISTOGRAM_SIZE), dtype=PRECISIONS[self.precision])
+
+        kept = [j for j, row in enumerate(rows) if isinstance(row, (int, np.integer))]
+        if kept:
+            stacked[kept] = stored_histograms(self.histograms, self.precision)[[rows[j] for j in kept]]
+
+        new = [j for j, row in enumerate(rows) if not isinstance(row, (int, np.integer))]
+        if new:
+            stacked[new] = encode_histograms(np.vstack([rows[j] for j in new]), self.precision)
+
+        return wrap_histograms(stacked, self.precision)
+
+    # Function to stack the region grids of index entries, each either the row of an unchanged
+    # image in the current grids or a new grid
+    def _stack_grids(self, rows):
+        stacked = np.empty((len(rows), GRID_CELLS, REGION_HISTOGRAM_SIZE), dtype=np.float32)
+
+        kept = [j for j, row in enumerate(rows) if isinstance(row, (int, np.integer))]
+        if kept:
+            stacked[kept] = self.grids[[rows[j] for j in kept]]
+
+        new = [j for j, row in enumerate(rows) if not isinstance(row, (int, np.integer))]
+        if new:
+            stacked[new] = np.stack([rows[j] for j in new])
+
+        return stacked
+
+    # Function to bring the index in line with the files currently in the search folder. The folders
+    # are listed and the images stat'ed on scan_threads threads, readahead threads read the files
+    # to decode ahead of the decoders, and with skip_unchanged_dirs the images of folders whose
+    # mtime did not change since the last refresh are taken from the index without listing them.
+    # archives turns indexing the images inside archives on or off, and regions storing the region
+    # grids of the images (None keeps the current settings).
+    def refresh(self, search_folder=None, workers=1, decode_scale=None, precision=None,
+                scan_threads=DEFAULT_SCAN_THREADS, readahead=0, skip_unchanged_dirs=False, limits=None,
+                archives=None, regions=None):
+        if search_folder is None:
+            search_folder = self.root
+        if search_folder is None:
+            raise ValueError("No search folder given and the index has no root folder")
+
+        # Paths are stored absolute, so the index means the same from any working folder. A missing root
+        # (an unmounted share, a relative root seen from another folder) is an error rather than an empty folder.
+        search_folder = os.path.abspath(search_folder)
+        if not os.path.isdir(search_folder):
+            raise ValueError(f"Search folder '{search_folder}' does not exist")
+        self.root = search_folder
+
+        # Histograms decoded at another scale can't be mixed, so a new scale re-decodes everything
+        if decode_scale is not None and decode_scale != self.decode_scale:
+            if self.paths:
+                logging.warning(f"Decode scale changed from 1/{self.decode_scale} to 1/{decode_scale}, "
+                                f"recomputing all histograms")
+            self.decode_scale = decode_scale
+            self.paths = []
+            self.failed = {}
+            self.directories = {}
+            self.archive_stats = {}
+        if precision is not None:
+            self.set_precision(precision)
+
+        # Files that failed under other limits may decode now, so they are tried again
+        retry_failed = limits is not None and tuple(limits) != tuple(self.limits)
+        if limits is not None:
+            self.limits = ImageLimits(*limits)
+        if archives is not None:
+            self.archives = archives
+
+        # Region grids come from the same decode as the histograms, so turning them on decodes every image again
+        if regions is not None and regions != self.regions:
+            if regions and self.paths:
+                logging.warning(f"Region grids requested, decoding all {len(self.paths)} images again")
+            self.regions = regions
+            self.grids = None
+        regions_missing = self.regions and self.grids is None
+
+        known = {path: i for i, path in enumerate(self.paths)}
+        stats = {'unchanged': 0, 'added': 0, 'updated': 0, 'removed': 0, 'failed': 0}
+
+        known_files = None
+        known_archives = None
+        if skip_unchanged_dirs or (self.archives and self.archive_stats):
+            known_entries = ([ScanEntry(path, int(size), int(mtime))
+                              for path, size, mtime in zip(self.paths, self.sizes, self.mtimes)]
+                             + [ScanEntry(path, size, mtime) for path, (size, mtime) in self.failed.items()])
+            if skip_unchanged_dirs:
+                known_files = group_by_directory(known_entries)
+            if self.archives:
+                known_archives = group_by_archive(known_entries, self.archive_stats)
+        scanner = DirectoryScanner(scan_threads, with_stat=True, previous=self.directories, known_files=known_files,
+                                   archives=self.archives, known_archives=known_archives)
+
+        # Entries are [path, size, mtime, histogram, hash, is_new, grid], in os.walk order, where the
+        # histogram and grid of an unchanged image are its current row. Entries whose histogram is
+        # still None have to be decoded.
+        entries = []
+        pending = []
+        failed = {}
+
+        for image_path, size, mtime_ns in scanner.scan(search_folder):
+            if not self.owns(image_path):
+                continue
+
+            i = known.pop(image_path, None)
+            if (i is not None and self.hashes is not None and not regions_missing
+                    and self.sizes[i] == size and self.mtimes[i] == mtime_ns):
+                stats['unchanged'] += 1
+                entries.append([image_path, size, mtime_ns, i, self.hashes[i], False, i])
+            elif i is None and not retry_failed and self.failed.get(image_path) == (size, mtime_ns):
+                # Still the same broken file, don't try to decode it again
+                failed[image_path] = (size, mtime_ns)
+            else:
+                pending.append(len(entries))
+                entries.append([image_path, size, mtime_ns, None, None, i is None, None])
+
+        stats['removed'] = len(known)
+
+        # Decode the new and modified files
+        features = extract_features([entries[j][0] for j in pending], workers, decode_scale=self.decode_scale,
+                                    readahead=readahead, limits=self.limits, regions=self.regions)
+        histograms, hashes, ok = features[:3]
+        grids = features[3] if self.regions else [None] * len(pending)
+        for j, hist, dhash, decoded, grid in zip(pending, histograms, hashes, ok, grids):
+            entry = entries[j]
+            if decoded:
+                entry[3] = hist
+                entry[4] = dhash
+                entry[6] = grid
+                stats['added' if entry[5] else 'updated'] += 1
+            else:
+                stats['failed'] += 1
+                failed[entry[0]] = (entry[1], entry[2])
+
+        entries = [entry for entry in entries if entry[3] is not None]
+
+        # Without a changed row the current arrays are kept as they are, so a memory-mapped index
+        # stays mapped instead of being copied into memory
+        changed = stats['added'] or stats['updated'] or stats['removed']
+        if changed or [entry[3] for entry in entries] != list(range(len(self.paths))):
+            self.paths = [entry[0] for entry in entries]
+            self.sizes = np.array([entry[1] for entry in entries], dtype=np.int64)
+            self.mtimes = np.array([entry[2] for entry in entries], dtype=np.int64)
+            self.histograms = self._stack_histograms([entry[3] for entry in entries])
+            self.hashes = np.array([entry[4] for entry in entries], dtype=np.uint64)
+            self.grids = self._stack_grids([entry[6] for entry in entries]) if self.regions else None
+        self.failed = failed
+        self.directories = scanner.directories
+        self.archive_stats = scanner.archive_stats
+
+        if changed:
+            self.generation += 1
+
+        stats['folders_listed'] = scanner.listed
+        stats['folders_skipped'] = scanner.skipped
+        return stats
+
+    # Function to bring only the given files and folders in line with the disk, e.g. after a file
+    # system watcher reported them, without walking the rest of the search folder. Folders are
+    # re-synced with everything below them, and paths that no longer exist are dropped together
+    # with everything indexed below them. A changed archive is listed again and its members are
+    # treated like files. Like refresh, this assigns new arrays instead of writing into the
+    # current ones, so a copy of the index taken before stays consistent.
+    def update_paths(self, changed_paths, workers=1):
+        # Indexes without stored hashes or region grids need every image decoded again anyway
+        if self.hashes is None or (self.regions and self.grids is None):
+            return self.refresh(workers=workers)
+
+        known = {path: i for i, path in enumerate(self.paths)}
+        stats = {'unchanged': 0, 'added': 0, 'updated': 0, 'removed': 0, 'failed': 0}
+        removed = set()
+        failed = dict(self.failed)
+        archive_stats = dict(self.archive_stats)
+        candidates = {}
+
+        for changed_path in dict.fromkeys(changed_paths):
+            entries = []
+            if os.path.isdir(changed_path):
+                scanner = DirectoryScanner(with_stat=True, archives=self.archives)
+                entries = [entry for entry in scanner.scan(changed_path) if self.owns(entry.path)]
+                archive_stats.update(scanner.archive_stats)
+            elif os.path.isfile(changed_path):
+                if self.archives and is_archive(changed_path):
+                    entries = self._list_archive(changed_path, archive_stats)
+                elif changed_path.lower().endswith(IMAGE_EXTENSIONS) and self.owns(changed_path):
+                    try:
+                        st = os.stat(changed_path)
+                        entries = [ScanEntry(changed_path, st.st_size, st.st_mtime_ns)]
+                    except OSError as e:
+                        logging.warning(f"Unable to stat image '{changed_path}': {e}")
+            else:
+                archive_stats.pop(changed_path, None)
+            current = {entry.path for entry in entries}
+
+            # Drop the entries of files that are gone. Only folders, archives, or paths that were not
+            # indexed as files, can have entries below them, which takes a pass over all paths.
+            stale = [changed_path]
+            prefixes = []
+            if not os.path.isfile(changed_path) and changed_path not in known and changed_path not in failed:
+                prefixes.append(os.path.join(changed_path, ''))
+            if self.archives and is_archive(changed_path):
+                prefixes.append(changed_path + ARCHIVE_SEPARATOR)
+            for prefix in prefixes:
+                stale += [path for path in known if path.startswith(prefix)]
+                stale += [path for path in failed if path.startswith(prefix)]
+            for path in stale:
+                if path in current:
+                    continue
+                if path in known:
+                    removed.add(known[path])
+                failed.pop(path, None)
+
+            for entry in entries:
+                candidates[entry.path] = (entry.size, entry.mtime_ns)
+
+        # Rows to decode again as (path, size, mtime, row or None for new files)
+        pending = []
+        for image_path, (size, mtime_ns) in candidates.items():
+            i = known.get(image_path)
+            if i is not None and self.sizes[i] == size and self.mtimes[i] == mtime_ns:
+                stats['unchanged'] += 1
+            elif i is None and failed.get(image_path) == (size, mtime_ns):
+                continue
+            else:
+                pending.append((image_path, size, mtime_ns, i))
+
+        features = extract_features([entry[0] for entry in pending], workers, decode_scale=self.decode_scale,
+                                    limits=self.limits, regions=self.regions)
+        histograms, hashes, ok = features[:3]
+        pending_grids = features[3] if self.regions else [None] * len(pending)
+
+        updated = {}
+        added = []
+        for (image_path, size, mtime, i), hist, dhash, decoded, grid in zip(pending, histograms, hashes, ok,
+                                                                           pending_grids):
+            if not decoded:
+                stats['failed'] += 1
+                failed[image_path] = (size, mtime)
+                if i is not None:
+                    removed.add(i)
+            elif i is None:
+                stats['added'] += 1
+                failed.pop(image_path, None)
+                added.append((image_path, size, mtime, hist, dhash, grid))
+            else:
+                stats['updated'] += 1
+                updated[i] = (size, mtime, hist, dhash, grid)
+
+        stats['removed'] = len(removed - {i for image_path, size, mtime, i in pending if i is not None})
+
+        keep = np.ones(len(self.paths), dtype=bool)
+        keep[list(removed)] = False
+        new_rows = np.cumsum(keep) - 1
+
+        sizes, mtimes = self.sizes[keep], self.mtimes[keep]
+        histograms, hashes = stored_histograms(self.histograms, self.precision)[keep], self.hashes[keep]
+        grids = self.grids[keep] if self.regions else None
+        for i, (size, mtime, hist, dhash, grid) in updated.items():
+            sizes[new_rows[i]], mtimes[new_rows[i]] = size, mtime
+            histograms[new_rows[i]], hashes[new_rows[i]] = encode_histograms(hist, self.precision), dhash
+            if grids is not None:
+                grids[new_rows[i]] = grid
+
+        # New files go to the end, their place in os.walk order doesn't matter for searching
+        self.paths = [path for path, kept in zip(self.paths, keep) if kept] + [entry[0] for entry in added]
+        if added:
+            sizes = np.concatenate([sizes, np.array([entry[1] for entry in added], dtype=np.int64)])
+            mtimes = np.concatenate([mtimes, np.array([entry[2] for entry in added], dtype=np.int64)])
+            added_histograms = encode_histograms(np.vstack([entry[3] for entry in added]), self.precision)
+            histograms = np.vstack([histograms, added_histograms])
+            hashes = np.concatenate([hashes, np.array([entry[4] for entry in added], dtype=np.uint64)])
+            if grids is not None:
+                grids = np.concatenate([grids, np.stack([entry[5] for entry in added])])
+        self.sizes, self.mtimes, self.hashes, self.grids = sizes, mtimes, hashes, grids
+        self.histograms = wrap_histograms(histograms, self.precision)
+        self.failed = failed
+        self.archive_stats = archive_stats
+
+        if stats['added'] or stats['updated'] or stats['removed'] or removed:
+            self.generation += 1
+
+        return stats
+
+    # Function to list the images in an archive as ScanEntry tuples, recording its size and mtime
+    # in archive_stats. Returns no entries if the archive can't be read.
+    def _list_archive(self, archive_path, archive_stats):
+        try:
+            st = os.stat(archive_path)
+            members = list_archive(archive_path)
+        except ARCHIVE_ERRORS as e:
+            logging.warning(f"Unable to list archive '{archive_path}': {e}")
+            archive_stats.pop(archive_path, None)
+            return []
+
+        archive_stats[archive_path] = [st.st_size, st.st_mtime_ns]
+        return [ScanEntry(member_path(archive_path, name), size, mtime_ns) for name, size, mtime_ns in members
+                if name.lower().endswith(IMAGE_EXTENSIONS) and self.owns(member_path(archive_path, name))]
+
+# Function to read the generation of an index from its meta.json without loading the index
+def index_generation(index_path):
+    with open(os.path.join(index_path, 'meta.json'), 'r', encoding='utf-8') as meta_file:
+        return json.load(meta_file).get('generation', 0)
+
+# Function to create a new index for a folder from scratch
+def build_index(search_folder, index_path, workers=1, decode_scale=1, precision='float32',
+                scan_threads=DEFAULT_SCAN_THREADS, readahead=0, limits=None, archives=False, regions=False):
+    index = FeatureIndex(search_folder, decode_scale, precision, limits=limits or DEFAULT_LIMITS, archives=archives,
+                         regions=regions)
+    stats = index.refresh(workers=workers, scan_threads=scan_threads, readahead=readahead)
+    index.save(index_path)
+    return index, stats
+
+# Function to capture what saving an index writes besides its arrays, which only change along with the generation
+def _saved_state(index):
+    return (index.generation, index.root, index.decode_scale, index.precision, tuple(index.limits), index.archives,
+            index.regions, dict(index.failed), dict(index.directories), dict(index.archive_stats))
+
+# Function to load an index if it exists, refresh it against the folder and save it if anything changed.
+# Without a decode scale, precision, limits, archives or regions setting, an existing index keeps
+# the ones it was built with. With keep_root, as for searches, an existing index is refreshed against
+# its own root folder even if another folder is given, so it never loses the images outside that folder.
+# With mmap, an existing index is memory-mapped, so a search that finds nothing new scores straight off the
+# page cache without reading or writing the index.
+def update_index(index_path, search_folder=None, workers=1, decode_scale=None, precision=None,
+                 scan_threads=DEFAULT_SCAN_THREADS, readahead=0, skip_unchanged_dirs=False, limits=None,
+                 archives=None, regions=None, keep_root=False, mmap=False):
+    if os.path.isdir(index_path):
+        index = FeatureIndex.load(index_path, mmap)
+        if keep_root and search_folder is not None and index.root is not None:
+            if os.path.abspath(search_folder) != os.path.abspath(index.root):
+                logging.warning(f"Index '{index_path}' holds the images of '{index.root}', searching those "
+                                f"instead of '{search_folder}'")
+            search_folder = None
+        state = _saved_state(index)
+    else:
+        index = FeatureIndex(search_folder)
+        state = None
+    stats = index.refresh(search_folder, workers, decode_scale, precision, scan_threads, readahead, skip_unchanged_dirs,
+                          limits, archives, regions)
+
+    # Repeat searches against an unchanged folder don't rewrite the whole index
+    if _saved_state(index) != state:
+        if mmap:
+            index.read_into_memory()
+        index.save(index_path)
+    return index, stats
@@ -0,0 +1,145 @@
+# Decode limits for very large and hostile images
+#
+# cv2.imread allocates the whole decoded image, 3 bytes per pixel, before
+# anything can look at it, and the HSV conversion used to allocate a second
+# copy of the same size. One 20000x20000 scan, or a decompression-bomb PNG of
+# a few kB that claims billions of pixels, is enough to push a worker out of
+# memory and take the whole batch with it. So the dimensions are read from the
+# file header first, without decoding anything, and checked against the limits:
+#
+#   max_pixels     images with more pixels are never decoded
+#   memory_budget  bytes the decoded image and one strip of its HSV copy may
+#                  take. JPEG files over it are decoded at 1/2, 1/4 or 1/8
+#                  scale in the DCT domain instead. Other formats over it are
+#                  rejected only when a budget was given; without one they
+#                  are decoded in full as before, and DEFAULT_MEMORY_BUDGET
+#                  only picks the JPEG scale and caps archive members.
+#
+# The whole BGR image is still decoded and allocated at once, only the HSV
+# conversion and calcHist run strip by strip (see features.image_histogram),
+# so only STRIP_PIXELS of HSV exist at any time and the peak memory of a
+# worker is the decoded image plus one strip. Files whose header can't be
+# read are left to the decoder, which still applies OpenCV's own pixel limit.
+
+import struct
+from collections import namedtuple
+
+from .options import DECODE_SCALES, DEFAULT_MAX_PIXELS, DEFAULT_MEMORY_BUDGET
+
+ImageLimits = namedtuple('ImageLimits', ['max_pixels', 'memory_budget'])
+
+# No memory budget means DEFAULT_MEMORY_BUDGET, without rejecting anything over it
+DEFAULT_LIMITS = ImageLimits(DEFAULT_MAX_PIXELS, None)
+
+# Number of pixels converted to HSV and counted at a time
+STRIP_PIXELS = 1 << 22
+
+# JPEG start-of-frame markers, which hold the image dimensions (all but DHT, JPG and DAC)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+class ImageTooLarge(ValueError):
+    pass
+
+# Function to read the (width, height) of a JPEG, PNG, BMP or WebP image from the header of a binary
+# file object positioned at its start, without decoding it. Returns None for other or broken headers.
+def probe_image_size(stream):
+    header = stream.read(30)
+
+    if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR' and len(header) >= 24:
+        return struct.unpack('>II', header[16:24])
+
+    if header.startswith(b'BM') and len(header) >= 26:
+        (dib_size,) = struct.unpack('<I', header[14:18])
+        if dib_size == 12:
+            return struct.unpack('<HH', header[18:22])
+        # Bottom-up bitmaps have a positive height, top-down ones a negative one
+        width, height = struct.unpack('<ii', header[18:26])
+        return abs(width), abs(height)
+
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP' and len(header) >= 30:
+        chunk = header[12:16]
+        if chunk == b'VP8 ':
+            width, height = struct.unpack('<HH', header[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b'VP8L':
+            (bits,) = struct.unpack('<I', header[21:25])
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b'VP8X':
+            return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+        return None
+
+    if header.startswith(b'\xff\xd8'):
+        stream.seek(-len(header) + 2, 1)
+        return _probe_jpeg(stream)
+
+    return None
+
+# Function to walk the marker segments of a JPEG file up to its start-of-frame, skipping
+# metadata such as EXIF thumbnails without reading them
+def _probe_jpeg(stream):
+    while True:
+        if stream.read(1) != b'\xff':
+            return None
+        marker = stream.read(1)
+        while marker == b'\xff':
+            marker = stream.read(1)
+        if not marker:
+            return None
+
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            # Markers without a segment
+            continue
+        if code in (0xD9, 0xDA):
+            # End of image or start of scan before any frame header
+            return None
+
+        length = stream.read(2)
+        if len(length) < 2:
+            return None
+
+        if code in JPEG_SOF_MARKERS:
+            frame = stream.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            # A height of 0 is only given later in the scan, which isn't worth parsing for
+            return (width, height) if height else None
+
+        stream.seek(struct.unpack('>H', length)[0] - 2, 1)
+
+# Function to get the memory budget of the limits, DEFAULT_MEMORY_BUDGET if they don't set one,
+# or None without limits
+def budget_bytes(limits):
+    if limits is None:
+        return None
+    return limits.memory_budget or DEFAULT_MEMORY_BUDGET
+
+# Function to estimate the peak bytes of decoding a width x height image at 1/decode_scale and
+# computing its histogram: the decoded BGR image, one strip of its HSV copy, and for formats
+# other than JPEG the full-size decode the image is shrunk from
+def decode_bytes(width, height, decode_scale=1, jpeg=True):
+    pixels = -(-width // decode_scale) * -(-height // decode_scale)
+    peak = pixels * 3 + min(pixels, STRIP_PIXELS) * 3
+    if not jpeg and decode_scale > 1:
+        peak += width * height * 3
+    return peak
+
+# Function to pick the scale to decode a width x height image at: the requested one, or for JPEG
+# files the first smaller one that fits the memory budget. Raises ImageTooLarge if the image has
+# more pixels than allowed, or if no scale fits a budget that was given; without one the smallest
+# scale is used.
+def fit_decode_scale(width, height, decode_scale=1, jpeg=True, limits=DEFAULT_LIMITS):
+    if width * height > limits.max_pixels:
+        raise ImageTooLarge(f"{width}x{height} pixels, more than the limit of {limits.max_pixels}")
+
+    scales = [scale for scale in (DECODE_SCALES if jpeg else (decode_scale,)) if scale >= decode_scale]
+    for scale in scales:
+        if decode_bytes(width, height, scale, jpeg) <= budget_bytes(limits):
+            return scale
+
+    if limits.memory_budget is None:
+        return scales[-1] if scales else decode_scale
+
+    raise ImageTooLarge(f"{width}x{height} pixels, needs more than the memory budget of "
+                        f"{limits.memory_budget >> 20} MB to decode")
@@ -0,0 +1,197 @@
+# Counters and stage timers for the search pipeline
+#
+# Every stage (walk, decode, histogram, dhash, score, rank, ...) adds its time
+# and the number of items it handled to the process-wide METRICS, and images
+# that can't be used are tallied by failure category. Worker processes record
+# into their own Metrics and send a snapshot back with their results, which
+# the parent merges. A summary can be written as JSON or in the Prometheus
+# text exposition format, and a cProfile run can be wrapped around a command.
+
+import io
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Why an image could not be used
+FAILURE_UNREADABLE = 'unreadable'
+FAILURE_UNSUPPORTED_FORMAT = 'unsupported_format'
+FAILURE_DECODE_ERROR = 'decode_error'
+FAILURE_TOO_LARGE = 'too_large'
+FAILURE_MESSAGES = {
+    FAILURE_UNREADABLE: 'unreadable file',
+    FAILURE_UNSUPPORTED_FORMAT: 'unsupported format',
+    FAILURE_DECODE_ERROR: 'decode error',
+    FAILURE_TOO_LARGE: 'over the pixel or memory limit',
+}
+
+METRIC_PREFIX = 'similar_image_search'
+
+# Whether a stage mostly waits for the disk or keeps a CPU busy. Decoding without readahead also
+# reads the file, so it only counts as CPU time when the files were read ahead.
+IO_STAGES = ('walk', 'read')
+CPU_STAGES = ('decode', 'histogram', 'dhash', 'score', 'rank')
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.failures = {}
+        self.timers = {}  # stage -> [calls, items, seconds]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def failure(self, category):
+        with self.lock:
+            self.failures[category] = self.failures.get(category, 0) + 1
+
+    def add_time(self, stage, seconds, items=1, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0, 0.0])
+            timer[0] += calls
+            timer[1] += items
+            timer[2] += seconds
+
+    @contextmanager
+    def timer(self, stage, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, items)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters': dict(self.counters), 'failures': dict(self.failures),
+                    'timers': {stage: list(timer) for stage, timer in self.timers.items()}}
+
+    # Function to add a snapshot taken in another process (or another Metrics)
+    def merge(self, snapshot):
+        with self.lock:
+            for name, n in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for category, n in snapshot['failures'].items():
+                self.failures[category] = self.failures.get(category, 0) + n
+            for stage, (calls, items, seconds) in snapshot['timers'].items():
+                timer = self.timers.setdefault(stage, [0, 0, 0.0])
+                timer[0] += calls
+                timer[1] += items
+                timer[2] += seconds
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters.clear()
+            self.failures.clear()
+            self.timers.clear()
+
+    # Function to build the machine-readable summary, with per-stage throughput
+    def summary(self):
+        snapshot = self.snapshot()
+        stages = {}
+        for stage, (calls, items, seconds) in snapshot['timers'].items():
+            stages[stage] = {'calls': calls, 'items': items, 'seconds': round(seconds, 6),
+                             'items_per_sec': round(items / seconds, 2) if seconds > 0 else None}
+
+        return {'uptime_seconds': round(time.time() - self.started, 3), 'counters': snapshot['counters'],
+                'failures': snapshot['failures'], 'failed': sum(snapshot['failures'].values()), 'stages': stages,
+                'time_breakdown': self.time_breakdown()}
+
+    # Function to split the stage time into I/O and CPU seconds. Stages running on several threads
+    # or processes add up their time, so these are thread-seconds rather than wall-clock seconds.
+    def time_breakdown(self):
+        with self.lock:
+            timers = {stage: timer[2] for stage, timer in self.timers.items()}
+        return {'io_seconds': round(sum(timers.get(stage, 0.0) for stage in IO_STAGES), 6),
+                'cpu_seconds': round(sum(timers.get(stage, 0.0) for stage in CPU_STAGES), 6),
+                'decode_includes_io': 'read' not in timers and 'decode' in timers}
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    # Function to render the metrics in the Prometheus text exposition format
+    def to_prometheus(self, prefix=METRIC_PREFIX):
+        snapshot = self.snapshot()
+        lines = []
+
+        for name, n in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {n}")
+
+        lines.append(f"# TYPE {prefix}_failures_total counter")
+        for category, n in sorted(snapshot['failures'].items()):
+            lines.append(f'{prefix}_failures_total{{category="{category}"}} {n}')
+
+        for suffix, column in (('calls', 0), ('items', 1), ('seconds', 2)):
+            lines.append(f"# TYPE {prefix}_stage_{suffix}_total counter")
+            for stage, timer in sorted(snapshot['timers'].items()):
+                lines.append(f'{prefix}_stage_{suffix}_total{{stage="{stage}"}} {timer[column]}')
+
+        lines.append(f"# TYPE {prefix}_uptime_seconds gauge")
+        lines.append(f"{prefix}_uptime_seconds {time.time() - self.started:.3f}")
+        return '\n'.join(lines) + '\n'
+
+    # Function to write the summary to a file, in Prometheus format for a .prom file and JSON otherwise
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.to_prometheus() if path.lower().endswith('.prom') else self.to_json())
+
+# Metrics of this process
+METRICS = Metrics()
+
+# Function to run a block under cProfile, writing the raw stats to output_path (for pstats or
+# snakeviz) and printing the functions with the highest cumulative time
+@contextmanager
+def profiled(output_path, top=25):
+    # Only imported when profiling, as they take longer to load than the rest of this module
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(top)
+        print(f"{text.getvalue()}Profile written to '{output_path}'")
+
+# Function to describe where the time went, e.g. "I/O 12.3 s, CPU 45.6 s (thread-seconds)"
+def format_time_breakdown(metrics=METRICS):
+    breakdown = metrics.time_breakdown()
+    note = ", decoding includes reading the files" if breakdown['decode_includes_io'] else ""
+    return f"I/O {breakdown['io_seconds']:.2f} s, CPU {breakdown['cpu_seconds']:.2f} s (thread-seconds{note})"
+
+# Function to describe how many images could not be used, by failure category. Returns None
+# if every image could be used.
+def failure_summary(metrics=METRICS):
+    failures = metrics.snapshot()['failures']
+    if not failures:
+        return None
+
+    details = ", ".join(f"{FAILURE_MESSAGES.get(category, category)}: {n}" for category, n in sorted(failures.items()))
+    return f"{sum(failures.values())} images could not be used ({details})"
+
+# Function to run a command with optional profiling, writing the metrics summary to metrics_path
+# (if given) and reporting failures once it is done, also when it fails
+@contextmanager
+def instrumented(metrics_path=None, profile_path=None):
+    profiler = profiled(profile_path) if profile_path else nullcontext()
+    try:
+        with profiler:
+            yield METRICS
+    finally:
+        summary = failure_summary()
+        if summary:
+            logging.warning(summary)
+            print(summary)
+        if metrics_path:
+            METRICS.write(metrics_path)
+            print(f"Metrics written to '{metrics_path}'")
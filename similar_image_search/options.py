@@ -0,0 +1,80 @@
+# Option defaults and parsers shared by the front-ends
+#
+# Only uses the standard library, so a front-end can build its argument parser
+# (and answer --help) without loading OpenCV, NumPy or the HTTP modules.
+
+# Where the search service listens by default
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+# Supported --decode-scale denominators (1 decodes at full resolution)
+DECODE_SCALES = (1, 2, 4, 8)
+
+# Precisions a feature index can store its histograms in (see store.PRECISIONS for their dtypes)
+PRECISION_NAMES = ('float32', 'float16', 'uint8')
+
+# Number of first-stage candidates re-ranked by default
+DEFAULT_CANDIDATES = 200
+
+# Number of threads listing folders
+DEFAULT_SCAN_THREADS = 8
+
+# Images with more pixels are never decoded (the same limit OpenCV applies on its own)
+DEFAULT_MAX_PIXELS = 1 << 30
+
+# Bytes one worker may allocate to decode an image and compute its histogram
+DEFAULT_MEMORY_BUDGET = 512 << 20
+
+# Cells per side of the grid of region histograms (see regions.py)
+GRID_SIZE = 4
+
+# Multipliers of the size suffixes accepted by parse_byte_size
+BYTE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Function to turn a decode scale such as "1/4" (or "4") into its denominator
+def parse_decode_scale(value):
+    text = str(value).strip()
+    if text.startswith('1/'):
+        text = text[2:]
+
+    try:
+        decode_scale = int(text)
+    except ValueError:
+        decode_scale = None
+
+    if decode_scale not in DECODE_SCALES:
+        raise ValueError(f"Unsupported decode scale '{value}', use one of 1, 1/2, 1/4 or 1/8")
+
+    return decode_scale
+
+# Function to turn a size such as "512M", "2G" or "1048576" into a number of bytes
+def parse_byte_size(value):
+    text = str(value).strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in BYTE_UNITS else ''
+
+    try:
+        size = float(text[:len(text) - len(unit)]) * BYTE_UNITS[unit]
+    except ValueError:
+        size = 0
+
+    if size <= 0:
+        raise ValueError(f"Invalid size '{value}', use a number of bytes or e.g. 512M or 2G")
+
+    return int(size)
+
+# Function to turn a region such as "0,0,2,2" (LEFT,TOP,RIGHT,BOTTOM in grid cells, right and bottom
+# exclusive) into a tuple of cell coordinates
+def parse_region(value):
+    try:
+        region = tuple(int(part) for part in str(value).split(','))
+    except ValueError:
+        region = ()
+
+    if len(region) != 4 or not (0 <= region[0] < region[2] <= GRID_SIZE and 0 <= region[1] < region[3] <= GRID_SIZE):
+        raise ValueError(f"Invalid region '{value}', use LEFT,TOP,RIGHT,BOTTOM in cells of the {GRID_SIZE}x{GRID_SIZE} "
+                         f"grid, e.g. 0,0,2,2 for the top left quarter")
+
+    return region
@@ -0,0 +1,75 @@
+# Hamming-distance index over the 64-bit dHashes
+#
+# Multi-index hashing: every hash is split into four 16-bit chunks and the
+# index keeps one sorted table per chunk. If two hashes are within Hamming
+# distance r, at least one of their chunks is within r // 4 bits (pigeonhole
+# principle), so a query only has to look up the chunk values within r // 4
+# bits of its own chunks and then check the full distance of those candidates.
+
+from itertools import combinations
+
+import numpy as np
+
+HASH_BITS = 64
+CHUNK_BITS = 16
+N_CHUNKS = HASH_BITS // CHUNK_BITS
+
+# Number of set bits of every byte value
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Function to compute the Hamming distance between one hash and every hash of an array
+def hamming_distances(dhash, hashes):
+    xor = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(dhash))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+# Function to list every 16-bit value within max_bits bit flips of a chunk value
+def _chunk_neighbours(value, max_bits):
+    neighbours = [value]
+    for n_bits in range(1, max_bits + 1):
+        for bits in combinations(range(CHUNK_BITS), n_bits):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            neighbours.append(flipped)
+    return np.array(neighbours, dtype=np.uint16)
+
+class HashIndex:
+    def __init__(self, hashes):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+
+        # Per chunk, the rows sorted by chunk value and the sorted values for searchsorted
+        self.chunk_rows = []
+        self.chunk_values = []
+        for c in range(N_CHUNKS):
+            values = self._chunk(self.hashes, c)
+            rows = np.argsort(values, kind='stable')
+            self.chunk_rows.append(rows)
+            self.chunk_values.append(values[rows])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def _chunk(hashes, c):
+        return ((hashes >> np.uint64(c * CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+
+    # Function to find the rows whose hash is within the Hamming radius of the query hash.
+    # Returns the rows in index order and their distances.
+    def query(self, dhash, radius):
+        dhash = np.uint64(dhash)
+        max_bits = radius // N_CHUNKS
+
+        candidates = []
+        for c in range(N_CHUNKS):
+            values = _chunk_neighbours(int(self._chunk(dhash, c)), max_bits)
+            starts = np.searchsorted(self.chunk_values[c], values, side='left')
+            ends = np.searchsorted(self.chunk_values[c], values, side='right')
+            candidates.extend(self.chunk_rows[c][start:end] for start, end in zip(starts, ends) if end > start)
+
+        if not candidates:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        rows = np.unique(np.concatenate(candidates))
+        distances = hamming_distances(dhash, self.hashes[rows])
+        keep = distances <= radius
+        return rows[keep], distances[keep]
@@ -0,0 +1,37 @@
+# Ranking the entries of a loaded feature index against one input image
+#
+# Shared by the command line and the search service, so both give the same
+# results for the same options: an exact scan by default, only the images
+# near the input's perceptual hash with a hash radius, or only the closest
+# inverted lists of the IVF with a number of probes.
+
+from .phash import HashIndex
+from .scoring import similarity_scores, top_k
+
+# Function to find the best matches of an input image in an index. Returns (row, score) pairs,
+# best first. A prebuilt hash_index is reused if given; probes needs the IVF of the index.
+def search_index(index, input_hist, input_hash=None, threshold=0.005, num_similar=5, probes=None, hash_radius=None,
+                 ivf=None, hash_index=None):
+    if hash_radius is not None:
+        if index.hashes is None or input_hash is None:
+            raise ValueError("The index holds no perceptual hashes yet, update it to use a hash radius")
+        if hash_index is None:
+            hash_index = HashIndex(index.hashes)
+
+        # Only rank the images whose perceptual hash is within the Hamming radius of the input image
+        rows, distances = hash_index.query(input_hash, hash_radius)
+        scores = similarity_scores(input_hist, index.histograms[rows])
+        return [(int(rows[i]), float(scores[i])) for i in top_k(scores, num_similar, threshold)]
+
+    if probes:
+        if ivf is None:
+            raise ValueError("Probing inverted lists needs the IVF of the index, build it first")
+
+        # Only score the images in the inverted lists closest to the input image
+        return ivf.search(input_hist, index.histograms, threshold, num_similar, probes)
+
+    # Calculate the similarity scores of all images in one vectorized pass
+    scores = similarity_scores(input_hist, index.histograms)
+
+    # Pick the best images that meet the similarity threshold, sorted by similarity
+    return [(int(i), float(scores[i])) for i in top_k(scores, num_similar, threshold)]
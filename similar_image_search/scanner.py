@@ -0,0 +1,240 @@
+# Directory scanning and file readahead
+#
+# os.walk lists one directory after the other, and the index refresh then stats
+# every image on its own, so on a network share the CPUs wait for the disk and
+# the disk waits for the next request. The scanner lists directories with
+# os.scandir on a pool of threads: the next directories in walk order (and the
+# stats of their images) are always in flight while the caller works through
+# the current one, and the images still come out in os.walk order. Only a
+# bounded number of listings is held ahead of the caller.
+#
+# Scanning for an index also records the mtime and subdirectories of every
+# directory. Adding, removing or renaming a file changes the mtime of its
+# directory, so a later scan can skip listing (and stat'ing the images of) a
+# directory whose mtime is unchanged and take its images from the index.
+# Writing into an existing file in place does not touch the directory, so
+# such changes are only seen by a full scan.
+#
+# With archives, the images inside zip and tar archives are listed along with
+# the files of their folder (see archives.py). A scan with stats records the
+# size and mtime of every archive, and an archive that did not change is not
+# listed again.
+#
+# iter_file_buffers reads the bytes of files on another pool of threads ahead
+# of the decoders, which then decode from memory with cv2.imdecode.
+
+import logging
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .archives import ARCHIVE_ERRORS, is_archive, list_archive, member_path, split_archive_path
+from .metrics import METRICS
+from .options import DEFAULT_SCAN_THREADS
+
+# File extensions that are treated as images when walking a search folder
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+# Number of directory listings held ahead of the caller per scan thread
+LISTINGS_PER_THREAD = 4
+
+# An image file found by a scan; size and mtime_ns are None unless the scan stats its images
+ScanEntry = namedtuple('ScanEntry', ['path', 'size', 'mtime_ns'])
+
+class DirectoryScanner:
+    # previous maps directories to the [mtime_ns, subdirectory names] of an earlier scan, and
+    # known_files maps directories to the ScanEntry list of their images at that time. Directories
+    # found in both with an unchanged mtime are not listed again. With archives, the images in
+    # archives are listed too; known_archives maps archives to the [size, mtime_ns] and ScanEntry
+    # list of their images at an earlier scan, and archives found there unchanged are not listed again.
+    def __init__(self, threads=DEFAULT_SCAN_THREADS, with_stat=False, previous=None, known_files=None,
+                 metrics=METRICS, archives=False, known_archives=None):
+        self.threads = max(1, threads)
+        self.with_stat = with_stat
+        self.previous = previous or {}
+        self.known_files = known_files
+        self.metrics = metrics
+        self.archives = archives
+        self.known_archives = known_archives or {}
+
+        # Filled in by a scan with stats: [mtime_ns, subdirectory names] of every directory,
+        # and [size, mtime_ns] of every archive
+        self.directories = {}
+        self.archive_stats = {}
+        self.listed = 0
+        self.skipped = 0
+
+    # Function to list one directory, or take it from the previous scan if it did not change.
+    # Returns (mtime_ns, subdirectory names, image entries, skipped); the mtime is None without stats.
+    def _list(self, folder):
+        start = time.perf_counter()
+        mtime_ns = None
+        try:
+            if self.with_stat:
+                # Taken before listing, so a change made while listing shows up in the next scan
+                mtime_ns = os.stat(folder).st_mtime_ns
+                previous = self.previous.get(folder)
+                if previous is not None and previous[0] == mtime_ns and self.known_files is not None:
+                    files = self.known_files.get(folder, [])
+                    for entry in files:
+                        archive_path, name = split_archive_path(entry.path)
+                        if name is not None and archive_path in self.known_archives:
+                            self.archive_stats[archive_path] = self.known_archives[archive_path][0]
+                    self.metrics.add_time('walk', time.perf_counter() - start, items=len(files))
+                    return mtime_ns, previous[1], files, True
+
+            subdirs, files = [], []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    # Like os.walk: symbolic links to folders are listed as folders but not followed
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    if self.archives and is_archive(entry.name):
+                        files.extend(self._list_archive(entry))
+                        continue
+                    if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+
+                    if not self.with_stat:
+                        files.append(ScanEntry(entry.path, None, None))
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError as e:
+                        logging.warning(f"Unable to stat image '{entry.path}': {e}")
+                        continue
+                    files.append(ScanEntry(entry.path, st.st_size, st.st_mtime_ns))
+        except OSError as e:
+            logging.warning(f"Unable to list folder '{folder}': {e}")
+            mtime_ns, subdirs, files = None, [], []
+
+        self.metrics.add_time('walk', time.perf_counter() - start, items=len(files))
+        return mtime_ns, subdirs, files, False
+
+    # Function to list the images in an archive, or take them from the previous scan if the archive
+    # did not change
+    def _list_archive(self, entry):
+        if self.with_stat:
+            try:
+                st = entry.stat()
+            except OSError as e:
+                logging.warning(f"Unable to stat archive '{entry.path}': {e}")
+                return []
+            self.archive_stats[entry.path] = [st.st_size, st.st_mtime_ns]
+
+            known = self.known_archives.get(entry.path)
+            if known is not None and known[0] == [st.st_size, st.st_mtime_ns]:
+                return known[1]
+
+        try:
+            members = list_archive(entry.path)
+        except ARCHIVE_ERRORS as e:
+            logging.warning(f"Unable to list archive '{entry.path}': {e}")
+            return []
+
+        return [ScanEntry(member_path(entry.path, name), size, mtime_ns) if self.with_stat
+                else ScanEntry(member_path(entry.path, name), None, None)
+                for name, size, mtime_ns in members if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+    # Function to yield the image files below a folder, in os.walk order
+    def scan(self, search_folder):
+        window = self.threads * LISTINGS_PER_THREAD
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='scan') as executor:
+            # Folders still to visit, one deque per level of the walk, and the listings in flight
+            stack = [deque([search_folder])]
+            listings = {}
+
+            def prefetch():
+                for level in reversed(stack):
+                    for folder in level:
+                        if len(listings) >= window:
+                            return
+                        if folder not in listings:
+                            listings[folder] = executor.submit(self._list, folder)
+
+            try:
+                while stack:
+                    if not stack[-1]:
+                        stack.pop()
+                        continue
+
+                    folder = stack[-1].popleft()
+                    if folder not in listings:
+                        listings[folder] = executor.submit(self._list, folder)
+                    prefetch()
+                    mtime_ns, subdirs, files, skipped = listings.pop(folder).result()
+
+                    if skipped:
+                        self.skipped += 1
+                    else:
+                        self.listed += 1
+                    if mtime_ns is not None:
+                        self.directories[folder] = [mtime_ns, subdirs]
+
+                    stack.append(deque(os.path.join(folder, name) for name in subdirs))
+                    prefetch()
+                    yield from files
+            finally:
+                for listing in listings.values():
+                    listing.cancel()
+
+# Function to group scan entries by directory, for DirectoryScanner's known_files. Archive
+# members go with the directory of their archive.
+def group_by_directory(entries):
+    known_files = {}
+    for entry in entries:
+        known_files.setdefault(os.path.dirname(split_archive_path(entry.path)[0]), []).append(entry)
+    return known_files
+
+# Function to group the archive members among scan entries by archive, for DirectoryScanner's
+# known_archives, given the [size, mtime_ns] of every archive
+def group_by_archive(entries, archive_stats):
+    known_archives = {}
+    for entry in entries:
+        archive_path, name = split_archive_path(entry.path)
+        if name is not None and archive_path in archive_stats:
+            known_archives.setdefault(archive_path, (archive_stats[archive_path], []))[1].append(entry)
+    return known_archives
+
+# Function to read a file, timing the read. Returns None if it can't be read; archive members
+# are left to read_archive_members, which reads them in order.
+def _read_file(path, metrics):
+    if split_archive_path(path)[1] is not None:
+        return None
+
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+    except OSError:
+        data = None
+    metrics.add_time('read', time.perf_counter() - start)
+    if data is not None:
+        metrics.count('bytes_read', len(data))
+    return data
+
+# Function to yield (path, bytes) for the given paths in order, reading up to depth files ahead
+# on a pool of threads. The bytes are None for files that can't be read.
+def iter_file_buffers(paths, threads=4, depth=None, metrics=METRICS):
+    depth = depth or threads * 4
+    with ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='readahead') as executor:
+        pending = deque()
+        try:
+            for path in paths:
+                pending.append((path, executor.submit(_read_file, path, metrics)))
+                if len(pending) >= depth:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            for path, future in pending:
+                future.cancel()
@@ -0,0 +1,102 @@
+# Similarity scoring and ranking
+#
+# The corpus histograms are scored as one (N, 512) matrix instead of calling
+# cv2.compareHist once per image, and the best matches are picked with
+# np.partition so only the top k candidates are ever sorted.
+
+import cv2
+import numpy as np
+
+from .metrics import METRICS
+
+# Number of corpus rows scored at once; small enough for the block to stay in the CPU cache
+SCORE_BLOCK_ROWS = 4096
+
+# Function to calculate the similarity score between two histograms
+def calculate_similarity_score(hist1, hist2):
+    # Use the chi-squared distance as the similarity score
+    score = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
+    return 1.0 / (1.0 + score)  # Convert distance to similarity
+
+# Function to compute the chi-squared distance between a query histogram and every row of a
+# matrix, giving the same values as cv2.compareHist(query_hist, row, cv2.HISTCMP_CHISQR)
+def chi_squared_distances(query_hist, histograms):
+    query = np.asarray(query_hist, dtype=np.float32).ravel()
+
+    # OpenCV skips the bins where the first histogram is (close to) zero, which is
+    # the same as giving those bins a weight of zero
+    nonzero = np.abs(query) > np.finfo(np.float64).eps
+    inverse_query = np.zeros_like(query)
+    inverse_query[nonzero] = 1.0 / query[nonzero]
+
+    distances = np.empty(len(histograms), dtype=np.float64)
+    buffer = np.empty((min(SCORE_BLOCK_ROWS, len(histograms)), len(query)), dtype=np.float32)
+
+    for start in range(0, len(histograms), SCORE_BLOCK_ROWS):
+        block = np.asarray(histograms[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+        diff = buffer[:len(block)]
+        np.subtract(block, query, out=diff)
+        np.multiply(diff, diff, out=diff)
+        distances[start:start + len(block)] = diff @ inverse_query
+
+    return distances
+
+# Function to compute the chi-squared distance between matching rows of two matrices,
+# row i giving cv2.compareHist(first[i], second[i], cv2.HISTCMP_CHISQR)
+def paired_chi_squared_distances(first, second):
+    first = np.asarray(first, dtype=np.float64)
+    second = np.asarray(second, dtype=np.float64)
+
+    nonzero = np.abs(first) > np.finfo(np.float64).eps
+    terms = (first - second) ** 2 / np.where(nonzero, first, 1.0)
+    return np.where(nonzero, terms, 0.0).sum(axis=1)
+
+# Function to compute the chi-squared distances between several query histograms and every row
+# of a matrix at once. Expanding sum((q - x)^2 / q) over the non-zero query bins turns the whole
+# (Q, N) block into two matrix products, computed in float64 by default to keep the cancellation
+# small; float32 is about twice as fast and good enough to screen candidates.
+def chi_squared_distance_matrix(query_histograms, histograms, dtype=np.float64):
+    queries = np.asarray(query_histograms, dtype=dtype)
+    corpus = np.asarray(histograms, dtype=dtype)
+
+    nonzero = np.abs(queries) > np.finfo(np.float64).eps
+    weights = np.zeros_like(queries)
+    weights[nonzero] = 1.0 / queries[nonzero]
+
+    # sum(w q^2) - 2 sum(w q x) + sum(w x^2), where w q is 1 on the non-zero bins
+    distances = (weights * queries * queries).sum(axis=1, dtype=np.float64)[:, None]
+    distances = distances - 2.0 * (nonzero.astype(dtype) @ corpus.T)
+    distances += weights @ (corpus * corpus).T
+
+    # Rounding can leave identical histograms very slightly below zero
+    return np.maximum(distances, 0.0)
+
+# Function to calculate the similarity score between a query histogram and every row of a matrix
+def similarity_scores(query_hist, histograms):
+    with METRICS.timer('score', items=len(histograms)):
+        return 1.0 / (1.0 + chi_squared_distances(query_hist, histograms))
+
+# Function to find the indices of the k best scores at or above the threshold, best first.
+# Ties keep the order of the scores array, also at the cut-off.
+def top_k(scores, k, threshold=None):
+    scores = np.asarray(scores)
+    with METRICS.timer('rank', items=len(scores)):
+        if threshold is None:
+            candidates = np.arange(len(scores))
+        else:
+            candidates = np.flatnonzero(scores >= threshold)
+
+        if k is not None:
+            if k <= 0:
+                return candidates[:0]
+            if len(candidates) > k:
+                # Find the k-th best score without sorting, then keep everything better than it
+                # and the earliest of the candidates that tie with it
+                candidate_scores = scores[candidates]
+                kth_score = -np.partition(-candidate_scores, k - 1)[k - 1]
+                better = candidates[candidate_scores > kth_score]
+                tied = candidates[candidate_scores == kth_score][:k - len(better)]
+                candidates = np.concatenate([better, tied])
+
+        order = np.lexsort((candidates, -scores[candidates]))
+        return candidates[order]
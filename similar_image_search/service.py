@@ -0,0 +1,291 @@
+# Long-running search service keeping a feature index in memory
+#
+# The index, its IVF (if one was built) and a Hamming index over its hashes
+# are loaded once into an IndexSnapshot and shared by every request, so a
+# query only pays for decoding the input image and scoring. Requests are
+# handled by a fixed pool of threads over a local HTTP/JSON API:
+#
+#   GET  /health   number of images, generation, root folder and decode scale
+#   GET  /metrics  stage timers, request counts and failures in the Prometheus text format,
+#                  or as JSON with ?format=json
+#   POST /search   JSON {"path": ..., "threshold", "num_similar", "probes", "hash_radius"},
+#                  or the raw image bytes with the same options in the query string
+#   POST /reload   JSON {"refresh": true} also rescans the folder before reloading
+#
+# A reload builds a complete new snapshot next to the current one and swaps it
+# in with a single assignment, so queries that are already running finish on
+# the old snapshot and no query ever waits for a reload.
+#
+# With watch mode, the service applies file system changes below the indexed
+# folder to a working copy of the index itself and publishes a new snapshot
+# after every batch, saving the index to disk at most every save_interval
+# seconds.
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .ann import IVF_FILE, IVFIndex, load_ivf
+from .features import compute_buffer_features, compute_features
+from .index import FeatureIndex, index_generation, update_index
+from .metrics import METRICS
+from .options import DEFAULT_HOST, DEFAULT_PORT
+from .phash import HashIndex
+from .query import search_index
+from .watch import watch_folder
+
+# Largest request body accepted, uploaded images included
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Everything a query needs, replaced as a whole on reload
+IndexSnapshot = namedtuple('IndexSnapshot', ['index', 'ivf', 'hash_index'])
+
+class SearchService:
+    def __init__(self, index_path, workers=1, mmap=False):
+        self.index_path = index_path
+        self.workers = workers
+        self.mmap = mmap
+        self.reload_lock = threading.Lock()
+        self.snapshot = None
+        self.reload()
+
+    # Function to load the index (rescanning its folder first if refresh is set) and swap it in.
+    # Returns the refresh stats, or None if the folder was not rescanned.
+    def reload(self, refresh=False):
+        with self.reload_lock:
+            stats = None
+            if refresh:
+                index, stats = update_index(self.index_path, workers=self.workers)
+            else:
+                index = FeatureIndex.load(self.index_path, self.mmap)
+
+            # Only use an IVF that was built on purpose, training one here would stall the reload
+            ivf = load_ivf(index, self.index_path) if os.path.exists(os.path.join(self.index_path, IVF_FILE)) else None
+
+            self.publish(index, ivf)
+            return stats
+
+    # Function to swap in a new snapshot of an index that nothing changes afterwards
+    def publish(self, index, ivf=None):
+        hash_index = HashIndex(index.hashes) if index.hashes is not None else None
+        self.snapshot = IndexSnapshot(index, ivf, hash_index)
+        logging.info(f"Serving {len(index)} images from '{self.index_path}' (generation {index.generation})")
+
+    # Function to reload the index if another process saved a new generation of it
+    def reload_if_changed(self):
+        try:
+            generation = index_generation(self.index_path)
+        except (OSError, ValueError):
+            # The index is being swapped by a save right now, look again next time
+            return False
+
+        if generation == self.snapshot.index.generation:
+            return False
+
+        self.reload()
+        return True
+
+    # Function to check for a new index generation every interval seconds until stop is set
+    def watch_index(self, stop, interval=5.0):
+        while not stop.wait(interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logging.warning(f"Error while reloading index '{self.index_path}': {e}")
+
+    # Function to apply file system changes below the indexed folder until stop is set,
+    # publishing a new snapshot after every batch of changes
+    def watch_folder(self, stop, debounce=1.0, save_interval=10.0, polling=False):
+        index = copy.copy(self.snapshot.index)
+        last_save = time.monotonic()
+        unsaved = False
+
+        def on_update(index, stats):
+            nonlocal last_save, unsaved
+            if index.generation == self.snapshot.index.generation:
+                return
+
+            # The IVF keeps its centroids, only its lists are filled again for the new rows
+            ivf = self.snapshot.ivf
+            if ivf is not None:
+                ivf = IVFIndex(ivf.centroids, None, None)
+                ivf.assign(index.histograms, index.generation)
+
+            # update_paths assigns new arrays, so a shallow copy is never changed by the next batch
+            with self.reload_lock:
+                self.publish(copy.copy(index), ivf)
+            logging.info(f"Applied folder changes to '{self.index_path}': {stats}")
+
+            unsaved = True
+            if time.monotonic() - last_save >= save_interval:
+                index.save(self.index_path)
+                last_save = time.monotonic()
+                unsaved = False
+
+        try:
+            watch_folder(index, self.workers, debounce, stop=stop, on_update=on_update, polling=polling)
+        finally:
+            if unsaved:
+                index.save(self.index_path)
+
+    def health(self):
+        index = self.snapshot.index
+        return {'images': len(index), 'generation': index.generation, 'root': index.root,
+                'decode_scale': index.decode_scale, 'ivf': self.snapshot.ivf is not None}
+
+    # Function to find the images most similar to an image given by path or by its encoded bytes.
+    # Returns the ranked [{"path", "score"}] matches and the index generation they come from.
+    def search(self, image_path=None, image_bytes=None, threshold=0.005, num_similar=5, probes=None,
+               hash_radius=None):
+        METRICS.count('searches')
+        with METRICS.timer('search'):
+            return self._search(image_path, image_bytes, threshold, num_similar, probes, hash_radius)
+
+    def _search(self, image_path, image_bytes, threshold, num_similar, probes, hash_radius):
+        snapshot = self.snapshot
+        decode_scale, limits = snapshot.index.decode_scale, snapshot.index.limits
+
+        if image_bytes is not None:
+            input_hist, input_hash = compute_buffer_features(image_bytes, decode_scale, limits=limits)
+        elif image_path is not None:
+            input_hist, input_hash = compute_features(image_path, decode_scale, limits)
+        else:
+            raise ValueError("Give an image path or the image bytes to search for")
+
+        if input_hist is None:
+            raise ValueError("Unable to read the input image")
+
+        matches = search_index(snapshot.index, input_hist, input_hash, threshold, num_similar, probes, hash_radius,
+                               snapshot.ivf, snapshot.hash_index)
+        return {'generation': snapshot.index.generation,
+                'results': [{'path': snapshot.index.paths[row], 'score': score} for row, score in matches]}
+
+class PooledHTTPServer(HTTPServer):
+    # HTTP server handing every connection to a fixed pool of threads instead of a new thread each
+    def __init__(self, server_address, handler_class, service, threads=4):
+        super().__init__(server_address, handler_class)
+        self.service = service
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='search')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self.send_json(200, self.server.service.health())
+        elif url.path == '/metrics':
+            if parse_qs(url.query).get('format') == ['json']:
+                self.send_json(200, METRICS.summary())
+            else:
+                self.send_text(200, METRICS.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': f"Unknown endpoint '{self.path}'"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            body = self.read_body()
+            if url.path == '/search':
+                self.send_json(200, self.handle_search(url, body))
+            elif url.path == '/reload':
+                options = json.loads(body) if body else {}
+                stats = self.server.service.reload(bool(options.get('refresh')))
+                self.send_json(200, dict(self.server.service.health(), stats=stats))
+            else:
+                self.send_json(404, {'error': f"Unknown endpoint '{url.path}'"})
+        except ValueError as e:
+            METRICS.count('request_errors')
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            METRICS.count('request_errors')
+            logging.warning(f"Error while handling '{self.path}': {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            # The body is not read, so the connection can't be reused
+            self.close_connection = True
+            raise ValueError(f"Request body larger than {MAX_REQUEST_BYTES} bytes")
+        return self.rfile.read(length)
+
+    def handle_search(self, url, body):
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            options = json.loads(body)
+            image_path, image_bytes = options.get('path'), None
+        else:
+            options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            image_path, image_bytes = None, body
+
+        probes = options.get('probes')
+        hash_radius = options.get('hash_radius')
+        return self.server.service.search(image_path, image_bytes,
+                                          float(options.get('threshold', 0.005)),
+                                          int(options.get('num_similar', 5)),
+                                          int(probes) if probes is not None else None,
+                                          int(hash_radius) if hash_radius is not None else None)
+
+    def send_json(self, status, payload):
+        self.send_text(status, json.dumps(payload), 'application/json')
+
+    def send_text(self, status, text, content_type):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+# Function to serve an index until interrupted. The index is either reloaded whenever another process
+# saved a new generation of it, or with watch set, kept live by watching its folder.
+def serve(index_path, host=DEFAULT_HOST, port=DEFAULT_PORT, threads=4, workers=1, reload_interval=5.0, watch=False,
+          debounce=1.0, save_interval=10.0, polling=False, mmap=False):
+    service = SearchService(index_path, workers, mmap)
+    server = PooledHTTPServer((host, port), SearchRequestHandler, service, threads)
+
+    stop = threading.Event()
+    watcher = None
+    if watch:
+        # Catch up with what changed while nothing was watching, then only follow the events
+        service.reload(refresh=True)
+        watcher = threading.Thread(target=service.watch_folder, args=(stop, debounce, save_interval, polling))
+        watcher.start()
+    elif reload_interval:
+        threading.Thread(target=service.watch_index, args=(stop, reload_interval), daemon=True).start()
+
+    print(f"Serving {len(service.snapshot.index)} images from '{index_path}' on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if watcher is not None:
+            watcher.join()
@@ -0,0 +1,126 @@
+# Sharded feature indexes with scatter-gather queries
+#
+# A sharded index is a directory holding one ordinary feature index per shard
+# and a shards.json manifest listing them:
+#
+#   shards.json   format version and, for every shard, its name, root folder and
+#                 [number, count] if the root folder is split by path hash
+#   shard-000/    feature index of the first shard, and so on
+#
+# Images are partitioned by root folder (one shard per volume), by a hash of
+# their path relative to the root, or both. Every shard is a complete index of
+# its own, so it can be built, updated or served on its own, e.g. by one
+# process per volume. A query is sent to every shard in parallel, each shard
+# returns its best num_similar matches at or above the threshold, and those
+# are merged into the global ranking, which is the same ranking a single index
+# over all images gives.
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import merge_shard_results
+from .index import FeatureIndex, update_index
+from .limits import DEFAULT_LIMITS
+from .query import search_index
+
+SHARDS_VERSION = 1
+SHARDS_FILE = 'shards.json'
+
+# Function to tell whether a directory holds a sharded index rather than a single one
+def is_sharded_index(index_path):
+    return os.path.exists(os.path.join(index_path, SHARDS_FILE))
+
+class ShardedIndex:
+    def __init__(self, index_path, shards):
+        self.index_path = index_path
+
+        # One dict per shard with its name, root folder and hash shard (None if not split by hash)
+        self.shards = shards
+
+    def __len__(self):
+        return len(self.shards)
+
+    @classmethod
+    def load(cls, index_path):
+        with open(os.path.join(index_path, SHARDS_FILE), 'r', encoding='utf-8') as shards_file:
+            manifest = json.load(shards_file)
+
+        if manifest.get('version') != SHARDS_VERSION:
+            raise ValueError(f"Unsupported sharded index version {manifest.get('version')} in '{index_path}'")
+
+        return cls(index_path, manifest['shards'])
+
+    # Function to lay out the shards of a new sharded index over one or more root folders, splitting
+    # every root into num_shards hash shards. The shards are only built by update.
+    @classmethod
+    def create(cls, index_path, roots, num_shards=1):
+        if is_sharded_index(index_path):
+            raise ValueError(f"'{index_path}' already holds a sharded index")
+
+        shards = []
+        for root in roots:
+            for number in range(num_shards):
+                shards.append({'name': f"shard-{len(shards):03d}", 'root': os.path.abspath(root),
+                               'hash': [number, num_shards] if num_shards > 1 else None})
+
+        os.makedirs(index_path, exist_ok=True)
+        with open(os.path.join(index_path, SHARDS_FILE), 'w', encoding='utf-8') as shards_file:
+            json.dump({'version': SHARDS_VERSION, 'shards': shards}, shards_file, indent=2)
+
+        return cls(index_path, shards)
+
+    def shard_path(self, name):
+        return os.path.join(self.index_path, name)
+
+    # Function to build or refresh the given shards (all of them by default), one after the other.
+    # Returns the refresh stats of every shard by name.
+    def update(self, names=None, workers=1, decode_scale=None, precision=None, limits=None, archives=None,
+               regions=None):
+        stats = {}
+        for shard in self.shards:
+            if names is not None and shard['name'] not in names:
+                continue
+
+            shard_path = self.shard_path(shard['name'])
+            if not os.path.isdir(shard_path):
+                index = FeatureIndex(shard['root'], decode_scale or 1, precision or 'float32', shard['hash'],
+                                     limits or DEFAULT_LIMITS, bool(archives), bool(regions))
+                stats[shard['name']] = index.refresh(workers=workers)
+                index.save(shard_path)
+            else:
+                index, stats[shard['name']] = update_index(shard_path, workers=workers, decode_scale=decode_scale,
+                                                           precision=precision, limits=limits, archives=archives,
+                                                           regions=regions)
+
+        return stats
+
+    # Function to load every shard. All shards have to be decoded at the same scale, since a query
+    # is only decoded once.
+    def load_shards(self, mmap=False):
+        indexes = [FeatureIndex.load(self.shard_path(shard['name']), mmap) for shard in self.shards]
+
+        decode_scales = {index.decode_scale for index in indexes}
+        if len(decode_scales) > 1:
+            raise ValueError(f"The shards of '{self.index_path}' were decoded at different scales "
+                             f"({', '.join(f'1/{scale}' for scale in sorted(decode_scales))}), update them to one scale")
+
+        return indexes
+
+# Function to search every shard in parallel threads and merge the results. ivfs holds the IVF of
+# every shard when probing. Returns (path, score) pairs, best first.
+def search_shards(indexes, input_hist, input_hash=None, threshold=0.005, num_similar=5, probes=None,
+                  hash_radius=None, ivfs=None, executor=None):
+    ivfs = ivfs or [None] * len(indexes)
+
+    def search_shard(index, ivf):
+        return [(index.paths[row], score) for row, score in
+                search_index(index, input_hist, input_hash, threshold, num_similar, probes, hash_radius, ivf)]
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max(1, len(indexes)), thread_name_prefix='shard') as executor:
+            results = list(executor.map(search_shard, indexes, ivfs))
+    else:
+        results = list(executor.map(search_shard, indexes, ivfs))
+
+    return merge_shard_results(results, num_similar)
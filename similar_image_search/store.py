@@ -0,0 +1,188 @@
+# Compact storage of index features
+#
+# Histograms can be stored at lower precision than float32: float16 halves the
+# size, and uint8 quarters it. uint8 codes are square-root companded, code =
+# round(255 * sqrt(h)), which keeps more levels for the many small bins that
+# dominate the chi-squared weights. Either way the stored matrix is a plain
+# contiguous .npy file that can be memory-mapped and scored in blocks without
+# loading it first. uint8 rows are decoded through a 256-entry lookup table
+# (cv2.LUT) as they are read, which is cheaper than numpy's float16 to float32
+# conversion, so uint8 is both the smallest and the faster of the two to score.
+#
+# Paths are stored as one UTF-8 blob with an offsets array next to it instead
+# of a JSON list, so they can be mapped too and are only decoded when used.
+
+import os
+
+import cv2
+import numpy as np
+
+from .scoring import similarity_scores, top_k
+
+# Precisions a feature index can store its histograms in, with their storage dtype
+PRECISIONS = {
+    'float32': np.float32,
+    'float16': np.float16,
+    'uint8': np.uint8,
+}
+
+PATHS_FILE = 'paths.bin'
+PATH_OFFSETS_FILE = 'path_offsets.npy'
+
+# Histogram value of every uint8 code
+UINT8_LEVELS = (np.arange(256, dtype=np.float32) / 255.0) ** 2
+
+# Function to check a --precision value
+def parse_precision(value):
+    if value not in PRECISIONS:
+        raise ValueError(f"Unsupported precision '{value}', use one of {', '.join(PRECISIONS)}")
+    return value
+
+# Function to decode uint8 codes of any shape into float32 histogram values
+def decode_codes(codes):
+    if np.ndim(codes) == 0 or np.size(codes) == 0:
+        return UINT8_LEVELS[codes]
+    codes = np.ascontiguousarray(codes)
+    return cv2.LUT(codes.reshape(-1, codes.shape[-1]), UINT8_LEVELS).reshape(codes.shape)
+
+# Function to turn float32 histograms into the stored representation of a precision
+def encode_histograms(histograms, precision):
+    histograms = np.asarray(histograms, dtype=np.float32)
+    if precision == 'uint8':
+        return np.rint(np.sqrt(np.clip(histograms, 0.0, 1.0)) * 255.0).astype(np.uint8)
+    return histograms.astype(PRECISIONS[precision], copy=False)
+
+class QuantizedHistograms:
+    # Read-only matrix of uint8 histogram codes that decodes to float32 when indexed, so scoring
+    # code written for float32 matrices can use it as is
+    def __init__(self, codes):
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def ndim(self):
+        return self.codes.ndim
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        return decode_codes(self.codes[key])
+
+    def __array__(self, dtype=None, copy=None):
+        histograms = decode_codes(self.codes)
+        return histograms if dtype is None else histograms.astype(dtype, copy=False)
+
+# Function to wrap stored histograms (possibly memory-mapped) for scoring
+def wrap_histograms(stored, precision):
+    if precision == 'uint8':
+        return QuantizedHistograms(stored)
+    return stored
+
+# Function to get the stored representation of histograms in a precision, without a decode and
+# encode round trip if they are already stored that way
+def stored_histograms(histograms, precision):
+    if isinstance(histograms, QuantizedHistograms):
+        return histograms.codes if precision == 'uint8' else encode_histograms(histograms, precision)
+    if histograms.dtype == PRECISIONS[precision] and precision != 'uint8':
+        return histograms
+    return encode_histograms(histograms, precision)
+
+class PathTable:
+    # Sequence of paths decoded on access from a UTF-8 blob, where path i is blob[offsets[i]:offsets[i + 1]]
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("path index out of range")
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8', 'surrogatepass')
+
+    def __iter__(self):
+        blob = bytes(self.blob)
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield blob[start:end].decode('utf-8', 'surrogatepass')
+
+# Function to write paths as a blob and an offsets array into a folder
+def save_path_table(paths, folder):
+    encoded = [path.encode('utf-8', 'surrogatepass') for path in paths]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in encoded], out=offsets[1:])
+
+    with open(os.path.join(folder, PATHS_FILE), 'wb') as paths_file:
+        paths_file.write(b''.join(encoded))
+    np.save(os.path.join(folder, PATH_OFFSETS_FILE), offsets)
+
+# Function to open the path table of a folder, memory-mapped if mmap is set
+def load_path_table(folder, mmap=False):
+    offsets = np.load(os.path.join(folder, PATH_OFFSETS_FILE), mmap_mode='r' if mmap else None)
+    paths_path = os.path.join(folder, PATHS_FILE)
+
+    if mmap and offsets[-1] > 0:
+        blob = np.memmap(paths_path, dtype=np.uint8, mode='r')
+    else:
+        with open(paths_path, 'rb') as paths_file:
+            blob = paths_file.read()
+
+    return PathTable(blob, offsets)
+
+# Function to measure how much storing histograms at lower precision changes the chi-squared
+# ranking: indexed images are used as queries against the float32 histograms and against the
+# quantized ones, leaving out the query image itself. Returns one dict per precision with the
+# recall of the exact top num_similar, how often the best match is the same, the score errors
+# and the bytes per image.
+def evaluate_precisions(histograms, precisions=('float16', 'uint8'), num_queries=100, num_similar=10, seed=0):
+    histograms = np.asarray(histograms, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(histograms), min(num_queries, len(histograms)), replace=False)
+
+    def best_others(scores, q):
+        return np.array([row for row in top_k(scores, num_similar + 1) if row != q][:num_similar], dtype=np.int64)
+
+    exact = []
+    for q in queries:
+        scores = similarity_scores(histograms[q], histograms)
+        exact.append((scores, best_others(scores, q)))
+
+    reports = []
+    for precision in precisions:
+        quantized = wrap_histograms(encode_histograms(histograms, precision), precision)
+        recalls, same_best, errors = [], 0, []
+
+        for q, (scores, expected) in zip(queries, exact):
+            # The query itself is decoded from the input image, so it stays float32
+            quantized_scores = similarity_scores(histograms[q], quantized)
+            found = best_others(quantized_scores, q)
+
+            recalls.append(len(set(found.tolist()) & set(expected.tolist())) / max(1, len(expected)))
+            same_best += bool(len(found)) and found[0] == expected[0]
+            errors.append(np.abs(quantized_scores[expected] - scores[expected]))
+
+        errors = np.concatenate(errors) if errors else np.zeros(0)
+        reports.append({
+            'precision': precision,
+            'bytes_per_image': histograms.shape[1] * np.dtype(PRECISIONS[precision]).itemsize,
+            f'recall@{num_similar}': round(float(np.mean(recalls)), 4) if recalls else None,
+            'same_best': round(float(same_best) / len(queries), 4) if len(queries) else None,
+            'mean_score_error': round(float(errors.mean()), 6) if len(errors) else None,
+            'max_score_error': round(float(errors.max()), 6) if len(errors) else None,
+        })
+
+    return reports
@@ -0,0 +1,117 @@
+# Streaming similarity search with bounded memory
+#
+# Image paths are generated lazily by the folder walk, decoded chunk by chunk
+# and scored as soon as each chunk arrives. Only the best num_similar matches
+# are kept, in a bounded heap, so memory stays the same whatever the size of
+# the folder, and a snapshot of the current best matches can be shown while
+# the scan is still running.
+
+import heapq
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from .extract import DEFAULT_CHUNK_SIZE, iter_feature_chunks
+from .features import compute_histogram, iter_image_paths
+from .limits import DEFAULT_LIMITS
+from .metrics import METRICS
+from .scoring import similarity_scores
+
+# Progress of a streaming search: images scored so far, images that could not be
+# decoded, seconds since the start, current best (path, score) pairs and whether
+# the scan has finished
+SearchSnapshot = namedtuple('SearchSnapshot', ['scanned', 'failed', 'elapsed', 'results', 'done'])
+
+class TopK:
+    # Bounded min-heap of the k best (score, path) pairs seen so far.
+    # Equal scores keep the image that was seen first.
+    def __init__(self, k, threshold=None):
+        self.k = k
+        self.threshold = threshold
+        self.heap = []
+        self.seen = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push_batch(self, paths, scores):
+        first_seq = self.seen
+        self.seen += len(paths)
+        if self.k <= 0:
+            return
+
+        # Skip everything that can't make it into the heap without looking at it in Python
+        scores = np.asarray(scores, dtype=np.float64)
+        candidates = np.arange(len(scores))
+        if self.threshold is not None:
+            candidates = candidates[scores[candidates] >= self.threshold]
+        if len(self.heap) >= self.k:
+            candidates = candidates[scores[candidates] > self.heap[0][0]]
+
+        for i in candidates:
+            entry = (float(scores[i]), -(first_seq + int(i)), paths[i])
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, entry)
+            elif entry > self.heap[0]:
+                heapq.heapreplace(self.heap, entry)
+
+    # Function to list the current matches as (path, score) pairs, best first
+    def results(self):
+        return [(path, score) for score, neg_seq, path in sorted(self.heap, reverse=True)]
+
+# Function to search a folder while it is being scanned, yielding a SearchSnapshot about
+# every snapshot_interval seconds and a final one with done=True. The scan stops early once
+# the cancel event is set. If image_paths is given, those are scanned instead of walking
+# the folder, e.g. when the caller listed them first to know how many there are. readahead
+# threads read the files ahead of the decoders. Images over the limits are skipped as failed.
+def iter_similar_images(input_image_path, search_folder, threshold=0.005, num_similar=5, workers=1,
+                        decode_scale=1, chunk_size=DEFAULT_CHUNK_SIZE, snapshot_interval=1.0, cancel=None,
+                        image_paths=None, readahead=0, limits=DEFAULT_LIMITS):
+    start = time.perf_counter()
+
+    input_hist = compute_histogram(input_image_path, decode_scale, limits)
+    if input_hist is None:
+        yield SearchSnapshot(0, 0, time.perf_counter() - start, [], True)
+        return
+
+    best = TopK(num_similar, threshold)
+    scanned = 0
+    failed = 0
+    last_snapshot = start
+
+    if image_paths is None:
+        image_paths = iter_image_paths(search_folder)
+
+    for chunk in iter_feature_chunks(image_paths, workers, chunk_size, decode_scale, readahead, limits):
+        if cancel is not None and cancel.is_set():
+            break
+
+        paths = [image_path for image_path, decoded in zip(chunk.paths, chunk.ok) if decoded]
+        scores = similarity_scores(input_hist, chunk.histograms[chunk.ok])
+        with METRICS.timer('rank', items=len(paths)):
+            best.push_batch(paths, scores)
+
+        scanned += len(paths)
+        failed += len(chunk.paths) - len(paths)
+
+        now = time.perf_counter()
+        if now - last_snapshot >= snapshot_interval:
+            last_snapshot = now
+            yield SearchSnapshot(scanned, failed, now - start, best.results(), False)
+
+    yield SearchSnapshot(scanned, failed, time.perf_counter() - start, best.results(), True)
+
+# Function to run a streaming search, passing every snapshot to on_snapshot, and
+# return the final (path, score) matches
+def stream_similar_images(input_image_path, search_folder, threshold=0.005, num_similar=5, workers=1,
+                          decode_scale=1, chunk_size=DEFAULT_CHUNK_SIZE, snapshot_interval=1.0, on_snapshot=None,
+                          cancel=None, image_paths=None, readahead=0, limits=DEFAULT_LIMITS):
+    snapshot = None
+    for snapshot in iter_similar_images(input_image_path, search_folder, threshold, num_similar, workers,
+                                        decode_scale, chunk_size, snapshot_interval, cancel, image_paths, readahead,
+                                        limits):
+        if on_snapshot is not None:
+            on_snapshot(snapshot)
+
+    return snapshot.results if snapshot is not None else []
@@ -0,0 +1,115 @@
+# Thumbnail cache for the GUI result views
+#
+# Decoding a full-size image from a network share just to show a small tile is
+# what makes browsing results slow, so thumbnails are kept at two levels: an
+# on-disk store of small JPEG files keyed by image path, mtime and thumbnail
+# size, which survives restarts, and an in-memory LRU the GUI fills with its
+# ready-to-draw images. The store only uses PIL and the file system and is
+# safe to use from several worker threads at once.
+
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from .archives import read_archive_member, split_archive_path
+from .limits import DEFAULT_LIMITS, ImageTooLarge, budget_bytes
+
+DEFAULT_THUMBNAIL_SIZE = (150, 150)
+
+# Function to find the default folder of the on-disk thumbnail store
+def default_thumbnail_folder():
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'similar-image-search', 'thumbnails')
+
+class LRUCache:
+    # Mapping keeping at most capacity items, dropping the least recently used one first
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+class ThumbnailStore:
+    def __init__(self, folder=None, size=DEFAULT_THUMBNAIL_SIZE, quality=85):
+        self.folder = folder or default_thumbnail_folder()
+        self.size = tuple(size)
+        self.quality = quality
+
+    # Function to find where the thumbnail of an image is stored; a modified image gets a new key
+    def thumbnail_path(self, image_path, mtime_ns):
+        key = f"{os.path.abspath(image_path)}|{mtime_ns}|{self.size[0]}x{self.size[1]}"
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest[:2], digest + '.jpg')
+
+    # Function to return the thumbnail of an image as a PIL image, from the store if it was made
+    # before, otherwise by decoding the image and storing the result. Returns None if the image
+    # can't be read. Images inside archives are keyed by the mtime of the archive.
+    def load(self, image_path):
+        from PIL import Image
+
+        archive_path, name = split_archive_path(image_path)
+        try:
+            thumbnail_path = self.thumbnail_path(image_path, os.stat(archive_path).st_mtime_ns)
+        except OSError as e:
+            logging.warning(f"Unable to read image '{image_path}': {e}")
+            return None
+
+        try:
+            with Image.open(thumbnail_path) as thumbnail:
+                thumbnail.load()
+                return thumbnail
+        except OSError:
+            pass
+
+        source = image_path
+        if name is not None:
+            try:
+                data = read_archive_member(image_path, budget_bytes(DEFAULT_LIMITS))
+            except ImageTooLarge as e:
+                logging.warning(f"Unable to make a thumbnail of '{image_path}': {e}")
+                return None
+            if data is None:
+                return None
+            source = io.BytesIO(data)
+
+        try:
+            with Image.open(source) as image:
+                # Let the JPEG decoder downscale in the DCT domain instead of decoding every pixel
+                image.draft('RGB', self.size)
+                thumbnail = image.convert('RGB')
+            thumbnail.thumbnail(self.size, Image.LANCZOS)
+        except Exception as e:
+            logging.warning(f"Error while making a thumbnail of '{image_path}': {e}")
+            return None
+
+        try:
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            tmp_path = f"{thumbnail_path}.{threading.get_ident()}.tmp"
+            thumbnail.save(tmp_path, 'JPEG', quality=self.quality)
+            os.replace(tmp_path, thumbnail_path)
+        except OSError as e:
+            logging.warning(f"Unable to store the thumbnail of '{image_path}': {e}")
+
+        return thumbnail
@@ -0,0 +1,240 @@
+# Watching a search folder to keep its feature index live
+#
+# Rather than walking the whole folder again to find new renders, a watcher
+# reports the paths that changed: inotify on Linux (through ctypes, no extra
+# dependency), or else a polling fallback that stats every folder and only
+# lists the folders whose mtime changed. Creating, deleting or renaming a file
+# updates the mtime of its folder, but rewriting a file in place does not, so
+# the fallback only notices those once the folder changes for another reason.
+#
+# Changed paths are collected until no new event arrived for a debounce delay
+# (or a maximum delay passed during a long burst), then applied to the index in
+# one FeatureIndex.update_paths call, which only decodes new or modified images.
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher:
+    # Watches every folder below a root with inotify. Raises OSError if inotify is not available
+    # or the watch limit (fs.inotify.max_user_watches) is too low for the tree.
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.folders = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, f"Unable to watch '{folder}': {os.strerror(error)}")
+
+        # Watching a folder again after it was renamed returns its old descriptor
+        self.folders[wd] = folder
+
+    def add_tree(self, folder):
+        for root, dirs, files in os.walk(folder):
+            self.add_folder(root)
+
+    # Function to wait up to timeout seconds for events and return the paths they are about.
+    # A None in the list means events were lost and the whole root has to be checked.
+    def read(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                paths.append(None)
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & IN_DELETE_SELF:
+                paths.append(folder)
+                continue
+
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # New folders have to be watched, and files may already be in them
+                self.add_tree(path)
+            paths.append(path)
+
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class PollingWatcher:
+    # Finds changes by comparing folder mtimes, listing only the folders that changed
+    def __init__(self, root, interval=2.0):
+        self.root = root
+        self.interval = interval
+
+        # Folder -> (mtime, {name: (is_folder, size, mtime)})
+        self.folders = {}
+        self._scan_tree(root)
+
+    def _list_folder(self, folder):
+        entries = {}
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        entries[entry.name] = (True, 0, 0)
+                    else:
+                        st = entry.stat()
+                        entries[entry.name] = (False, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+        return entries
+
+    def _scan_tree(self, folder):
+        for root, dirs, files in os.walk(folder):
+            try:
+                self.folders[root] = (os.stat(root).st_mtime_ns, self._list_folder(root))
+            except OSError:
+                continue
+
+    def _forget_tree(self, folder):
+        prefix = os.path.join(folder, '')
+        for path in [path for path in self.folders if path == folder or path.startswith(prefix)]:
+            del self.folders[path]
+
+    # Function to return the paths that changed since the last call. Every call waits for the
+    # polling interval, whatever the timeout, so the folders are not stat'ed more often than that.
+    def read(self, timeout):
+        time.sleep(self.interval)
+
+        paths = []
+        for folder, (mtime, entries) in list(self.folders.items()):
+            if folder not in self.folders:
+                # Forgotten together with a parent folder that was removed during this pass
+                continue
+            try:
+                current_mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                self._forget_tree(folder)
+                paths.append(folder)
+                continue
+            if current_mtime == mtime:
+                continue
+
+            try:
+                current = self._list_folder(folder)
+            except OSError:
+                continue
+            self.folders[folder] = (current_mtime, current)
+
+            for name in entries.keys() | current.keys():
+                if entries.get(name) == current.get(name):
+                    continue
+
+                path = os.path.join(folder, name)
+                was_folder = name in entries and entries[name][0]
+                if was_folder:
+                    self._forget_tree(path)
+                if name in current and current[name][0]:
+                    self._scan_tree(path)
+                paths.append(path)
+
+        return paths
+
+    def close(self):
+        pass
+
+# Function to open the best available watcher for a folder
+def open_watcher(root, polling=False, poll_interval=2.0):
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Unable to watch '{root}' with inotify, polling folder mtimes instead: {e}")
+
+    return PollingWatcher(root, poll_interval)
+
+# Function to apply folder changes to an index until stop is set. After every applied batch,
+# on_update(index, stats) is called; the index is changed in place between those calls.
+def watch_folder(index, workers=1, debounce=1.0, max_delay=10.0, stop=None, on_update=None, polling=False,
+                 poll_interval=2.0):
+    watcher = open_watcher(index.root, polling, poll_interval)
+    pending = set()
+    first_event = last_event = None
+
+    try:
+        while stop is None or not stop.is_set():
+            paths = watcher.read(debounce)
+            now = time.monotonic()
+
+            if paths:
+                pending.update(paths)
+                last_event = now
+                if first_event is None:
+                    first_event = now
+
+            # Wait for the burst to settle, but don't hold changes back forever during a long one
+            if not pending or (now - last_event < debounce and now - first_event < max_delay):
+                continue
+
+            if None in pending:
+                logging.warning(f"Missed file system events below '{index.root}', checking the whole folder")
+                stats = index.refresh(workers=workers)
+            else:
+                stats = index.update_paths(sorted(pending), workers)
+            pending.clear()
+            first_event = last_event = None
+
+            if on_update is not None:
+                on_update(index, stats)
+    finally:
+        watcher.close()
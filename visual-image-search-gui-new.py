@@ -1,123 +1,185 @@
-import cv2
 import os
-import numpy as np
 import argparse
 import logging
-import sys
-from datetime import datetime
+import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
-from tkinter import filedialog, messagebox, Listbox
-from PIL import Image, ImageTk
+from tkinter import filedialog, messagebox
+from PIL import ImageTk
+from similar_image_search import DEFAULT_URL, LRUCache, ThumbnailStore, engine, instrumented
 
-# Function to compute the color histogram of an image
-def compute_histogram(image_path):
-    try:
-        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+# Milliseconds between two looks at the messages of the search worker
+POLL_INTERVAL_MS = 100
 
-        if image is None:
-            logging.warning(f"Unable to read image '{image_path}'")
-            return None
-
-        # Check if the image is grayscale, and convert it to color if necessary
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-        # Convert the image to the HSV color space
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-        # Calculate the histogram
-        hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-
-        # Normalize the histogram
-        hist = cv2.normalize(hist, hist).flatten()
-
-        return hist
-    except Exception as e:
-        logging.warning(f"Error while processing '{image_path}': {e}")
-        return None
-
-# Function to calculate the similarity score between two histograms
-def calculate_similarity_score(hist1, hist2):
-    # Use the chi-squared distance as the similarity score
-    try:
-        score = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
-        return 1.0 / (1.0 + score)  # Convert distance to similarity
-    except Exception as e:
-        logging.warning(f"Error while calculating similarity score: {e}")
-        return 0.0
-
-# Function to find visually similar images
-def find_similar_images(input_image_path, search_folder, threshold=0.30, num_similar=10, canceled=False):
-    input_hist = compute_histogram(input_image_path)
-    if input_hist is None:
-        return []
-
-    image_paths = []
-    image_histograms = []
-
-    try:
-        # Iterate through the subfolders and find image histograms
-        for root, dirs, files in os.walk(search_folder):
-            if canceled:
-                break
-
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp')):
-                    image_path = os.path.join(root, file)
-                    image_hist = compute_histogram(image_path)
-
-                    if image_hist is not None:
-                        image_paths.append(image_path)
-                        image_histograms.append(image_hist)
-    except Exception as e:
-        logging.warning(f"Error while searching for images: {e}")
-
-    if not image_paths:
-        return []
-
-    # Calculate the similarity scores
-    similarity_scores = [calculate_similarity_score(input_hist, hist) for hist in image_histograms]
+# Images decoded between two checks of the cancel button, small enough for it to react quickly
+SEARCH_CHUNK_SIZE = 16
 
-    # Find images that meet the similarity threshold
-    similar_indices = [i for i, score in enumerate(similarity_scores) if score >= threshold]
-
-    # Sort the images by similarity
-    similar_images = [image_paths[i] for i in similar_indices]
+# Size of a result tile (thumbnail plus caption) and of the image preview
+TILE_WIDTH = 170
+TILE_HEIGHT = 185
+PREVIEW_SIZE = (300, 300)
 
+# Function to print the similar images and log them to a timestamped output file
+def log_similar_images(input_image_path, threshold, num_similar, similar_images):
     if similar_images:
         print(f"Similar images to '{input_image_path}' (with similarity threshold {threshold * 100}% or higher):")
-        for i, image_path in enumerate(similar_images[:num_similar]):
+        for i, (image_path, score) in enumerate(similar_images):
             print(f"{i + 1}. {image_path}")
 
-        # Generate a file name based on the current date and time
-        now = datetime.now()
-        timestamp = now.strftime("%d-%m-%Y_%H-%M-%S")
-        output_file = f"similar-images-{timestamp}.txt"
+        output_file = engine.save_results(input_image_path, threshold, num_similar, similar_images)
+        print(f"Similar images logged to '{output_file}'")
 
-        # Log command-line options and similar images to the output file
-        with open(output_file, 'w', encoding='utf-8') as out_file:
-            out_file.write(f"Input image: {input_image_path}\n")
-            out_file.write(f"Threshold: {threshold}\n")
-            out_file.write(f"Number of similar images: {num_similar}\n\n")
-            out_file.write("Similar images:\n")
+class ThumbnailGrid:
+    # Scrollable grid of result tiles. Only the tiles of the rows in view exist on the canvas,
+    # so thousands of results stay responsive. Thumbnails of the rows in view, and of a few rows
+    # around them, are made on the thumbnail pool and handed back to the Tk main thread through
+    # a queue, as Tk images can only be created there.
+    def __init__(self, parent, store, pool, on_select=None, cache_size=512, prefetch_rows=2):
+        self.store = store
+        self.pool = pool
+        self.on_select = on_select
+        self.prefetch_rows = prefetch_rows
+
+        self.frame = tk.Frame(parent)
+        self.canvas = tk.Canvas(self.frame, width=TILE_WIDTH * 4, height=TILE_HEIGHT * 2, highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.scroll)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.canvas.bind('<Configure>', self.refresh)
+        self.canvas.bind('<Button-1>', self.click)
+        self.canvas.bind('<MouseWheel>', lambda event: self.scroll('scroll', -event.delta // 120, 'units'))
+        self.canvas.bind('<Button-4>', lambda event: self.scroll('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda event: self.scroll('scroll', 1, 'units'))
+
+        self.items = []  # (path, score) of every result
+        self.tiles = {}  # result position -> (path, image item, caption item, thumbnail)
+        self.columns = 0
+        self.thumbnails = LRUCache(cache_size)  # path -> PhotoImage
+        self.loading = {}  # path -> future of the thumbnail being made
+        self.loaded = queue.Queue()
+
+        self.canvas.after(POLL_INTERVAL_MS, self.poll_thumbnails)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def set_items(self, items):
+        items = list(items)
+        if items == self.items:
+            return
+
+        self.items = items
+        self.clear_tiles()
+        self.refresh()
+
+    def clear_tiles(self):
+        for path, image_item, caption_item, thumbnail in self.tiles.values():
+            self.canvas.delete(image_item, caption_item)
+        self.tiles = {}
+
+    def scroll(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    # Function to create the tiles in view, drop the others and prefetch the thumbnails around them
+    def refresh(self, event=None):
+        columns = max(1, self.canvas.winfo_width() // TILE_WIDTH)
+        if columns != self.columns:
+            self.columns = columns
+            self.clear_tiles()
+
+        rows = math.ceil(len(self.items) / columns)
+        self.canvas.configure(scrollregion=(0, 0, columns * TILE_WIDTH, rows * TILE_HEIGHT))
+
+        top = self.canvas.canvasy(0)
+        first_row = int(top // TILE_HEIGHT)
+        last_row = int((top + self.canvas.winfo_height()) // TILE_HEIGHT)
+        visible = range(first_row * columns, min(len(self.items), (last_row + 1) * columns))
+
+        for position in [position for position in self.tiles if position not in visible]:
+            path, image_item, caption_item, thumbnail = self.tiles.pop(position)
+            self.canvas.delete(image_item, caption_item)
+        for position in visible:
+            if position not in self.tiles:
+                self.create_tile(position)
+
+        prefetch = range(max(0, first_row - self.prefetch_rows) * columns,
+                         min(len(self.items), (last_row + 1 + self.prefetch_rows) * columns))
+        self.prefetch([self.items[position][0] for position in prefetch])
+
+    def create_tile(self, position):
+        path, score = self.items[position]
+        x = (position % self.columns) * TILE_WIDTH + TILE_WIDTH // 2
+        y = (position // self.columns) * TILE_HEIGHT
+
+        thumbnail = self.thumbnails.get(path)
+        image_item = self.canvas.create_image(x, y + 5 + self.store.size[1] // 2, anchor=tk.CENTER)
+        if thumbnail is not None:
+            self.canvas.itemconfigure(image_item, image=thumbnail)
+        caption_item = self.canvas.create_text(x, y + self.store.size[1] + 15, width=TILE_WIDTH - 10,
+                                               text=f"{score:.4f} {os.path.basename(path)}", anchor=tk.CENTER)
+        self.tiles[position] = (path, image_item, caption_item, thumbnail)
+
+    # Function to make the thumbnails of the given paths in the background, forgetting the
+    # requests for paths that scrolled too far away before they were started
+    def prefetch(self, paths):
+        wanted = set(paths)
+        for path in [path for path in self.loading if path not in wanted]:
+            if self.loading[path].cancel():
+                del self.loading[path]
+
+        for path in paths:
+            if path not in self.thumbnails and path not in self.loading:
+                self.loading[path] = self.pool.submit(self.load_thumbnail, path)
+
+    # Function run on the thumbnail pool
+    def load_thumbnail(self, path):
+        self.loaded.put((path, self.store.load(path)))
+
+    # Function to turn the thumbnails made in the background into Tk images and show them
+    def poll_thumbnails(self):
+        while True:
+            try:
+                path, image = self.loaded.get_nowait()
+            except queue.Empty:
+                break
 
-            for i, image_path in enumerate(similar_images[:num_similar]):
-                out_file.write(f"{i + 1}. {image_path}\n")
+            self.loading.pop(path, None)
+            if image is None:
+                continue
 
-        print(f"Similar images logged to '{output_file}'")
-    
-    if canceled:
-        return []
+            thumbnail = ImageTk.PhotoImage(image)
+            self.thumbnails.put(path, thumbnail)
+            for position, (tile_path, image_item, caption_item, _) in list(self.tiles.items()):
+                if tile_path == path:
+                    # The tile keeps its image alive even after the LRU dropped it
+                    self.canvas.itemconfigure(image_item, image=thumbnail)
+                    self.tiles[position] = (tile_path, image_item, caption_item, thumbnail)
 
-    if similar_images:
-        return similar_images[:num_similar]
-    else:
-        return []
+        self.canvas.after(POLL_INTERVAL_MS, self.poll_thumbnails)
+
+    def click(self, event):
+        column = int(self.canvas.canvasx(event.x) // TILE_WIDTH)
+        position = int(self.canvas.canvasy(event.y) // TILE_HEIGHT) * self.columns + column
+        if column < self.columns and 0 <= position < len(self.items) and self.on_select is not None:
+            self.on_select(self.items[position][0])
 
 class SimilarImageSearchApp:
-    def __init__(self, root):
+    def __init__(self, root, server_url=None, workers=1, thumbnail_folder=None):
         self.root = root
         self.root.title("Similar Image Search")
+        self.server_url = server_url  # Search with a running search service instead of scanning the folder
+        self.workers = workers
+
+        # Thumbnails and previews are made on a small thread pool and cached on disk
+        self.thumbnail_pool = ThreadPoolExecutor(max_workers=4)
+        self.thumbnail_store = ThumbnailStore(thumbnail_folder)
+        self.preview_store = ThumbnailStore(thumbnail_folder, PREVIEW_SIZE)
+        self.preview_window = None
 
         self.input_image_path = tk.StringVar()
         self.search_folder_path = tk.StringVar()
@@ -125,12 +187,18 @@ class SimilarImageSearchApp:
         self.num_similar = tk.IntVar()
         self.input_image_preview = None
         self.cancel_button = None
+        self.status = tk.StringVar()
 
         self.create_widgets()
 
         # Initialize list to hold similar image paths
         self.similar_images = []
-        self.canceled = False  # Flag to check if the search is canceled
+
+        # The search runs on a worker thread, which only talks to the Tk main thread through the
+        # message queue; the cancel event is the only thing the main thread changes for it
+        self.search_thread = None
+        self.cancel_event = threading.Event()
+        self.messages = queue.Queue()
     
     def create_widgets(self):
         tk.Label(self.root, text="Input Image Path:").pack()
@@ -158,15 +226,19 @@ class SimilarImageSearchApp:
         self.num_similar.set(10)
 
         # Create a Cancel button to stop the search
-        self.cancel_button = tk.Button(self.root, text="Cancel", command=self.cancel_search)
+        self.cancel_button = tk.Button(self.root, text="Cancel", command=self.cancel_search, state=tk.DISABLED)
         self.cancel_button.pack()
 
-        tk.Button(self.root, text="Find Similar Images", command=self.find_similar_images).pack()
+        self.find_button = tk.Button(self.root, text="Find Similar Images", command=self.find_similar_images)
+        self.find_button.pack()
+
+        # Show the progress of the running search
+        tk.Label(self.root, textvariable=self.status).pack()
 
-        # Create a Listbox to display similar image paths
-        self.listbox = Listbox(self.root, selectmode=tk.SINGLE)
-        self.listbox.pack()
-        self.listbox.bind('<<ListboxSelect>>', self.show_image_preview)
+        # Create a grid of thumbnails to display the similar images
+        self.grid = ThumbnailGrid(self.root, self.thumbnail_store, self.thumbnail_pool,
+                                  on_select=self.display_input_image_preview)
+        self.grid.pack(fill=tk.BOTH, expand=True)
 
     def browse_input_image(self):
         file_path = filedialog.askopenfilename()
@@ -180,77 +252,136 @@ class SimilarImageSearchApp:
         if folder_path:
             self.search_folder_path.set(folder_path)
 
-    def display_input_image_preview(self, image_path):
-        try:
-            image = Image.open(image_path)
-            image.thumbnail((300, 300))
-            self.input_image_preview = ImageTk.PhotoImage(image)
-
-            if self.input_image_preview is not None:
-                label = tk.Label(self.root, image=self.input_image_preview)
-                label.image = self.input_image_preview
-                label.pack()
-        except Exception as e:
-            logging.warning(f"Error while displaying input image preview: {e}")
-
     def cancel_search(self):
-        self.canceled = True
+        self.cancel_event.set()
+        self.status.set("Canceling...")
 
     def find_similar_images(self):
-        self.cancel_button['state'] = tk.NORMAL  # Enable the Cancel button
+        if self.search_thread is not None:
+            return
+
         input_path = self.input_image_path.get()
         threshold_value = self.threshold.get()
         num_similar_value = self.num_similar.get()
         search_folder_path = self.search_folder_path.get()
 
-        self.listbox.delete(0, tk.END)  # Clear the listbox
-        self.canceled = False  # Reset the canceled flag
+        self.grid.set_items([])  # Clear the results
+        self.similar_images = []
+        self.cancel_event = threading.Event()
 
-        self.similar_images = find_similar_images(input_path, search_folder_path, threshold_value, num_similar_value, self.canceled)
+        self.cancel_button['state'] = tk.NORMAL  # Enable the Cancel button
+        self.find_button['state'] = tk.DISABLED
+        self.status.set("Listing images...")
 
-        if self.canceled:
-            messagebox.showinfo("Canceled", "Similar image search canceled.")
-        elif self.similar_images:
-            for image_path in self.similar_images:
-                self.listbox.insert(tk.END, os.path.basename(image_path))
+        self.search_thread = threading.Thread(target=self.search_worker, daemon=True,
+                                              args=(input_path, search_folder_path, threshold_value,
+                                                    num_similar_value, self.cancel_event))
+        self.search_thread.start()
+        self.root.after(POLL_INTERVAL_MS, self.poll_search_messages)
 
+    # Function run on the worker thread, posting progress and the final results to the message queue
+    def search_worker(self, input_path, search_folder_path, threshold, num_similar, cancel):
+        try:
+            # The images of the folder are listed first, so the progress can tell how many are left
+            similar_images = engine.query(input_path, search_folder_path, server_url=self.server_url,
+                                          threshold=threshold, num_similar=num_similar, workers=self.workers,
+                                          cancel=cancel,
+                                          on_progress=lambda snapshot, total: self.messages.put(('progress', snapshot,
+                                                                                                 total)),
+                                          list_first=True, chunk_size=SEARCH_CHUNK_SIZE, snapshot_interval=0.25)
+            if not self.server_url and not cancel.is_set():
+                log_similar_images(input_path, threshold, num_similar, similar_images)
+            self.messages.put(('done', similar_images))
+        except Exception as e:
+            logging.warning(f"Error while searching for similar images: {e}")
+            self.messages.put(('error', str(e)))
+
+    # Function to handle the messages of the search worker on the Tk main thread
+    def poll_search_messages(self):
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+
+            if message[0] == 'progress':
+                snapshot, total = message[1], message[2]
+                self.status.set(engine.format_progress(snapshot, total))
+                self.show_results(snapshot.results)
+            elif message[0] == 'done':
+                self.finish_search(message[1])
+                return
+            else:
+                self.finish_search([])
+                messagebox.showerror("Error", message[1])
+                return
+
+        self.root.after(POLL_INTERVAL_MS, self.poll_search_messages)
+
+    def show_results(self, similar_images):
+        self.similar_images = [image_path for image_path, score in similar_images]
+        self.grid.set_items(similar_images)
+
+    def finish_search(self, similar_images):
+        self.search_thread = None
         self.cancel_button['state'] = tk.DISABLED  # Disable the Cancel button
+        self.find_button['state'] = tk.NORMAL
 
-        if not self.canceled:
-            messagebox.showinfo("Success", "Similar images search completed. Results are displayed below.")
+        if self.cancel_event.is_set():
+            self.status.set("Search canceled")
+            messagebox.showinfo("Canceled", "Similar image search canceled.")
+            return
 
-    def show_image_preview(self, event):
-        selected_indices = self.listbox.curselection()
-        if selected_indices:
-            selected_index = selected_indices[0]
-            selected_image_path = self.similar_images[int(selected_index)]
-            self.display_input_image_preview(selected_image_path)
+        self.show_results(similar_images)
+        self.status.set(f"Found {len(similar_images)} similar images")
+        messagebox.showinfo("Success", "Similar images search completed. Results are displayed below.")
 
+    # Function to show an image in the preview window, once its preview was made in the background
     def display_input_image_preview(self, image_path):
-        if self.input_image_preview is not None:
-            self.input_image_preview.destroy()  # Destroy the previous preview image widget
+        future = self.thumbnail_pool.submit(self.preview_store.load, image_path)
+        self.root.after(POLL_INTERVAL_MS, self.show_preview_when_ready, image_path, future)
 
-            try:
-                image = Image.open(image_path)
-                image.thumbnail((300, 300))
-                image_preview = ImageTk.PhotoImage(image)
-
-                if image_preview is not None:
-                    preview_window = tk.Toplevel(self.root)
-                    label = tk.Label(preview_window, image=image_preview)
-                    label.image = image_preview
-                    label.pack()
-            except Exception as e:
-                logging.warning(f"Error while displaying image preview: {e}")
+    def show_preview_when_ready(self, image_path, future):
+        if not future.done():
+            self.root.after(POLL_INTERVAL_MS, self.show_preview_when_ready, image_path, future)
+            return
+
+        image = future.result()
+        if image is None:
+            return
+
+        try:
+            image_preview = ImageTk.PhotoImage(image)
+
+            # Reuse the preview window instead of opening a new one for every image
+            if self.preview_window is None or not self.preview_window.winfo_exists():
+                self.preview_window = tk.Toplevel(self.root)
+                self.preview_label = tk.Label(self.preview_window)
+                self.preview_label.pack()
+
+            self.preview_window.title(os.path.basename(image_path))
+            self.preview_label.configure(image=image_preview)
+            self.preview_label.image = image_preview
+        except Exception as e:
+            logging.warning(f"Error while displaying image preview: {e}")
 
 if __name__ == "__main__":
-    # Configure logging to save errors to a file
+    parser = argparse.ArgumentParser(description="Similar image search GUI.")
+    parser.add_argument("--server", nargs="?", const=DEFAULT_URL,
+                        help=f"Search with a running search service (default {DEFAULT_URL}) instead of scanning the search folder")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes decoding images (0 uses every core)")
+    parser.add_argument("--thumbnail-cache", help="Folder of the on-disk thumbnail cache (default: in the user cache folder)")
+    parser.add_argument("--metrics",
+                        help="Write the stage timings and failure counts of the session to this file on exit, JSON or Prometheus text for a .prom file")
+    parser.add_argument("--profile", help="Profile the session with cProfile and write the stats to this file on exit")
+    args = parser.parse_args()
+
+    # Configure logging to save errors to a file; standard error is left alone so crashes still show
     logging.basicConfig(filename='errors_log_gui.txt', level=logging.WARNING,
                         format='%(asctime)s - %(levelname)s - %(message)s')
 
-    # Redirect standard error to the errors log file
-    sys.stderr = open('errors_log_gui.txt', 'a')
-    
-    root = tk.Tk()
-    app = SimilarImageSearchApp(root)
-    root.mainloop()
+    with instrumented(args.metrics, args.profile):
+        root = tk.Tk()
+        app = SimilarImageSearchApp(root, args.server, args.workers, args.thumbnail_cache)
+        root.mainloop()
@@ -1,89 +1,21 @@
-import cv2
-import os
-import numpy as np
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
 from PIL import Image, ImageTk, ImageFilter
 import argparse
-from datetime import datetime
+from similar_image_search import DEFAULT_URL, engine, instrumented
 
-# Function to compute the color histogram of an image
-def compute_histogram(image_path):
-    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+# Milliseconds between two looks at the messages of the search worker
+POLL_INTERVAL_MS = 100
 
-    if image is None:
-        messagebox.showerror("Error", f"Unable to read image '{image_path}'")
-        return None
-
-    # Check if the image is grayscale, and convert it to color if necessary
-    if len(image.shape) == 2:
-        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-
-    # Convert the image to the HSV color space
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-    # Calculate the histogram
-    hist = cv2.calcHist([hsv], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-
-    # Normalize the histogram
-    hist = cv2.normalize(hist, hist).flatten()
-
-    return hist
-
-# Function to calculate the similarity score between two histograms
-def calculate_similarity_score(hist1, hist2):
-    # Use the chi-squared distance as the similarity score
-    score = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
-    return 1.0 / (1.0 + score)  # Convert distance to similarity
-
-# Function to find visually similar images
-def find_similar_images(input_image_path, search_folder, threshold=0.30, num_similar=10):
-    input_hist = compute_histogram(input_image_path)
-    if input_hist is None:
-        return
-
-    image_paths = []
-    image_histograms = []
-
-    # Iterate through the subfolders and find image histograms
-    for root, dirs, files in os.walk(search_folder):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp')):
-                image_path = os.path.join(root, file)
-                image_hist = compute_histogram(image_path)
-
-                if image_hist is not None:
-                    image_paths.append(image_path)
-                    image_histograms.append(image_hist)
-
-    if not image_paths:
-        return
-
-    # Calculate the similarity scores
-    similarity_scores = [calculate_similarity_score(input_hist, hist) for hist in image_histograms]
-
-    # Find images that meet the similarity threshold
-    similar_indices = [i for i, score in enumerate(similarity_scores) if score >= threshold]
-
-    # Sort the images by similarity
-    similar_images = [image_paths[i] for i in similar_indices]
+# Images decoded between two checks of the cancel button, small enough for it to react quickly
+SEARCH_CHUNK_SIZE = 16
 
+# Function to log the similar images to a timestamped output file
+def log_similar_images(input_image_path, threshold, num_similar, similar_images):
     if similar_images:
-        # Generate a file name based on the current date and time
-        now = datetime.now()
-        timestamp = now.strftime("%d-%m-YYYY_%H-%M-%S")
-        output_file = f"similar-images-{timestamp}.txt"
-
-        # Write similar images to the output file
-        with open(output_file, 'w') as out_file:
-            out_file.write(f"Input image: {input_image_path}\n")
-            out_file.write(f"Threshold: {threshold}\n")
-            out_file.write(f"Number of similar images: {num_similar}\n\n")
-            out_file.write("Similar images:\n")
-
-            for i, image_path in enumerate(similar_images[:num_similar]):
-                out_file.write(f"{i + 1}. {image_path}\n")
-
+        output_file = engine.save_results(input_image_path, threshold, num_similar, similar_images[:num_similar])
         messagebox.showinfo("Success", f"Similar images logged to '{output_file}'")
 
 # Function to open a file dialog for image selection
@@ -110,10 +42,98 @@ def select_search_folder():
 
 # Function to find and display similar images
 def find_and_display_similar_images():
+    global search_thread, search_cancel
+
+    if search_thread is not None:
+        return
+
     input_path = input_image_path.get()
     threshold_value = float(threshold.get())
     num_similar_value = int(num_similar.get())
-    find_similar_images(input_path, search_folder_var.get(), threshold_value, num_similar_value)
+
+    results_listbox.delete(0, tk.END)
+    search_cancel = threading.Event()
+    cancel_button.config(state=tk.NORMAL)
+    find_similar_button.config(state=tk.DISABLED)
+    status_var.set("Listing images...")
+
+    # Scan on a worker thread so the window keeps responding
+    search_thread = threading.Thread(target=search_worker, daemon=True,
+                                     args=(input_path, search_folder_var.get(), threshold_value, num_similar_value,
+                                           search_cancel))
+    search_thread.start()
+    window.after(POLL_INTERVAL_MS, poll_search_messages, input_path, threshold_value, num_similar_value)
+
+# Function run on the worker thread, posting progress and the final results to the message queue
+def search_worker(input_path, search_folder, threshold_value, num_similar_value, cancel):
+    try:
+        # With a search service, which already holds the index, only the input image is decoded. Otherwise the
+        # images are listed first, so the progress can tell how many are left.
+        similar_images = engine.query(input_path, search_folder, server_url=args.server, threshold=threshold_value,
+                                      num_similar=num_similar_value, cancel=cancel,
+                                      on_progress=lambda snapshot, total: search_messages.put(('progress', snapshot,
+                                                                                               total)),
+                                      list_first=True, chunk_size=SEARCH_CHUNK_SIZE, snapshot_interval=0.25)
+        search_messages.put(('done', similar_images))
+    except Exception as e:
+        search_messages.put(('error', str(e)))
+
+# Function to handle the messages of the search worker on the Tk main thread
+def poll_search_messages(input_path, threshold_value, num_similar_value):
+    global search_thread
+
+    while True:
+        try:
+            message = search_messages.get_nowait()
+        except queue.Empty:
+            break
+
+        if message[0] == 'progress':
+            status_var.set(engine.format_progress(message[1], message[2]))
+            show_results(message[1].results)
+            continue
+
+        search_thread = None
+        cancel_button.config(state=tk.DISABLED)
+        find_similar_button.config(state=tk.NORMAL)
+
+        if message[0] == 'error':
+            status_var.set("Search failed")
+            messagebox.showerror("Error", message[1])
+        elif search_cancel.is_set():
+            status_var.set("Search canceled")
+        else:
+            show_results(message[1])
+            status_var.set(f"Found {len(message[1])} similar images")
+            log_similar_images(input_path, threshold_value, num_similar_value, message[1])
+        return
+
+    window.after(POLL_INTERVAL_MS, poll_search_messages, input_path, threshold_value, num_similar_value)
+
+# Function to show the ranked matches found so far
+def show_results(similar_images):
+    results_listbox.delete(0, tk.END)
+    for image_path, score in similar_images:
+        results_listbox.insert(tk.END, f"{score:.4f}  {image_path}")
+
+# Function to stop the running search
+def cancel_search():
+    search_cancel.set()
+    status_var.set("Canceling...")
+
+# Parse the command-line options
+parser = argparse.ArgumentParser(description="Visual image search GUI.")
+parser.add_argument("--server", nargs="?", const=DEFAULT_URL,
+                    help=f"Search with a running search service (default {DEFAULT_URL}) instead of scanning the search folder")
+parser.add_argument("--metrics",
+                    help="Write the stage timings and failure counts of the session to this file on exit, JSON or Prometheus text for a .prom file")
+parser.add_argument("--profile", help="Profile the session with cProfile and write the stats to this file on exit")
+args = parser.parse_args()
+
+# The search runs on a worker thread, which only talks to the Tk main thread through the message queue
+search_thread = None
+search_cancel = threading.Event()
+search_messages = queue.Queue()
 
 # Create the main window
 window = tk.Tk()
@@ -155,4 +175,16 @@ search_folder_button.pack()
 find_similar_button = tk.Button(window, text="Find Similar Images", command=find_and_display_similar_images)
 find_similar_button.pack()
 
-window.mainloop()
+# Cancel the running search
+cancel_button = tk.Button(window, text="Cancel", command=cancel_search, state=tk.DISABLED)
+cancel_button.pack()
+
+# Search progress and the best matches found so far
+status_var = tk.StringVar()
+status_label = tk.Label(window, textvariable=status_var)
+status_label.pack()
+results_listbox = tk.Listbox(window, width=80)
+results_listbox.pack()
+
+with instrumented(args.metrics, args.profile):
+    window.mainloop()